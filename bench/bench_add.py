@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# bench_add.py
+# Time of add -A on many small files: the first one, which hashes them
+# all, one with nothing to do, and one after a few files changed.
+#
+#   python3 bench/bench_add.py                  # 20k files
+#   python3 bench/bench_add.py --files 100000
+#
+# Files are spread over directories of 100, two levels deep.
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VERFLOW = os.path.join(ROOT, "verFlow")
+FILES_PER_DIR = 100
+
+
+def filePath(worktree, i):
+    d = i // FILES_PER_DIR
+    return os.path.join(worktree, "d{0}".format(d // 100), "d{0}".format(d % 100),
+                        "f{0}.txt".format(i))
+
+
+def filesWrite(worktree, count, version = 0, step = 1):
+    for i in range(0, count, step):
+        path = filePath(worktree, i)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, "w") as f:
+            f.write("file {0}, version {1}\n".format(i, version))
+
+
+def verFlow(worktree, *args):
+    """Run a verFlow command in worktree.  Returns the seconds it took."""
+    start = time.time()
+    subprocess.run([ sys.executable, VERFLOW ] + list(args), cwd = worktree, check = True)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Time of add -A on many small files")
+    parser.add_argument("--files", type = int, default = 20000, help = "How many files")
+    parser.add_argument("--changed", type = int, default = 100,
+                        help = "Change one file in that many before the last add")
+    parser.add_argument("--dir", help = "Where to create the files (default: a temporary directory)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir = args.dir) as tmp:
+        worktree = os.path.join(tmp, "repo")
+        verFlow(tmp, "init", worktree)
+        filesWrite(worktree, args.files)
+
+        print("add -A, {0} new files: {1:.2f}s".format(args.files, verFlow(worktree, "add", "-A")))
+        print("add -A, nothing changed: {0:.2f}s".format(verFlow(worktree, "add", "-A")))
+        filesWrite(worktree, args.files, version = 1, step = args.changed)
+        print("add -A, {0} files changed: {1:.2f}s".format(
+            len(range(0, args.files, args.changed)), verFlow(worktree, "add", "-A")))
+
+
+if __name__ == "__main__":
+    main()
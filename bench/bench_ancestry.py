@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# bench_ancestry.py
+# Work done by merge-base and --is-ancestor by distance between the
+# commits, on a synthetic history with merges, with and without a
+# commit-graph; and by the full ancestor walk they replace.
+#
+#   python3 bench/bench_ancestry.py                   # 20k commits
+#   python3 bench/bench_ancestry.py --commits 100000
+#
+# The history is a first-parent line where every tenth commit merges a
+# side branch of three commits, forked twenty commits before.  A is the
+# commit d first parents below the tip B.
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from object import GitCommit, objectWrite
+from verFlowRepository import repoCreate, vfREPO
+from vf_ancestry import vfAncestryWalk, isAncestor, mergeBases
+from vf_commitGraph import commitGraphWrite, commitLookup
+
+# The empty tree
+TREE = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+MERGE_EVERY = 10
+SIDE_LENGTH = 3
+SIDE_FORK = 20
+
+
+class vfHistory(object):
+    def __init__(self, repo):
+        self.repo = repo
+        self.date = 1700000000
+
+    def commit(self, parents):
+        commit = GitCommit()
+        commit.kvlm[b"tree"] = TREE.encode("ascii")
+        if parents:
+            commit.kvlm[b"parent"] = [ p.encode("ascii") for p in parents ]
+        self.date += 1
+        person = "A <a@b> {0} +0000".format(self.date).encode("utf8")
+        commit.kvlm[b"author"] = person
+        commit.kvlm[b"committer"] = person
+        commit.kvlm[None] = "commit {0}\n".format(self.date).encode("utf8")
+        return objectWrite(commit, self.repo)
+
+
+def historyWrite(repo, count):
+    """Write about count commits.  Returns the first-parent line, root
+    first."""
+    history = vfHistory(repo)
+    line = [ history.commit([]) ]
+    written = 1
+    while written < count:
+        parents = [ line[-1] ]
+        if len(line) % MERGE_EVERY == 0 and len(line) > SIDE_FORK:
+            side = line[-SIDE_FORK]
+            for _ in range(SIDE_LENGTH):
+                side = history.commit([ side ])
+            parents.append(side)
+            written += SIDE_LENGTH
+        line.append(history.commit(parents))
+        written += 1
+    return line
+
+
+def fullWalk(repo, tip):
+    """What answering meant before: every ancestor of tip."""
+    seen = { tip }
+    todo = [ tip ]
+    while todo:
+        for p in commitLookup(repo, todo.pop()).parents:
+            if p not in seen:
+                seen.add(p)
+                todo.append(p)
+    return len(seen)
+
+
+def measure(path, query):
+    """Run query(repo, walk) on a new repository object.  Returns
+    (commits visited, seconds)."""
+    repo = vfREPO(path)
+    walk = vfAncestryWalk(repo)
+    start = time.perf_counter()
+    query(repo, walk)
+    return walk.visited, time.perf_counter() - start
+
+
+def report(path, line, distances):
+    tip = line[-1]
+    print("{0:>7} {1:>18} {2:>18} {3:>18}".format("d", "merge-base", "is-ancestor (yes)", "is-ancestor (no)"))
+    for d in distances:
+        if d >= len(line):
+            continue
+        a = line[-1 - d]
+        cells = list()
+        for query in (lambda repo, walk: mergeBases(repo, a, [ tip ], walk = walk),
+                      lambda repo, walk: isAncestor(repo, a, tip, walk),
+                      lambda repo, walk: isAncestor(repo, tip, a, walk)):
+            visited, seconds = measure(path, query)
+            cells.append("{0:>7} / {1:.3f}s".format(visited, seconds))
+        print("{0:>7} {1:>18} {2:>18} {3:>18}".format(d, *cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Work of merge-base and --is-ancestor by distance")
+    parser.add_argument("--commits", type = int, default = 20000, help = "About how many commits")
+    parser.add_argument("--distances", type = int, nargs = "+", default = [ 10, 100, 1000, 10000 ])
+    parser.add_argument("--dir", help = "Where to create the repository (default: a temporary directory)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir = args.dir) as tmp:
+        path = os.path.join(tmp, "repo")
+        repo = repoCreate(path)
+        start = time.perf_counter()
+        line = historyWrite(repo, args.commits)
+        print("wrote {0} first-parent commits, {1:.1f}s".format(len(line), time.perf_counter() - start))
+
+        start = time.perf_counter()
+        count = fullWalk(vfREPO(path), line[-1])
+        print("full ancestor walk: {0} commits, {1:.2f}s".format(count, time.perf_counter() - start))
+
+        print("\nwithout a commit-graph (visited / time):")
+        report(path, line, args.distances)
+        commitGraphWrite(repo, tips = [ line[-1] ])
+        print("\nwith a commit-graph (visited / time):")
+        report(path, line, args.distances)
+
+
+if __name__ == "__main__":
+    main()
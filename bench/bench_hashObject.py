@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# bench_hashObject.py
+# Peak memory of hash-object -w by file size: blobs are streamed, so it
+# should stay flat whatever the size.
+#
+#   python3 bench/bench_hashObject.py                 # 10M 100M 1G
+#   python3 bench/bench_hashObject.py --sizes 10M 4G  # needs ~2x disk
+#
+# Each size is hashed by a new verFlow process, whose peak RSS is read
+# from wait4().  The content is a random 1 MB block repeated, so zlib
+# has real work to do.
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VERFLOW = os.path.join(ROOT, "verFlow")
+UNITS = { "K": 1 << 10, "M": 1 << 20, "G": 1 << 30 }
+
+
+def sizeParse(value):
+    if value[-1:].upper() in UNITS:
+        return int(value[:-1]) * UNITS[value[-1:].upper()]
+    return int(value)
+
+
+def fileWrite(path, size):
+    block = os.urandom(1 << 20)
+    with open(path, "wb") as f:
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def hashObject(repo, path):
+    """Run hash-object -w on path.  Returns (sha, seconds, peak RSS in
+    bytes)."""
+    start = time.time()
+    proc = subprocess.Popen([ sys.executable, VERFLOW, "hash-object", "-w", path ],
+                            cwd = repo, stdout = subprocess.PIPE)
+    out = proc.stdout.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise Exception("hash-object failed on {0}".format(path))
+    # ru_maxrss is in kilobytes on Linux
+    return out.decode().strip(), time.time() - start, usage.ru_maxrss * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Peak RSS of hash-object -w by file size")
+    parser.add_argument("--sizes", nargs = "+", default = [ "10M", "100M", "1G" ],
+                        help = "File sizes, with an optional K, M or G suffix")
+    parser.add_argument("--dir", help = "Where to create the files (default: a temporary directory)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir = args.dir) as tmp:
+        repo = os.path.join(tmp, "repo")
+        subprocess.run([ sys.executable, VERFLOW, "init", repo ], check = True)
+        print("{0:>12} {1:>10} {2:>10} {3:>10}".format("size", "seconds", "MB/s", "peak RSS"))
+        for value in args.sizes:
+            size = sizeParse(value)
+            path = os.path.join(tmp, "blob")
+            fileWrite(path, size)
+            sha, seconds, rss = hashObject(repo, path)
+            os.unlink(path)
+            print("{0:>12} {1:>10.2f} {2:>10.1f} {3:>8.1f}MB".format(
+                value, seconds, size / seconds / (1 << 20), rss / (1 << 20)))
+            # Leave the disk for the next one
+            os.unlink(os.path.join(repo, ".ver_flow", "objects", sha[:2], sha[2:]))
+
+
+if __name__ == "__main__":
+    main()
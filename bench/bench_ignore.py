@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# bench_ignore.py
+# Matching paths against a large ignore file: the old matcher, fnmatch
+# against every rule in turn, and the compiled vfIgnoreRules.
+#
+#   python3 bench/bench_ignore.py                        # 100k paths
+#   python3 bench/bench_ignore.py --paths 1000000 --old-paths 20000
+#
+# The rules are a synthetic mix of what ignore files hold: plain names,
+# *.ext, dir/*.tmp, prefix* and a negation.  The old matcher is slow
+# enough to be timed on a sample only.  Its answers differ (its "*"
+# crosses "/"), only the time is compared.
+import argparse
+import os
+import random
+import sys
+import time
+from fnmatch import fnmatch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vf_ignore import vfIgnore, vfIgnoreRules, checkIgnore
+
+
+def rulesMake(count, rand):
+    """count rules, as parsed by vfignoreParse: (pattern, excluded)."""
+    rules = list()
+    kinds = [ lambda i: "name{0}".format(i),
+              lambda i: "*.ext{0}".format(i),
+              lambda i: "dir{0}/*.tmp".format(i),
+              lambda i: "prefix{0}*".format(i) ]
+    for i in range(count - 1):
+        rules.append((kinds[i % len(kinds)](i), True))
+    # "!pattern", for one of them
+    rules.append((rules[rand.randrange(len(rules))][0], False))
+    return rules
+
+
+def pathsMake(count, rules, rand):
+    """count paths, a few of which match some rule."""
+    paths = list()
+    for _ in range(count):
+        dirs = [ "d{0}".format(rand.randrange(50)) for _ in range(rand.randrange(1, 5)) ]
+        if rand.random() < 0.1:
+            dirs[-1] = "dir{0}".format(rand.randrange(len(rules)))
+        name = rand.choice([ "file{0}.c", "name{0}", "file.ext{0}", "prefix{0}x", "a.tmp" ])
+        paths.append("/".join(dirs + [ name.format(rand.randrange(len(rules))) ]))
+    return paths
+
+
+def checkIgnoreOld(rules, path):
+    """What checkIgnoreHelper used to do for each ignore file."""
+    result = None
+    for pattern, value in rules:
+        if fnmatch(path, pattern):
+            result = value
+    return result if result is not None else False
+
+
+def timed(match, paths):
+    """Seconds per path, and how many were ignored."""
+    start = time.perf_counter()
+    ignored = sum(1 for path in paths if match(path))
+    return (time.perf_counter() - start) / len(paths), ignored
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Old and compiled ignore matchers")
+    parser.add_argument("--rules", type = int, default = 301, help = "How many rules")
+    parser.add_argument("--paths", type = int, default = 100000,
+                        help = "How many paths for the compiled matcher")
+    parser.add_argument("--old-paths", type = int, default = 10000,
+                        help = "How many of them for the old matcher")
+    parser.add_argument("--seed", type = int, default = 1)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    rules = rulesMake(args.rules, rand)
+    paths = pathsMake(args.paths, rules, rand)
+
+    start = time.perf_counter()
+    compiled = vfIgnore(absolute = [ vfIgnoreRules(rules) ], scoped = dict())
+    print("compile {0} rules: {1:.1f}ms".format(len(rules), (time.perf_counter() - start) * 1000))
+
+    old, old_ignored = timed(lambda path: checkIgnoreOld(rules, path), paths[:args.old_paths])
+    new, new_ignored = timed(lambda path: checkIgnore(compiled, path), paths)
+    print("old: {0:8.1f}us/path  ({1} paths, {2} ignored, {3:.1f}s for {4})".format(
+        old * 1e6, min(args.old_paths, len(paths)), old_ignored, old * len(paths), len(paths)))
+    print("new: {0:8.1f}us/path  ({1} paths, {2} ignored, {3:.1f}s)".format(
+        new * 1e6, len(paths), new_ignored, new * len(paths)))
+    print("speedup: {0:.0f}x".format(old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# bench_renames.py
+# Time of diff-tree -r -M and -C when many files moved at once: half of
+# them as they were, half edited, plus a few copies of modified files.
+#
+#   python3 bench/bench_renames.py                  # 10k moves
+#   python3 bench/bench_renames.py --moves 50000
+#
+# Both trees are built in this process, with add -A; only the diffs are
+# timed, each by a new verFlow process.
+import argparse
+import collections
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from commandBridge import vfadd
+from verFlowRepository import repoCreate, vfREPO
+from vf_commit import treeFromIndex
+from vf_indexFile import indexRead
+
+VERFLOW = os.path.join(ROOT, "verFlow")
+LINES = 40
+
+
+def fileWrite(path, lines):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, "w") as f:
+        f.writelines(lines)
+
+
+def treeWrite(path):
+    """add -A, and the tree of the index."""
+    repo = vfREPO(path)
+    vfadd(repo, [], all = True)
+    return treeFromIndex(repo, indexRead(repo))
+
+
+def diffTree(path, option, old, new):
+    """Run diff-tree -r with option.  Returns (seconds, count of each
+    status)."""
+    start = time.time()
+    out = subprocess.run([ sys.executable, VERFLOW, "diff-tree", "-r", option, old, new ],
+                         cwd = path, check = True, stdout = subprocess.PIPE).stdout
+    seconds = time.time() - start
+    # Raw output: ":<modes> <shas> <status>\t<path>"
+    status = collections.Counter(line.split(b"\t")[0].split()[-1][:1].decode()
+                                 for line in out.splitlines())
+    return seconds, status
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "diff-tree -M and -C on many moved files")
+    parser.add_argument("--moves", type = int, default = 10000, help = "How many files move")
+    parser.add_argument("--copies", type = int, default = 50,
+                        help = "How many modified files are also copied")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--dir", help = "Where to create the repository (default: a temporary directory)")
+    args = parser.parse_args()
+    rand = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory(dir = args.dir) as tmp:
+        path = os.path.join(tmp, "repo")
+        repoCreate(path)
+        files = dict()
+        for i in range(args.moves + args.copies):
+            files[os.path.join("src", "d{0:03}".format(i // 100), "f{0:05}.c".format(i))] = [
+                "file {0} line {1}: {2:016x}\n".format(i, j, rand.getrandbits(64)) for j in range(LINES) ]
+        for name, lines in files.items():
+            fileWrite(os.path.join(path, name), lines)
+        start = time.time()
+        old = treeWrite(path)
+        print("{0} files added: {1:.1f}s".format(len(files), time.time() - start))
+
+        # The first ones move, every other one edited; the others are
+        # modified in place, and copied
+        names = sorted(files)
+        for i, name in enumerate(names[:args.moves]):
+            lines = files[name]
+            if i % 2:
+                lines[rand.randrange(LINES)] = "edited\n"
+            os.unlink(os.path.join(path, name))
+            fileWrite(os.path.join(path, "moved", name[len("src/"):]), lines)
+        for name in names[args.moves:]:
+            lines = files[name]
+            lines[0] = "modified\n"
+            fileWrite(os.path.join(path, name), lines)
+            lines[1] = "copied\n"
+            fileWrite(os.path.join(path, "copies", os.path.basename(name)), lines)
+        new = treeWrite(path)
+
+        for option in ("-M", "-C"):
+            seconds, status = diffTree(path, option, old, new)
+            print("diff-tree -r {0}: {1:.2f}s  {2}".format(option, seconds, " ".join(
+                "{0}:{1}".format(k, v) for k, v in sorted(status.items()))))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,18 +8,36 @@ from datetime import datetime
 import grp, pwd
 from fnmatch import fnmatch
 import hashlib
+import itertools
 from math import ceil
 import re
+import time
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 from verFlowRepository import repoCreate, repoFile, repoFind, repoPath, repoDir, repoDefaultConfig
-from object import objectRead, objectFind, objectWrite
+from object import objectRead, objectFind, objectWrite, objectHashStream, objectReadStream, objectReadHeader
 from object import GitBlob, GitCommit, GitTree, GitTag
 from kvlmParser import kvlmParse, kvlmSerialize
-from vfRefs import refsList, refResolver
+from vfRefs import refsAll, refResolver, refsTips, refWrite, packRefs
+from vfRefs import vfRefTransaction, REF_ZERO
 from vf_indexFile import indexRead, indexWrite
-from vf_indexFile import vfIndexEntry
-from vf_ignore import vfignoreRead, checkIgnore
+from vf_indexFile import vfIndexEntry, indexEntryFromStat, indexEntryStatMatches
+from vf_cacheTree import cacheTreeRead, cacheTreeStore, cacheTreeInvalidate
+from vf_ignore import vfignoreRead
+from vf_walk import worktreeWalk, pathIgnored
 from vf_commit import treeFromIndex, getUserFromConfig, vfConfigRead
+from vf_repack import repack
+from vf_pack import packsLoad
+from vf_checkout import treeCheckout, checkoutWorkers
+from vf_status import statusCompute, treeToDict
+from vf_commitGraph import commitGraphWrite, commitLookup
+from vf_revWalk import revWalk, revWalkObjects, revDateParse, revDateFormat
+from vf_bitmap import bitmapLoad, bitmapWrite, bitmapReachable, bitsPositions, vfReachStats
+from vf_ancestry import mergeBases, isAncestor, ancestryDateSlop
+from vf_oidIndex import oidAbbrev
+from vf_treeDiff import treeDiff
+from vf_renames import diffRenames, renameThresholdParse, RENAME_THRESHOLD
+from vf_fsmonitor import fsmonitorChanged, fsmonitorStart, fsmonitorStop, fsmonitorRun, fsmonitorDaemonPid
 """ INITIALIZE THE REPOSITORY || CREATE THE REPO """
 def cmd_init(args):
     repoCreate(args.path)
@@ -27,10 +45,24 @@ def cmd_init(args):
 """Output the contents of a file(type object) to stdout"""
 def cmd_cat_file(args):
     repo = repoFind()
+    if args.show_type or args.show_size:
+        # Only the header is needed for those
+        fmt, size = objectReadHeader(repo, objectFind(repo, args.object))
+        print(fmt.decode("ascii") if args.show_type else size)
+        return
+    if not args.type:
+        raise Exception("cat-file needs an object type, or -t or -s")
     cat_file(repo,args.object,fmt = args.type.encode())
 
 def cat_file(repo,obj,fmt = None):
-    obj = objectRead(repo,objectFind(repo,obj,fmt = fmt))
+    sha = objectFind(repo,obj,fmt = fmt)
+    if fmt == b'blob':
+        # Blobs are copied as they are inflated, whatever their size
+        _, _, chunks = objectReadStream(repo, sha)
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        return
+    obj = objectRead(repo,sha)
     sys.stdout.buffer.write(obj.serialize())
 """Hash the object and write back(optional)"""
 def cmd_hash_object(args):
@@ -45,6 +77,10 @@ def cmd_hash_object(args):
 
 def objectHash(fd,fmt,repo = None):
     """Given an object it generates the hash of that specific object"""
+    if fmt == b'blob':
+        # Blobs can be huge: stream them instead of reading them whole
+        return objectHashStream(fd, fmt, repo)
+
     data = fd.read()
     
     match fmt:
@@ -56,55 +92,248 @@ def objectHash(fd,fmt,repo = None):
 
     return objectWrite(obj,repo)
 
-### Add Packfile Implementation with index optional
+### Packfiles: move loose objects into a delta compressed pack
+def cmd_repack(args):
+    repo = repoFind()
+    if args.write_bitmap and not args.all:
+        raise Exception("Bitmaps need all the objects in one pack: use -a")
+    report = repack(repo, prune = args.prune, all = args.all,
+                    window = args.window, depth = args.depth)
+    repackReportPrint(report)
+    if args.write_bitmap and report.pack:
+        bitmapWriteReport(repo, report.pack)
+
+def cmd_gc(args):
+    """Pack everything into a single pack and drop what got packed"""
+    repo = repoFind()
+    report = repack(repo, prune = True, all = True)
+    repackReportPrint(report)
+    print("Wrote {0} commits to the commit-graph".format(commitGraphWrite(repo)))
+    if report.pack:
+        bitmapWriteReport(repo, report.pack)
+
+def bitmapWriteReport(repo, path):
+    """Write the bitmap index of the pack at path, and tell about it"""
+    pack = next(p for p in packsLoad(repo) if p.path == path)
+    start = time.time()
+    count = bitmapWrite(repo, pack)
+    print("Wrote {0} bitmaps ({1} bytes) in {2:.2f}s".format(
+        count, os.path.getsize(path[:-5] + ".bitmap"), time.time() - start))
+
+def cmd_commit_graph(args):
+    repo = repoFind()
+    if args.action == "write":
+        start = time.time()
+        count = commitGraphWrite(repo)
+        print("Wrote {0} commits to the commit-graph in {1:.2f}s".format(count, time.time() - start))
+
+def repackReportPrint(report):
+    if not report.objects:
+        print("Nothing new to pack.")
+        return
+    ratio = report.output_bytes / report.input_bytes if report.input_bytes else 0
+    print("Packed {0} objects ({1} deltas) into {2}".format(
+        report.objects, report.deltas, os.path.basename(report.pack)))
+    print("Input: {0} bytes, output: {1} bytes ({2:.1%}), in {3:.2f}s".format(
+        report.input_bytes, report.output_bytes, ratio, report.seconds))
 
-### log command using graphviz
+### log command
 def cmd_log(args):
     repo = repoFind()
 
-    print("Graph of verFlow Log{")
-    print(" node[shape = rect]")
-    logGraphviz(repo,objectFind(repo,args.commit), set())
-    print("}")
+    if args.graphviz:
+        print("Graph of verFlow Log{")
+        print(" node[shape = rect]")
+        logGraphviz(repo,objectFind(repo,args.commit), set())
+        print("}")
+        return
+
+    since = revDateParse(args.since) if args.since else None
+    until = revDateParse(args.until) if args.until else None
+    walk = revWalk(repo, [ objectFind(repo, args.commit, fmt = b'commit') ],
+                   first_parent = args.first_parent, since = since, until = until,
+                   topo = args.topo_order)
+    if args.max_count is not None:
+        # Stop before looking up anything more than we show
+        walk = itertools.islice(walk, max(args.max_count, 0))
+    try:
+        for count, info in enumerate(walk):
+            if count and not args.oneline:
+                print()
+            logPrint(repo, info, args.oneline)
+    except BrokenPipeError:
+        # The reader went away (log | head): that's not an error.
+        # Python would complain again when flushing stdout on exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+def logPrint(repo, info, oneline = False):
+    """Print commit info, in git's medium format or on one line."""
+    commit = objectRead(repo, info.sha)
+    message = commit.kvlm[None].decode("utf8")
+    if oneline:
+        subject = message.strip().split("\n")[0]
+        print("{0} {1}".format(oidAbbrev(repo, info.sha), subject))
+        return
+
+    print("commit {0}".format(info.sha))
+    if len(info.parents) > 1:
+        print("Merge: {0}".format(" ".join(oidAbbrev(repo, p) for p in info.parents)))
+    author = commit.kvlm.get(b"author") or commit.kvlm.get(b"committer")
+    if author:
+        # "<name> <<email>> <timestamp> <timezone>"
+        who, timestamp, tz = author.decode("utf8").rsplit(" ", 2)
+        print("Author: {0}".format(who))
+        print("Date:   {0}".format(revDateFormat(int(timestamp), tz)))
+    print()
+    for line in message.rstrip("\n").split("\n"):
+        # Blank lines too, as git does
+        print("    " + line)
 
 def logGraphviz(repo, sha, commitSeen):
+    # Walk with a stack, not recursion: histories can be deeper than
+    # Python's recursion limit.  Parents come from the commit-graph.
+    stack = [ sha ]
+    while stack:
+        sha = stack.pop()
+        if sha in commitSeen:
+            continue
+        commitSeen.add(sha)
 
-    if sha in commitSeen:
-        return
-    commitSeen.add(sha)
+        commit = objectRead(repo,sha)
+        assert commit.fmt==b'commit'
+        message = commit.kvlm[None].decode("utf-8").strip()
+        message = message.replace("\\", "\\\\")
+        message  = message.replace("\"", "\\\"")
 
-    commit = objectRead(repo,sha)
-    shortHash = sha[0:8]
-    message = commit.kvlm[None].decode("utf-8").strip()
-    message = message.replace("\\", "\\\\")
-    message  = message.replace("\"", "\\\"")
+        if "\n" in message:
+            message = message[:message.index('\n')]
+
+        print("  c_{0} [label=\"{1}: {2}\"]".format(sha, sha[0:7], message))
+
+        parents = commitLookup(repo, sha).parents
+        for p in parents:
+            print ("  c_{0} -> c_{1};".format(sha, p))
+        # Reversed, so the first parent is walked first, as before
+        stack.extend(reversed(parents))
 
-    if "\n" in message:
-        message = message[:message.index('\n')]
-    
-    print("  c_{0} [label=\"{1}: {2}\"]".format(sha, sha[0:7], message))
-    assert commit.fmt==b'commit'
 
-    if not b'parent' in commit.kvlm.keys():
-        #Initial Commit
+### rev-list command
+def cmd_rev_list(args):
+    """Lists the commits reachable from the given ones but not from those
+    given as ^<commit>, and with --objects their trees and blobs too"""
+    repo = repoFind()
+    start = time.time()
+    tips = list()
+    exclude = list()
+    for name in args.commit:
+        if name.startswith("^"):
+            exclude.append(objectFind(repo, name[1:]))
+        else:
+            tips.append(objectFind(repo, name))
+    if args.all:
+        tips.extend(refsTips(repo))
+    if not tips:
+        raise Exception("No commit specified")
+
+    index = bitmapLoad(repo) if args.use_bitmap_index else None
+    stats = vfReachStats()
+    if index is not None:
+        bits, extra = bitmapReachable(repo, index, tips, stats)
+        if exclude:
+            not_bits, not_extra = bitmapReachable(repo, index, exclude, stats)
+            bits &= ~not_bits
+            extra = { sha: fmt for sha, fmt in extra.items() if not sha in not_extra }
+        if not args.objects:
+            bits &= index.commits
+            extra = { sha: fmt for sha, fmt in extra.items() if fmt == b'commit' }
+        if args.count:
+            print(bits.bit_count() + len(extra))
+        else:
+            # Commits first, as without bitmaps, newest (not packed) first
+            out = [ sha for sha, fmt in extra.items() if fmt == b'commit' ]
+            out += [ index.shaAt(pos) for pos in bitsPositions(bits & index.commits) ]
+            out += [ sha for sha, fmt in extra.items() if fmt != b'commit' ]
+            out += [ index.shaAt(pos) for pos in bitsPositions(bits & ~index.commits) ]
+            if out:
+                sys.stdout.write("\n".join(out) + "\n")
+    else:
+        out = revList(repo, tips, exclude, args.objects)
+        if args.count:
+            print(sum(1 for _ in out))
+        else:
+            for line in out:
+                print(line)
+        stats.seconds = time.time() - start
+
+    if args.stats:
+        if index is not None:
+            print("Bitmap index: {0} ({1} bitmaps, {2} bytes)".format(
+                os.path.basename(index.path), len(index.entries), index.size), file = sys.stderr)
+            print("Bitmaps used: {0}, commits walked: {1}, trees walked: {2}".format(
+                stats.bitmaps, stats.commits, stats.trees), file = sys.stderr)
+        else:
+            print("No bitmap index used", file = sys.stderr)
+        print("Query time: {0:.3f}s".format(stats.seconds), file = sys.stderr)
+
+def revListPeel(repo, shas):
+    """Split shas into commits, and other objects as (sha, fmt).  Tags
+    are peeled: they're in the objects, what they point to too."""
+    commits = list()
+    objects = list()
+    for sha in shas:
+        fmt = objectReadHeader(repo, sha)[0]
+        while fmt == b'tag':
+            objects.append((sha, fmt))
+            tag = objectRead(repo, sha)
+            sha = tag.kvlm[b'object'].decode("ascii")
+            fmt = tag.kvlm[b'type']
+        if fmt == b'commit':
+            commits.append(sha)
+        else:
+            objects.append((sha, fmt))
+    return commits, objects
+
+def revList(repo, tips, exclude, objects = False):
+    """The lines of rev-list without bitmaps: commits newest first, then
+    with objects, tags, then trees and blobs with their paths.  Commits
+    and objects reachable from exclude are walked first, not shown."""
+    commits, others = revListPeel(repo, tips)
+    not_commits, not_others = revListPeel(repo, exclude)
+    excluded = set(info.sha for info in revWalk(repo, not_commits))
+
+    seen = set()
+    if objects:
+        trees = [ (commitLookup(repo, sha).tree, "") for sha in excluded ]
+        trees += [ (sha, "") for sha, fmt in not_others if fmt == b'tree' ]
+        seen.update(sha for sha, fmt in not_others if fmt != b'tree')
+        for _ in revWalkObjects(repo, trees, seen):
+            pass
+
+    trees = list()
+    for info in revWalk(repo, commits, exclude = excluded):
+        yield info.sha
+        trees.append((info.tree, ""))
+    if not objects:
         return
-    
-    parents = commit.kvlm[b'parent']
-    if type(parents) != list:
-        parents = [ parents ]
-
-    for p in parents:
-        p = p.decode("ascii")
-        print ("  c_{0} -> c_{1};".format(sha, p))
-        logGraphviz(repo, p, commitSeen)
-    
+
+    for sha, fmt in others:
+        if fmt != b'tree' and not sha in seen:
+            seen.add(sha)
+            yield sha
+    trees += [ (sha, "") for sha, fmt in others if fmt == b'tree' ]
+    for sha, path in revWalkObjects(repo, trees, seen):
+        yield "{0} {1}".format(sha, path)
+
 
 def cmd_ls_tree(args):
     repo  = repoFind()
-    ls_tree(repo,args.tree, args.recursive)
+    ls_tree(repo,args.tree, args.recursive, long = args.long)
 
-def ls_tree(repo, ref, recursive = None, prefix = ""):
-    sha = objectFind(repo, ref, fmt=b"tree")
+def ls_tree(repo, ref, recursive = None, prefix = "", long = False):
+    ls_tree_sha(repo, objectFind(repo, ref, fmt=b"tree"), recursive, prefix, long)
+
+def ls_tree_sha(repo, sha, recursive = None, prefix = "", long = False):
+    # Subtrees are given by SHA: no need to resolve them as names
     obj = objectRead(repo,sha)
 
     for item in obj.items:
@@ -121,6 +350,12 @@ def ls_tree(repo, ref, recursive = None, prefix = ""):
             case _: raise Exception("Weird tree leaf mode {}".format(item.mode))
 
         if not (recursive and type=='tree'): # This is a leaf
+            if long:
+                # Blob sizes come from the object header alone
+                size = "-"
+                if type == "blob":
+                    size = str(objectReadHeader(repo, item.sha)[1])
+                type = "{0} {1:>7}".format(type, size)
             print("{0} {1} {2}\t{3}".format(
                 "0" * (6 - len(item.mode)) + item.mode.decode("ascii"),
                 #ls-tree displays the type
@@ -129,7 +364,44 @@ def ls_tree(repo, ref, recursive = None, prefix = ""):
                 item.sha,
                 os.path.join(prefix, item.path)))
         else: # This is a branch, recurse
-            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
+            ls_tree_sha(repo, item.sha, recursive, os.path.join(prefix, item.path), long)
+
+
+def cmd_diff_tree(args):
+    """Compares two trees (or the trees of commits), or with a single
+    commit, that commit with its first parent"""
+    repo = repoFind()
+    if len(args.tree) == 1:
+        commit = commitLookup(repo, objectFind(repo, args.tree[0], fmt = b'commit'))
+        if len(commit.parents) != 1:
+            # Like git, neither a root commit nor a merge is compared
+            # with anything
+            return
+        print(commit.sha)
+        old = commitLookup(repo, commit.parents[0]).tree
+        new = commit.tree
+    elif len(args.tree) == 2:
+        old, new = [ objectFind(repo, name, fmt = b'tree') for name in args.tree ]
+    else:
+        raise Exception("diff-tree takes one commit, or two trees")
+
+    changes = treeDiff(repo, old, new, recursive = args.recursive)
+    copies = args.find_copies is not None
+    if copies or args.find_renames is not None:
+        threshold = args.find_copies if copies else args.find_renames
+        threshold = renameThresholdParse(threshold) if threshold else RENAME_THRESHOLD
+        changes = diffRenames(repo, list(changes), copies, threshold, args.rename_candidates)
+
+    try:
+        for change in changes:
+            if args.name_only:
+                print(change.path)
+            elif args.name_status:
+                print(change.name())
+            else:
+                print(change.raw())
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
 
 
 def cmd_checkout(args):
@@ -153,39 +425,116 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path)
 
-    treeCheckout(repo,obj, os.path.realpath(args.path))
+    treeCheckout(repo,obj, os.path.realpath(args.path),
+                 workers = checkoutWorkers(repo, args.jobs))
 
 
-def treeCheckout(repo, tree, path):
-
-    for item in tree.items:
-        obj = objectRead(repo, item.sha)
-        dest = os.path.join(path,item.path)
-
+def cmd_show_ref(args):
+    repo = repoFind()
+    showRefs(refsAll(repo))
 
-        if obj.fmt == b'tree':
-            os.mkdir(dest)
-            treeCheckout(repo, obj, dest)
-        elif obj.fmt == b'blob':
-            # @TODO Support symlinks (identified by mode 12****)
-            with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+def showRefs(refs, with_hash = True, strip = ""):
+    for name, sha in refs:
+        print("{0}{1}".format(sha + " " if with_hash else "", name[len(strip):]))
 
-def cmd_show_ref(args):
+def cmd_pack_refs(args):
     repo = repoFind()
-    refs = refsList(repo)
+    packRefs(repo, all = args.all, prune = args.prune)
 
-    showRefs(repo, refs, prefix="refs")
+def cmd_update_ref(args):
+    """Updates, creates or deletes refs, checking their old values first;
+    with --stdin, a batch of them, all in one transaction"""
+    repo = repoFind()
+    transaction = vfRefTransaction(repo)
+
+    def value(name):
+        # The zero SHA is no object: it means there's no ref
+        if name is None or name == REF_ZERO:
+            return name
+        return objectFind(repo, name)
+
+    if args.stdin:
+        deref = not args.no_deref
+        for command, name, values in updateRefCommands(sys.stdin.buffer.read(), args.z):
+            if command == "option":
+                if name != "no-deref":
+                    raise Exception("Unknown option: {0}".format(name))
+                deref = False
+                continue
+            values = [ value(v) for v in values ]
+            if command == "update":
+                transaction.update(name, values[0], values[1], deref)
+            elif command == "create":
+                transaction.create(name, values[0], deref)
+            elif command == "delete":
+                transaction.delete(name, values[0], deref)
+            else:
+                transaction.verify(name, values[0], deref)
+            # Like git, an option only applies to the next command
+            deref = not args.no_deref
+    elif args.delete:
+        if not 1 <= len(args.args) <= 2:
+            raise Exception("update-ref -d takes a ref and an optional old value")
+        transaction.delete(args.args[0], value((args.args + [ None ])[1]), not args.no_deref)
+    else:
+        if not 2 <= len(args.args) <= 3:
+            raise Exception("update-ref takes a ref, a new value and an optional old value")
+        transaction.update(args.args[0], value(args.args[1]), value((args.args + [ None ])[2]),
+                           not args.no_deref)
+    transaction.commit()
+
+# Number of values each update-ref --stdin command takes, and how many
+# of those may be left out (in the line format)
+UPDATE_REF_COMMANDS = {
+    "update": (2, 1),
+    "create": (1, 0),
+    "delete": (1, 1),
+    "verify": (1, 1),
+    "option": (0, 0),
+}
+# Commands whose first value, the new one, can't be empty: None would
+# mean to only verify the ref
+UPDATE_REF_NEW = ("update", "create")
+
+def updateRefCommands(data, nul = False):
+    """Parse update-ref --stdin commands, yielding (command, ref or
+    option, values).  Values left out are None.  Lines are "<command>
+    <ref> <values>..." separated by spaces; with nul, "<command> <ref>"
+    and each value are followed by a NUL, and a value can't be left out,
+    only be empty.  The new value of update and create can't be empty."""
+    if nul:
+        fields = data.decode().split("\0")
+        if fields[-1] == "":
+            fields.pop()
+        i = 0
+        while i < len(fields):
+            command, _, name = fields[i].partition(" ")
+            if not command in UPDATE_REF_COMMANDS:
+                raise Exception("Unknown command: {0}".format(fields[i]))
+            count = UPDATE_REF_COMMANDS[command][0]
+            values = fields[i + 1:i + 1 + count]
+            if len(values) < count:
+                raise Exception("{0} {1}: missing values".format(command, name))
+            if command in UPDATE_REF_NEW and not values[0]:
+                raise Exception("{0} {1}: missing <new-oid>".format(command, name))
+            yield command, name, [ v or None for v in values ]
+            i += 1 + count
+        return
 
-def showRefs(repo, refs, with_hash = True, prefix = ""):
-    for k,v in refs.items():
-        if type(v) == str:
-            print("{0}{1}{2}".format(
-                v + " " if with_hash  else "",
-                prefix + "/" if prefix else "",
-                k))
-        else:
-            showRefs(repo, v, with_hash = with_hash , prefix="{0}{1}{2}".format(prefix, "/" if prefix else "", k))
+    for line in data.decode().split("\n"):
+        if not line.strip():
+            continue
+        words = line.split(" ")
+        command = words[0]
+        if not command in UPDATE_REF_COMMANDS or len(words) < 2:
+            raise Exception("Unknown command: {0}".format(line))
+        count, optional = UPDATE_REF_COMMANDS[command]
+        values = words[2:]
+        if not count - optional <= len(values) <= count:
+            raise Exception("{0} {1}: expected {2} value(s)".format(command, words[1], count))
+        if command in UPDATE_REF_NEW and not values[0]:
+            raise Exception("{0} {1}: missing <new-oid>".format(command, words[1]))
+        yield command, words[1], values + [ None ] * (count - len(values))
 
 def cmd_tag(args):
     repo  = repoFind()
@@ -199,8 +548,7 @@ def cmd_tag(args):
                   args.object,
                   objectTag)
     else:
-        refs = refsList(repo)
-        showRefs(repo, refs["tags"], with_hash=False)
+        showRefs(refsAll(repo, "refs/tags/"), with_hash=False, strip="refs/tags/")
 
 def createTag(repo,name, ref, createTagObject = False):
     # get the GitObject from the object reference
@@ -224,8 +572,7 @@ def createTag(repo,name, ref, createTagObject = False):
         createRef(repo, "tags/" + name, sha)
 
 def createRef(repo, ref_name, sha):
-    with open(repoFile(repo, "refs/" + ref_name), 'w') as fp:
-        fp.write(sha + "\n")
+    refWrite(repo, "refs/" + ref_name, sha)
 
 # Cmd Rev Parse
 
@@ -237,7 +584,30 @@ def cmd_rev_parse(args):
         fmt = None
 
     repo = repoFind()
-    print (objectFind(repo, args.name, fmt, follow=True))
+    sha = objectFind(repo, args.name, fmt, follow=True)
+    if args.short:
+        sha = oidAbbrev(repo, sha, args.abbrev)
+    print (sha)
+
+
+def cmd_merge_base(args):
+    """Prints the best common ancestor(s) of commits, or tells with the
+    exit status whether one is an ancestor of the other"""
+    repo = repoFind()
+    shas = [ objectFind(repo, name, fmt = b'commit') for name in args.commit ]
+
+    if args.is_ancestor:
+        if len(shas) != 2:
+            raise Exception("--is-ancestor takes two commits")
+        sys.exit(0 if isAncestor(repo, shas[0], shas[1], date_slop = ancestryDateSlop(repo)) else 1)
+
+    if len(shas) < 2:
+        raise Exception("merge-base needs at least two commits")
+    bases = mergeBases(repo, shas[0], shas[1:], all = args.all)
+    if not bases:
+        sys.exit(1)
+    for sha in bases:
+        print(sha)
 
 
 def cmd_ls_files(args):
@@ -282,132 +652,84 @@ def cmd_check_ignore(args):
     #rules to check ?: ignore what file
 
     rules = vfignoreRead(repo)
-    for path in args.path:
-        if checkIgnore(rules,path):
-            print(path)
-
-def cmd_status():
+    paths = args.path
+    if args.stdin:
+        # One path per line, all checked against the same rules
+        paths = paths + [ line.rstrip("\n") for line in sys.stdin ]
+    if not paths:
+        raise Exception("No path specified")
+
+    out = list()
+    for path in paths:
+        # "dir/" is checked as a directory, as is an existing one
+        is_dir = path.endswith("/") or os.path.isdir(os.path.join(repo.worktree, path))
+        # A path in an ignored directory is ignored too
+        if path and pathIgnored(rules, path.rstrip("/"), is_dir):
+            out.append(path)
+    if out:
+        sys.stdout.write("\n".join(out) + "\n")
+
+def cmd_status(args):
     repo = repoFind()
-    index = indexRead(repo)
+    status = statusCompute(repo)
     
-    cmd_status_branch(repo)
-    cmd_status_head_index(repo,index)
+    cmd_status_branch(status)
+    cmd_status_head_index(status)
     print()
-    cmd_status_index_worktree(repo, index)
-
-def cmd_status_branch(repo):
-    branch = getActiveBranch(repo)
-    if branch:
-        print("On branch {}.".format(branch))
+    cmd_status_index_worktree(status)
+    if args.verbose:
+        print()
+        print("fsmonitor: {0}, examined {1} tracked file(s), skipped {2}".format(
+            "used" if status.fsmonitor else "not used (full scan)",
+            status.paths_examined, status.paths_skipped))
+        print("untracked cache: listed {0} directory(ies) from the cache, {1} from the disk".format(
+            status.dirs_cached, status.dirs_read))
+        print("walker: enumerated {0} entries, pruned {1} ignored directory(ies), skipped {2} ignored file(s)".format(
+            status.walk.enumerated, status.walk.pruned, status.walk.ignored))
+
+def cmd_status_branch(status):
+    if status.branch:
+        print("On branch {}.".format(status.branch))
     else:
-        print("HEAD detached at {}".format (objectFind(repo, "HEAD")))
+        print("HEAD detached at {}".format (status.head))
 
-def getActiveBranch(repo):
-    with open(repoFile(repo,"HEAD"),"r") as f:
-        head = f.read()
-    
-    if head.startswith("ref: refs/heads/"):
-        return(head[16:-1])
-    else:
-        return False
-    
-def treeToDict(repo, ref, prefix = ""):
-    ret = dict()
-    tree_sha = objectFind(repo,ref,fmt = b'tree')
-    tree = objectRead(repo,tree_sha)
-
-    for leaf in tree.items:
-        full_path = os.path.join(prefix, leaf.path)
-        # We read the object to extract its type (this is uselessly
-        # expensive: we could just open it as a file and read the
-        # first few bytes)
-        is_subtree = leaf.mode.startswith(b'04')
-        # Depending on the type, we either store the path (if it's a
-        # blob, so a regular file), or recurse (if it's another tree,
-        # so a subdir)
-        if is_subtree:
-            ret.update(treeToDict(repo,leaf.sha,full_path))
-        else:
-            ret[full_path] = leaf.sha
-
-    return ret
 # Finding changes between HEAD and index
-def cmd_status_head_index(repo,index):
-    """Compares head and index to print files yet to be committed """
+def cmd_status_head_index(status):
+    """Prints files yet to be committed """
     print("Changes yet to be committed")
-    head = treeToDict(repo,"HEAD")
-
-    for entry in index.entries:
-        if entry.name  in head:
-            if head[entry.name] != entry.sha:
-                print("  modified:", entry.name)
-            del head[entry.name] # Delete the key
-        else:
-            print("  added:   ", entry.name)
-    # Keys still in HEAD are files that we haven't met in the index,
-    # and thus have been deleted.
-    for entry in head.keys():
-        print("  deleted: ", entry)
+    labels = { "added": "  added:   ", "modified": "  modified:", "deleted": "  deleted: " }
+    for change, name in status.staged:
+        print(labels[change], name)
 
 
 # Finding changes between index and worktree
-def cmd_status_index_worktree(repo,index):
+def cmd_status_index_worktree(status):
     print("Changes not yet staged for commit: ")
+    labels = { "modified": "  modified:", "deleted": " deleted : " }
+    for change, name in status.unstaged:
+        print(labels[change], name)
 
-    #files to ignore
-    ignore = vfignoreRead(repo)
-    gitdir_prefix = repo.gitdir + os.path.sep
-
-    all_files = list()
-
-    # We begin by walking the filesystem
-
-    for (root, _, files) in os.walk(repo.worktree, True):
-        if root==repo.gitdir or root.startswith(gitdir_prefix):
-            continue
-        
-        for f in files:
-            full_path = os.path.join(root,f)
-            rel_path = os.path.relpath(full_path,repo.worktree)
-            all_files.append(rel_path)
-    
-    # We now traverse the index, and compare real files with the cached
-    # versions.
-    for entry in index.entries:
-        full_path = os.path.join(repo.worktree, entry.name)
-        # That file *name* is in the index
-
-        if not os.path.exists(full_path):
-            print(" deleted : ", entry.name)
-        else:
-            stat = os.stat(entry.name)
-
-            # Compare metadata
-
-            ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
-            mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
-
-            if (stat.st_ctime_ns != ctime_ns) or (stat.st_mtime_ns != mtime_ns):
-
-                #if times are different deeply compare
-                with open(full_path, "rb") as fd:
-                    new_sha = objectHash(fd,b"blob",None)
-                    #compare hashes for verification
-                    same = entry.sha == new_sha
-
-                    if not same:
-                        print("  modified:",entry.name)
-
-        if entry.name in all_files:
-            all_files.remove(entry.name)
     print()
     print("Untracked files:")
 
-    for f in all_files:
+    for f in status.untracked:
         # @TODO If a full directory is untracked, we should display
         # its name without its contents.
-        if not checkIgnore(ignore, f):
-            print(" ", f)               
+        print(" ", f)
+
+def cmd_fsmonitor(args):
+    repo = repoFind()
+    if args.action == "start":
+        pid = fsmonitorStart(repo)
+        print("fsmonitor running, pid {0}".format(pid))
+    elif args.action == "run":
+        fsmonitorRun(repo)
+    elif args.action == "stop":
+        if not fsmonitorStop(repo):
+            print("fsmonitor is not running")
+    else:
+        pid = fsmonitorDaemonPid(repo)
+        print("fsmonitor running, pid {0}".format(pid) if pid else "fsmonitor is not running")
 
 def cmd_rm(args):
     repo = repoFind()
@@ -445,50 +767,114 @@ def rm(repo, paths, delete = True, skip_missing = False):
         for path in remove:
             os.unlink(path)
     
+    # Directories that lost entries must get their tree written again
+    cache_tree = cacheTreeRead(index)
+    for path in remove:
+        cacheTreeInvalidate(cache_tree, os.path.relpath(path, repo.worktree))
+    cacheTreeStore(index, cache_tree)
+
     index.entries = kept_entries
     indexWrite(repo,index)
 
 def cmd_add(args): 
     repo = repoFind()
-    vfadd(repo,args.path)
+    vfadd(repo,args.path, all = args.all)
 
-def vfadd(repo, paths, delete = True, skip_missing = False):
-    rm(repo,paths, delete= False, skip_missing = True)
+def vfadd(repo, paths, all = False):
+    """Add files to the index.  Directories are walked (skipping ignored
+    files), and all adds the whole worktree.  Tracked files that are
+    gone from those paths are removed from the index.  The index is
+    read and written only once, and only files that look modified are
+    hashed, on a pool of threads."""
+    if not (paths or all):
+        raise Exception("Nothing specified, nothing added.")
 
-    worktree = repo.worktree + os.sep
+    index = indexRead(repo)
+    entries = dict()
+    for e in index.entries:
+        entries[e.name] = e
 
-  # Convert the paths to pairs: (absolute, relative_to_worktree).
-  # Also delete them from the index if they're present.
+    worktree = repo.worktree + os.sep
 
-    clean_paths = list()
+    # Convert the paths to paths relative to the worktree, split in
+    # files and directories to walk ("" is the whole worktree).
+    files = list()
+    dirs = [ "" ] if all else list()
+    removed = list()
 
     for path in paths:
         abspath = os.path.abspath(path)
-        if not (abspath.startswith(worktree) and os.path.isfile(abspath)):
-            raise Exception("Not a file, or outside the worktree: {}".format(paths))
+        if not (abspath == repo.worktree or abspath.startswith(worktree)):
+            raise Exception("Outside the worktree: {}".format(path))
         relpath = os.path.relpath(abspath,repo.worktree)
-        clean_paths.append((abspath,  relpath))
-
-        index = indexRead(repo)
-
-        for (abspath,relpath) in clean_paths:
-            with open(abspath,"rb") as fd:
-                sha = objectHash(fd, b"blob", repo)
-            stat = os.stat(abspath)
-
-            ctime_s = int(stat.st_ctime)
-            ctime_ns = stat.st_ctime_ns % 10**9
-            mtime_s = int(stat.st_mtime)
-            mtime_ns = stat.st_mtime_ns % 10**9
-
-            entry = vfIndexEntry(ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns), dev=stat.st_dev, ino=stat.st_ino,
-                                    mode_type=0b1000, mode_perms=0o644, uid=stat.st_uid, gid=stat.st_gid,
-                                    fsize=stat.st_size, sha=sha, flag_assume_valid=False,
-                                    flag_stage=False, name=relpath)
-            index.entries.append(entry)
+        if relpath == ".":
+            relpath = ""
+
+        if os.path.isdir(abspath):
+            dirs.append(relpath)
+        elif os.path.isfile(abspath):
+            files.append(relpath)
+        elif relpath in entries:
+            # Deleted since it was added
+            removed.append(relpath)
+        else:
+            raise Exception("Pathspec did not match any files: {}".format(path))
+
+    if dirs:
+        ignore = vfignoreRead(repo, index)
+        # With the fsmonitor running, -A only looks at what changed
+        _, changed = fsmonitorChanged(repo, index) if all else (None, None)
+        if changed is not None:
+            dirs = list()
+            for name in changed:
+                if os.path.isfile(os.path.join(repo.worktree, name)):
+                    if name in entries or not pathIgnored(ignore, name):
+                        files.append(name)
+                elif name in entries:
+                    removed.append(name)
+        for top in dirs:
+            files.extend(worktreeWalk(repo, top, ignore))
+            # Tracked files are kept up to date even in ignored
+            # directories, which the walk doesn't enter.
+            prefix = top + "/" if top else ""
+            for name in entries:
+                if name.startswith(prefix):
+                    if os.path.isfile(os.path.join(repo.worktree, name)):
+                        files.append(name)
+                    else:
+                        removed.append(name)
+
+    cache_tree = cacheTreeRead(index)
+    for name in removed:
+        if entries.pop(name, None) is not None:
+            cacheTreeInvalidate(cache_tree, name)
+
+    # Only hash what isn't already in the index with the same metadata
+    to_hash = list()
+    for relpath in set(files):
+        stat = os.stat(os.path.join(repo.worktree, relpath))
+        e = entries.get(relpath)
+        if e is None or not indexEntryStatMatches(e, stat):
+            to_hash.append((relpath, stat))
+
+    def hashFile(relpath):
+        with open(os.path.join(repo.worktree, relpath),"rb") as fd:
+            return objectHash(fd, b"blob", repo)
+
+    with ThreadPoolExecutor() as pool:
+        shas = pool.map(hashFile, [ relpath for relpath, _ in to_hash ])
+        for (relpath, stat), sha in zip(to_hash, shas):
+            old = entries.get(relpath)
+            new = indexEntryFromStat(relpath, sha, stat)
+            if old is None or (old.sha, old.mode_type, old.mode_perms) != (new.sha, new.mode_type, new.mode_perms):
+                cacheTreeInvalidate(cache_tree, relpath)
+            entries[relpath] = new
+
+    # Write the index back, sorted by name like git does
+    index.entries = [ entries[name] for name in sorted(entries) ]
+    cacheTreeStore(index, cache_tree)
+    indexWrite(repo, index)
 
-            # Write the index back
-            indexWrite(repo, index)
 def commit_create(repo,tree,parent,author,timestamp,message):
     commit = GitCommit()
     commit.kvlm[b"tree"] = tree.encode("ascii")
@@ -517,23 +903,24 @@ def cmd_commit(args):
     index = indexRead(repo)
 
     tree = treeFromIndex(repo,index)
+    # Save the cache tree treeFromIndex updated, so the next commit
+    # only writes the directories that changed.
+    indexWrite(repo, index)
+
     # Create the commit object itself
 
+    parent = objectFind(repo, "HEAD")
     commit = commit_create(repo,
                            tree,
-                           objectFind(repo, "HEAD"),
+                           parent,
                            getUserFromConfig(vfConfigRead()),
                            datetime.now(),
                            args.message)
 
-    # Update HEAD so our commit is now the tip of the active branch
-    active_branch = getActiveBranch(repo)
-    if active_branch:   # If we're on a branch, we update refs/heads/BRANCH
-        with open(repoFile(repo,os.path.join("refs/heads", active_branch)),"w") as fd:
-            fd.write(commit + "\n")
-    else:   # Otherwise, we update HEAD itself.
-        with open(repoFile(repo, "HEAD"), "w") as fd:
-            fd.write("\n")
+    # Update HEAD so our commit is now the tip of the active branch, or
+    # HEAD itself if it's detached.  Unless another commit got there
+    # first: ours would drop it from the history.
+    refWrite(repo, "HEAD", commit, old = parent or REF_ZERO)
 
 
 # Function to map command to handler
@@ -554,6 +941,8 @@ def handle_command(args):
         cmd_log(args)
     elif args.command == "ls-tree":
         cmd_ls_tree(args)
+    elif args.command == "diff-tree":
+        cmd_diff_tree(args)
     elif args.command == "show-refs":
         cmd_show_ref(args)
     elif args.command == "tag":
@@ -565,8 +954,24 @@ def handle_command(args):
     elif args.command == "check-ignore":
         cmd_check_ignore(args)
     elif args.command == "status":
-        cmd_status()
+        cmd_status(args)
     elif args.command == "rm":
         cmd_rm(args)
+    elif args.command == "repack":
+        cmd_repack(args)
+    elif args.command == "gc":
+        cmd_gc(args)
+    elif args.command == "fsmonitor":
+        cmd_fsmonitor(args)
+    elif args.command == "commit-graph":
+        cmd_commit_graph(args)
+    elif args.command == "pack-refs":
+        cmd_pack_refs(args)
+    elif args.command == "update-ref":
+        cmd_update_ref(args)
+    elif args.command == "merge-base":
+        cmd_merge_base(args)
+    elif args.command == "rev-list":
+        cmd_rev_list(args)
     else:
         raise ValueError("Unknown command: {}".format(args.command))
\ No newline at end of file
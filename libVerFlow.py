@@ -20,6 +20,17 @@ import zlib
 import commandBridge
 
 
+class SimilarityAction(argparse.Action):
+    """-M[<n>] and friends.  git only takes a threshold attached to the
+    option ("-M60%", "--find-renames=60%"), but argparse also takes the
+    word after it: one that isn't a threshold is a tree, given back."""
+
+    def __call__(self, parser, namespace, values, option_string = None):
+        if values and not re.fullmatch(r"[0-9]+%?", values):
+            namespace.tree = (namespace.tree or []) + [values]
+            values = ""
+        setattr(namespace, self.dest, values)
+
 argparser = argparse.ArgumentParser(description='VerFlow: VCS for Coding Projects')  # creating an argument parser object
 argsubparsers = argparser.add_subparsers(title='Commands', dest='command')  # creating a subparser object
 argsubparsers.required = True  # subparser is required
@@ -35,8 +46,17 @@ argsp.add_argument("path",
                    )
 ## Subparser for cmd_cat-file handler
 argsp = argsubparsers.add_parser("cat-file",help="Output content of repository objects")
+argsp.add_argument("-t",
+                   dest="show_type",
+                   action="store_true",
+                   help="Show the object type instead of its content")
+argsp.add_argument("-s",
+                   dest="show_size",
+                   action="store_true",
+                   help="Show the object size instead of its content")
 argsp.add_argument("type",
                    metavar="type",
+                   nargs="?",
                    choices=["blob","commit","tree","tag"],
                    help="Specify the type of object")
 argsp.add_argument("object",
@@ -65,6 +85,28 @@ argsp.add_argument("commit",
                    default="HEAD",
                    nargs="?",
                    help="Commits to start the log at.")
+argsp.add_argument("-n", "--max-count",
+                   type=int,
+                   metavar="number",
+                   help="Show at most that many commits")
+argsp.add_argument("--since", "--after",
+                   metavar="date",
+                   help="Show commits more recent than date")
+argsp.add_argument("--until", "--before",
+                   metavar="date",
+                   help="Show commits older than date")
+argsp.add_argument("--first-parent",
+                   action="store_true",
+                   help="Only follow the first parent of merge commits")
+argsp.add_argument("--topo-order",
+                   action="store_true",
+                   help="Show no parent before all its children")
+argsp.add_argument("--oneline",
+                   action="store_true",
+                   help="Show each commit on one line: short hash and subject")
+argsp.add_argument("--graphviz",
+                   action="store_true",
+                   help="Print the history as a Graphviz graph")
 
 ## Subparser for cmd ls tree
 
@@ -73,12 +115,54 @@ argsp.add_argument("-r",
                    dest="recursive",
                    action="store_true",
                    help='Recurse into sub-trees')
+argsp.add_argument("-l", "--long",
+                   dest="long",
+                   action="store_true",
+                   help="Show the size of blobs")
 argsp.add_argument("tree", help="A tree object")
 
+# Subparser for diff-tree command
+argsp = argsubparsers.add_parser("diff-tree", help="Compare the content of two trees, or a commit with its parent")
+argsp.add_argument("-r",
+                   dest="recursive",
+                   action="store_true",
+                   help="Recurse into sub-trees")
+argsp.add_argument("--name-only",
+                   action="store_true",
+                   help="Only show the paths that changed")
+argsp.add_argument("--name-status",
+                   action="store_true",
+                   help="Only show the paths that changed, and how")
+argsp.add_argument("-M", "--find-renames",
+                   nargs="?",
+                   const="",
+                   metavar="N",
+                   action=SimilarityAction,
+                   help="Detect renames of files at least N similar (default 50%%)")
+argsp.add_argument("-C", "--find-copies",
+                   nargs="?",
+                   const="",
+                   metavar="N",
+                   action=SimilarityAction,
+                   help="Detect copies, from modified or renamed files, as well as renames")
+argsp.add_argument("--rename-candidates",
+                   type=int,
+                   help="How many similar files to score for each added file "
+                        "(default: diff.renameCandidates, or 10)")
+argsp.add_argument("tree",
+                   nargs="*",
+                   action="extend",
+                   help="Two trees (or commits), or one commit")
+
 ## Subparser for cmd_checkout
 
 argsp = argsubparsers.add_parser("checkout",help="Checkout to commit inside of a directory")
 
+argsp.add_argument("-j", "--jobs",
+                   type=int,
+                   default=None,
+                   help="Number of parallel workers (default: checkout.workers, or 1)")
+
 argsp.add_argument("commit",
                    help="The commit or tree to checkout")
 argsp.add_argument("path",
@@ -117,9 +201,50 @@ argsp.add_argument("--vf-type",
                    choices=["blob","commit","tag","tree"],
                    default=None,
                    help="Specify the expected type")
+argsp.add_argument("--short",
+                   action="store_true",
+                   help="Print the shortest unique prefix of the hash")
+argsp.add_argument("--abbrev",
+                   type=int,
+                   metavar="length",
+                   help="With --short, print at least length digits (default: core.abbrev)")
 argsp.add_argument("name",
                    help="The name to parse")
 
+## Subparser for rev-list command
+
+argsp = argsubparsers.add_parser("rev-list", help="List the commits, or objects, reachable from commits")
+argsp.add_argument("--objects",
+                   action="store_true",
+                   help="Also list the trees and blobs of the commits")
+argsp.add_argument("--count",
+                   action="store_true",
+                   help="Only print how many there are")
+argsp.add_argument("--all",
+                   action="store_true",
+                   help="Start from all the refs and HEAD")
+argsp.add_argument("--use-bitmap-index",
+                   action="store_true",
+                   help="Use the bitmap index, if there is one")
+argsp.add_argument("--stats",
+                   action="store_true",
+                   help="Print the bitmap index size and query time on stderr")
+argsp.add_argument("commit",
+                   nargs="*",
+                   help="The commits to start from, or not to list when prefixed with ^")
+
+## Subparser for merge-base command
+
+argsp = argsubparsers.add_parser("merge-base", help="Find the best common ancestors of commits")
+argsp.add_argument("-a", "--all",
+                   action="store_true",
+                   help="Print all the best common ancestors, not just one")
+argsp.add_argument("--is-ancestor",
+                   action="store_true",
+                   help="Exit with 0 if the first commit is an ancestor of the second, else 1")
+argsp.add_argument("commit",
+                   nargs="+",
+                   help="The commits")
 
 argsp = argsubparsers.add_parser("ls-files", help= "List all the files currently in staging area")
 
@@ -130,12 +255,18 @@ argsp.add_argument("--verbose",
 
 argsp = argsubparsers.add_parser("check-ignore",
                                  help="Check path(s) against ignore rules")
+argsp.add_argument("--stdin",
+                   action="store_true",
+                   help="Also read paths from the standard input, one per line")
 argsp.add_argument("path",
-                   nargs="+",
+                   nargs="*",
                    help="Path to check")
 # Subparser for  status command
 argsp = argsubparsers.add_parser("status",
                                  help= "Show the current status of worktree")
+argsp.add_argument("-v", "--verbose",
+                   action="store_true",
+                   help="Also show how many files were examined")
 
 # SubParser for rm command
 argsp = argsubparsers.add_parser("rm",help="Remove files from the working tree and the index")
@@ -144,7 +275,11 @@ argsp.add_argument("path",
                    help="Path of files to remove")
 # Subparser for add command
 argsp = argsubparsers.add_parser("add", help= "Add files contents to the index")
-argsp.add_argument("path", nargs="+", help="Files to add")
+argsp.add_argument("-A", "--all",
+                   dest="all",
+                   action="store_true",
+                   help="Add, modify and remove entries to match the whole worktree")
+argsp.add_argument("path", nargs="*", help="Files or directories to add")
 
 # Subparser for commit command
 argsp = argsubparsers.add_parser("commit", help= "Record changes to the repository.")
@@ -153,6 +288,76 @@ argsp.add_argument("-m",
                    dest="message",
                    help="Message to associate with this commit")
 
+# Subparser for repack command
+argsp = argsubparsers.add_parser("repack", help="Pack loose objects into a delta compressed pack")
+argsp.add_argument("-a",
+                   dest="all",
+                   action="store_true",
+                   help="Also repack the objects of the existing packs")
+argsp.add_argument("-d",
+                   dest="prune",
+                   action="store_true",
+                   help="Remove the loose objects and packs made redundant")
+argsp.add_argument("-b", "--write-bitmap-index",
+                   dest="write_bitmap",
+                   action="store_true",
+                   help="Write a reachability bitmap index for the new pack (needs -a)")
+argsp.add_argument("--window",
+                   type=int,
+                   default=10,
+                   help="Number of objects to try as delta bases")
+argsp.add_argument("--depth",
+                   type=int,
+                   default=50,
+                   help="Maximum delta chain length")
+
+# Subparser for gc command
+argsp = argsubparsers.add_parser("gc", help="Pack all objects into a single pack, and prune the rest")
+
+# Subparser for commit-graph command
+argsp = argsubparsers.add_parser("commit-graph", help="Write the commit-graph file, to speed up history walks")
+argsp.add_argument("action",
+                   choices=["write"],
+                   help="What to do")
+
+# Subparser for pack-refs command
+argsp = argsubparsers.add_parser("pack-refs", help="Move refs to the packed-refs file, to list and look them up faster")
+argsp.add_argument("--all",
+                   action="store_true",
+                   help="Pack all the refs, not only tags and the refs already packed")
+argsp.add_argument("--no-prune",
+                   dest="prune",
+                   action="store_false",
+                   help="Keep the loose refs")
+
+# Subparser for update-ref command
+argsp = argsubparsers.add_parser("update-ref", help="Update, create or delete refs safely, one or a batch at a time")
+argsp.add_argument("-d",
+                   dest="delete",
+                   action="store_true",
+                   help="Delete the ref, checking its old value if given")
+argsp.add_argument("--no-deref",
+                   action="store_true",
+                   help="Update symbolic refs themselves, not the refs they point to")
+argsp.add_argument("--stdin",
+                   action="store_true",
+                   help="Read update, create, delete and verify commands from the standard input, "
+                        "and apply them all or none")
+argsp.add_argument("-z",
+                   action="store_true",
+                   help="With --stdin, fields are terminated by NUL")
+argsp.add_argument("args",
+                   nargs="*",
+                   help="<ref> <new value> [<old value>], or with -d <ref> [<old value>]")
+
+# Subparser for fsmonitor command
+argsp = argsubparsers.add_parser("fsmonitor", help="Run a daemon watching the worktree for changes")
+argsp.add_argument("action",
+                   nargs="?",
+                   default="start",
+                   choices=["start", "stop", "status", "run"],
+                   help="Start it in the background (default), stop it, show if it runs, or run it in the foreground")
+
 def main(argv = sys.argv[1:]):
     args = argparser.parse_args(argv)
     commandBridge.handle_command(args)
\ No newline at end of file
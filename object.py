@@ -1,13 +1,18 @@
 # importing standard libraries
 import os
+import collections
 import hashlib
 import zlib
 import re
+import tempfile
 #importing other files
-from verFlowRepository import repoFile, repoDir
+from verFlowRepository import repoFile, repoDir, repoPath
 from kvlmParser import kvlmParse,kvlmSerialize
 from verFlowTree import treeParser, treeSerialize
 from vfRefs import refResolver
+from vf_cache import repoObjectCache
+from vf_pack import packRead, packReadStream, packReadHeader, packContains, inflateStream
+from vf_oidIndex import oidIndex
 
 class VerFlowObject (object):
     
@@ -29,14 +34,27 @@ class VerFlowObject (object):
     def init(self):
         pass  # Default implementation
 
-def objectRead(repo, sha):
-    """Read object sha from VerFlow repository repo. Return a
-    VerFlowObject whose exact type depends on the object."""
+def objectReadRaw(repo, sha):
+    """Read the object sha, either loose or from a pack. Return a
+    pair (fmt, data) without the header, or None if it doesn't exist.
+    Objects read are kept in the repo's object cache."""
+
+    cache = repoObjectCache(repo)
+    ret = cache.get(sha)
+    if ret is not None:
+        return ret
+
+    ret = objectReadRawUncached(repo, sha)
+    if ret is not None:
+        cache.put(sha, *ret)
+    return ret
 
+def objectReadRawUncached(repo, sha):
     path = repoFile(repo, "objects", sha[0:2], sha[2:])
 
-    if not os.path.isfile(path):
-        return None
+    if not (path and os.path.isfile(path)):
+        # Not a loose object, try the packs.
+        return packRead(repo, sha, resolve=lambda base: objectReadRaw(repo, base))
 
     with open(path, "rb") as f:
         raw = zlib.decompress(f.read())
@@ -53,16 +71,143 @@ def objectRead(repo, sha):
         if size != len(raw) - y - 1:
             raise Exception("Malformed object {0}: bad length".format(sha))
 
-        # Object type to format mapping
-        match fmt:
-            case b'commit' : c=GitCommit
-            case b'tree'   : c=GitTree
-            case b'tag'    : c=GitTag
-            case b'blob'   : c=GitBlob
-            case _:
-                raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
-        # Call constructor
-        return c(raw[y + 1:])
+        return fmt, raw[y + 1:]
+
+# Number of (fmt, size) pairs remembered by objectReadHeader
+HEADER_CACHE_SIZE = 4096
+# Compressed bytes read at once when peeking at a loose object header
+HEADER_PEEK = 256
+
+def objectReadHeader(repo, sha):
+    """Return the pair (fmt, size) of object sha, or None if it doesn't
+    exist.  Only the header is inflated, so this costs the same for a
+    tiny commit and a huge blob.  Results are cached on the repo, which
+    is safe since an object never changes."""
+    if repo.header_cache is None:
+        repo.header_cache = collections.OrderedDict()
+    cache = repo.header_cache
+    if sha in cache:
+        cache.move_to_end(sha)
+        return cache[sha]
+    cached = repoObjectCache(repo).peek(sha)
+    if cached is not None:
+        return cached[0], len(cached[1])
+
+    path = repoFile(repo, "objects", sha[0:2], sha[2:])
+
+    if path and os.path.isfile(path):
+        with open(path, "rb") as f:
+            d = zlib.decompressobj()
+            buf = b''
+            while not b'\x00' in buf:
+                data = d.unconsumed_tail or f.read(HEADER_PEEK)
+                if not data:
+                    raise Exception("Malformed object {0}: bad header".format(sha))
+                buf += d.decompress(data, HEADER_PEEK)
+        x = buf.find(b' ')
+        y = buf.find(b'\x00')
+        ret = (buf[0:x], int(buf[x+1:y].decode("ascii")))
+    else:
+        ret = packReadHeader(repo, sha, resolve=lambda base: objectReadHeader(repo, base))
+        if ret is None:
+            return None
+
+    cache[sha] = ret
+    if len(cache) > HEADER_CACHE_SIZE:
+        cache.popitem(last=False)
+    return ret
+
+def objectReadStream(repo, sha):
+    """Read object sha as a stream.  Return a triple (fmt, size, chunks)
+    where chunks is an iterator over the object's data, or None if the
+    object doesn't exist.  Only a small buffer is kept in memory, so
+    this is the way to read blobs of any size."""
+
+    cached = repoObjectCache(repo).get(sha)
+    if cached is not None:
+        return cached[0], len(cached[1]), iter([cached[1]])
+
+    path = repoFile(repo, "objects", sha[0:2], sha[2:])
+
+    if not (path and os.path.isfile(path)):
+        return packReadStream(repo, sha, resolve=lambda base: objectReadRaw(repo, base))
+
+    def stream():
+        with open(path, "rb") as f:
+            chunks = inflateStream(f.read)
+
+            # The header is at most a few dozen bytes: inflate until we
+            # meet its null terminator.
+            buf = b''
+            for chunk in chunks:
+                buf += chunk
+                y = buf.find(b'\x00')
+                if y >= 0:
+                    break
+            x = buf.find(b' ')
+            if y < 0 or x < 0 or x > y:
+                raise Exception("Malformed object {0}: bad header".format(sha))
+            size = int(buf[x+1:y].decode("ascii"))
+            # First item is the header, the data follows.
+            yield buf[0:x], size
+
+            got = len(buf) - y - 1
+            if got:
+                yield buf[y + 1:]
+            for chunk in chunks:
+                got += len(chunk)
+                yield chunk
+            if got != size:
+                raise Exception("Malformed object {0}: bad length".format(sha))
+
+    chunks = stream()
+    fmt, size = next(chunks)
+    return fmt, size, chunks
+
+def objectReadRange(repo, sha, offset, length):
+    """Read length bytes of object sha starting at offset, without
+    keeping more than a chunk in memory.  Returns less than length
+    bytes if the object ends first."""
+    stream = objectReadStream(repo, sha)
+    if stream is None:
+        raise Exception("Missing object {0}".format(sha))
+    fmt, size, chunks = stream
+    end = min(offset + length, size)
+    ret = list()
+    pos = 0
+    for chunk in chunks:
+        next_pos = pos + len(chunk)
+        if next_pos > offset:
+            ret.append(chunk[max(offset - pos, 0):end - pos])
+        pos = next_pos
+        if pos >= end:
+            # Stop inflating; cached objects and deltas are plain
+            # iterators over a single chunk, with nothing to close
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+            break
+    return b''.join(ret)
+
+def objectRead(repo, sha):
+    """Read object sha from VerFlow repository repo. Return a
+    VerFlowObject whose exact type depends on the object."""
+
+    raw = objectReadRaw(repo, sha)
+    if raw is None:
+        return None
+    fmt, data = raw
+
+    # Object type to format mapping
+    match fmt:
+        case b'commit' : c=GitCommit
+        case b'tree'   : c=GitTree
+        case b'tag'    : c=GitTag
+        case b'blob'   : c=GitBlob
+        case _:
+            raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+    # Call constructor
+    return c(data)
 
         
 def objectWrite(obj, repo=None):
@@ -84,6 +229,54 @@ def objectWrite(obj, repo=None):
     return sha
 
 
+# Size of the chunks read when streaming objects
+STREAM_CHUNK = 1024 * 1024
+
+def objectHashStream(fd, fmt = b'blob', repo = None):
+    """Same as objectWrite, for an object whose data is the content of
+    the open file fd.  The data is read, hashed and compressed chunk by
+    chunk, so memory usage doesn't depend on the size of the file."""
+    size = os.fstat(fd.fileno()).st_size
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+    h = hashlib.sha1(header)
+
+    tmp = None
+    if repo:
+        # We only know where the object goes once it's hashed, so we
+        # write to a temporary file and move it in place afterwards.
+        tmp_fd, tmp = tempfile.mkstemp(dir=repoDir(repo, "objects"), prefix="tmp_obj_")
+        out = os.fdopen(tmp_fd, "wb")
+        z = zlib.compressobj()
+        out.write(z.compress(header))
+
+    try:
+        read = 0
+        for chunk in iter(lambda: fd.read(STREAM_CHUNK), b''):
+            read += len(chunk)
+            h.update(chunk)
+            if tmp:
+                out.write(z.compress(chunk))
+        if read != size:
+            raise Exception("File changed while being hashed: {0}".format(fd.name))
+
+        sha = h.hexdigest()
+        if tmp:
+            out.write(z.flush())
+            out.close()
+            path = repoFile(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+            if os.path.exists(path):
+                os.unlink(tmp)
+            else:
+                os.replace(tmp, path)
+            tmp = None
+    finally:
+        if tmp:
+            out.close()
+            os.unlink(tmp)
+
+    return sha
+
+
 ##Object Resolver
 
 def objectResolve(repo,name):
@@ -112,15 +305,14 @@ This function is aware of:
         # This may be a hash, either small or full.  4 seems to be the
         # minimal length for git to consider something a short hash.
         name = name.lower()
-        prefix = name[0:2]
-        path = repoDir(repo,"objects",prefix,mkdir=False)
-        if path:
-            rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    # Notice a string startswith() itself, so this
-                    # works for full hashes.
-                    candidates.append(prefix + f)
+        if len(name) == 40:
+            # A full hash names the object, if there's one: no need to
+            # look for others, nor at the refs.
+            path = repoPath(repo, "objects", name[0:2], name[2:])
+            if os.path.isfile(path) or packContains(repo, name):
+                return [ name ]
+        else:
+            candidates.extend(oidIndex(repo).prefixMatch(name))
        # Try for references.
     as_tag = refResolver(repo, "refs/tags/" + name)
     if as_tag: # Did we find a tag?
@@ -133,6 +325,14 @@ This function is aware of:
     return candidates
 
 def objectFind(repo, name, fmt=None, follow=True):
+    # The commit-graph module reads objects through us
+    from vf_commitGraph import commitLookup
+
+    # <rev>~<n> is the n-th first parent of rev, <rev>^<n> its n-th
+    # parent, and they chain: HEAD~2^2
+    navigation = re.match(r"^(.*?)((?:[~^][0-9]*)*)$", name)
+    name, navigation = navigation.group(1), navigation.group(2)
+
     sha = objectResolve(repo, name)
 
     if not sha:
@@ -142,19 +342,39 @@ def objectFind(repo, name, fmt=None, follow=True):
     
     sha = sha[0]
 
+    for op, count in re.findall(r"([~^])([0-9]*)", navigation):
+        count = int(count) if count else 1
+        sha = objectFind(repo, sha, fmt = b'commit')
+        if op == "~":
+            for _ in range(count):
+                parents = commitLookup(repo, sha).parents
+                if not parents:
+                    raise Exception("No such reference {0}{1}.".format(name, navigation))
+                sha = parents[0]
+        elif count:
+            parents = commitLookup(repo, sha).parents
+            if count > len(parents):
+                raise Exception("No such reference {0}{1}.".format(name, navigation))
+            sha = parents[count - 1]
+
     if not fmt:
         return sha
     
     while True:
-        obj = objectRead(repo,sha)
-        #     ^^^^^^^^^^^ < this is a bit agressive: we're reading
-          # the full object just to get its type.  And we're doing
-          # that in a loop, albeit normally short.  Don't expect
-          # high performance here
-        if obj.fmt == fmt:
+        # Only peek at the header for the type: the full object is
+        # read only when we have to follow it.
+        header = objectReadHeader(repo,sha)
+        if header is None:
+            return None
+        if header[0] == fmt:
             return sha
         if not follow:
             return None
+        if header[0] == b'commit' and fmt == b'tree':
+            # The commit-graph knows the tree, no need to parse
+            sha = commitLookup(repo, sha).tree
+            continue
+        obj = objectRead(repo,sha)
         
         ## FOllow tags
         if obj.fmt == b'tag':
@@ -0,0 +1,126 @@
+# test_ancestry.py
+# isAncestor on histories whose dates lie, with and without a
+# commit-graph.
+import argparse
+import os
+
+import pytest
+
+import commandBridge
+from object import GitCommit, objectWrite
+from verFlowRepository import repoCreate, vfREPO
+from vf_ancestry import isAncestor, mergeBases
+from vf_commitGraph import commitGraphWrite
+
+DAY = 86400
+# The empty tree
+TREE = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+
+
+def commitWrite(repo, parents, date, message):
+    commit = GitCommit()
+    commit.kvlm[b"tree"] = TREE.encode("ascii")
+    if parents:
+        commit.kvlm[b"parent"] = [ p.encode("ascii") for p in parents ]
+    person = "A <a@b> {0} +0000".format(date).encode("utf8")
+    commit.kvlm[b"author"] = person
+    commit.kvlm[b"committer"] = person
+    commit.kvlm[None] = message.encode("utf8")
+    return objectWrite(commit, repo)
+
+
+@pytest.fixture
+def history(tmp_path):
+    """root, then a commit made on a machine whose clock was ten days
+    behind, then one made on time; and a side branch off root.  Also
+    a merge of the side branch dated before both its parents."""
+    repo = repoCreate(str(tmp_path / "repo"))
+    now = 1700000000
+    c = dict()
+    c["root"] = commitWrite(repo, [], now, "root")
+    c["late"] = commitWrite(repo, [ c["root"] ], now - 10 * DAY, "behind")
+    c["tip"] = commitWrite(repo, [ c["late"] ], now + 60, "tip")
+    c["side"] = commitWrite(repo, [ c["root"] ], now + 30, "side")
+    c["merge"] = commitWrite(repo, [ c["tip"], c["side"] ], now - 20 * DAY, "merge")
+    repo.commits = c
+    return repo
+
+
+ANCESTORS = [
+    ("root", "tip", True),
+    ("root", "late", True),
+    ("late", "tip", True),
+    ("root", "merge", True),
+    ("side", "merge", True),
+    ("late", "merge", True),
+    ("tip", "tip", True),
+    ("tip", "root", False),
+    ("side", "tip", False),
+    ("tip", "side", False),
+    ("merge", "root", False),
+]
+
+
+@pytest.mark.parametrize("ancestor, descendant, expected", ANCESTORS)
+def testSkewedNoGraph(history, ancestor, descendant, expected):
+    c = history.commits
+    repo = vfREPO(history.worktree)
+    assert isAncestor(repo, c[ancestor], c[descendant]) is expected
+
+
+@pytest.mark.parametrize("ancestor, descendant, expected", ANCESTORS)
+def testSkewedGraph(history, ancestor, descendant, expected):
+    c = history.commits
+    assert commitGraphWrite(history, tips = [ c["merge"] ]) == 5
+    repo = vfREPO(history.worktree)
+    assert isAncestor(repo, c[ancestor], c[descendant]) is expected
+
+
+def testSkewedPartialGraph(history):
+    # Only the first commits in the graph: the others are walked by
+    # date, through commits that are in it
+    c = history.commits
+    commitGraphWrite(history, tips = [ c["late"] ])
+    repo = vfREPO(history.worktree)
+    assert isAncestor(repo, c["root"], c["tip"])
+    assert isAncestor(repo, c["late"], c["merge"])
+    assert isAncestor(repo, c["side"], c["merge"])
+    assert not isAncestor(repo, c["side"], c["tip"])
+
+
+def testDateSlopOptIn(history):
+    # With a cutoff, the commit ten days behind isn't walked through:
+    # that's the answer it trades for speed
+    c = history.commits
+    repo = vfREPO(history.worktree)
+    assert not isAncestor(repo, c["root"], c["tip"], date_slop = DAY)
+    assert isAncestor(repo, c["root"], c["tip"], date_slop = 30 * DAY)
+    # Generation numbers win over the cutoff
+    commitGraphWrite(history, tips = [ c["merge"] ])
+    assert isAncestor(vfREPO(history.worktree), c["root"], c["tip"], date_slop = DAY)
+
+
+def isAncestorCommand(monkeypatch, repo, ancestor, descendant):
+    """The exit status of merge-base --is-ancestor."""
+    monkeypatch.chdir(repo.worktree)
+    with pytest.raises(SystemExit) as e:
+        commandBridge.cmd_merge_base(argparse.Namespace(
+            all = False, is_ancestor = True, commit = [ ancestor, descendant ]))
+    return e.value.code
+
+
+def testCommandConfig(monkeypatch, history):
+    c = history.commits
+    assert isAncestorCommand(monkeypatch, history, c["root"], c["tip"]) == 0
+    conf = vfREPO(history.worktree).conf
+    conf.set("core", "ancestryDateSlop", str(DAY))
+    with open(os.path.join(history.gitdir, "config"), "w") as f:
+        conf.write(f)
+    assert isAncestorCommand(monkeypatch, history, c["root"], c["tip"]) == 1
+
+
+def testMergeBaseSkewed(history):
+    c = history.commits
+    repo = vfREPO(history.worktree)
+    assert mergeBases(repo, c["tip"], [ c["side"] ]) == [ c["root"] ]
+    assert mergeBases(repo, c["merge"], [ c["side"] ]) == [ c["side"] ]
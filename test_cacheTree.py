@@ -0,0 +1,165 @@
+# test_cacheTree.py
+# The TREE index extension: its format, which directories adding a file
+# invalidates, and the trees commit and status no longer read or write.
+import os
+import shutil
+import subprocess
+from datetime import datetime
+
+import pytest
+
+import object as vfobject
+import vf_commit
+import vf_status
+from commandBridge import vfadd, commit_create
+from verFlowRepository import repoCreate, vfREPO
+from vfRefs import refWrite
+from vf_cacheTree import (vfCacheTree, cacheTreeParse, cacheTreeSerialize, cacheTreeRead,
+                          cacheTreeInvalidate, cacheTreeFind)
+from vf_commit import treeFromIndex
+from vf_indexFile import indexRead, indexWrite
+from vf_status import statusCompute
+
+FILES = [ "top", "a/one", "a/b/two", "a/b/three", "c/four", "bb/five", "a-b/six" ]
+
+
+def filesWrite(worktree, names, content = "{0}\n"):
+    for name in names:
+        path = os.path.join(worktree, name)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, "w") as f:
+            f.write(content.format(name))
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """A repository with FILES committed, and the index they were
+    committed from, with its cache tree."""
+    repo = repoCreate(str(tmp_path / "repo"))
+    monkeypatch.chdir(repo.worktree)
+    filesWrite(repo.worktree, FILES)
+    vfadd(repo, [], all = True)
+    index = indexRead(repo)
+    tree = treeFromIndex(repo, index)
+    indexWrite(repo, index)
+    refWrite(repo, "HEAD", commit_create(repo, tree, None, "A <a@b>", datetime.now(), "files\n"))
+    repo = vfREPO(repo.worktree)
+    repo.tree = tree
+    return repo
+
+
+def node(entry_count, sha = None, **subtrees):
+    n = vfCacheTree()
+    n.entry_count = entry_count
+    n.sha = sha
+    n.subtrees = subtrees
+    return n
+
+
+def testRoundTrip():
+    root = node(7, "1" * 40,
+                a = node(-1, b = node(2, "2" * 40)),
+                c = node(1, "3" * 40),
+                bb = node(-1),
+                **{ "a-b": node(1, "4" * 40) })
+    data = cacheTreeSerialize(root)
+    # Shortest names first, and no SHA for invalid directories
+    assert data == (b"\x007 4\n" + b"\x11" * 20 +
+                    b"a\x00-1 1\n" + b"b\x002 0\n" + b"\x22" * 20 +
+                    b"c\x001 0\n" + b"\x33" * 20 +
+                    b"bb\x00-1 0\n" +
+                    b"a-b\x001 0\n" + b"\x44" * 20)
+    assert cacheTreeSerialize(cacheTreeParse(data)) == data
+    parsed = cacheTreeParse(data)
+    assert not parsed.subtrees["a"].valid() and parsed.subtrees["a"].sha is None
+    assert cacheTreeFind(parsed, "a/b").sha == "2" * 40
+
+
+def testInvalidate():
+    root = cacheTreeParse(cacheTreeSerialize(node(
+        4, "1" * 40, a = node(3, "2" * 40, b = node(2, "3" * 40), x = node(1, "4" * 40)),
+        c = node(1, "5" * 40))))
+    cacheTreeInvalidate(root, "a/b/new")
+    assert [ p for p in ("", "a", "a/b", "a/x", "c") if not cacheTreeFind(root, p).valid() ] == [
+        "", "a", "a/b" ]
+    # A new directory: what's above it, up to where the cache stops
+    cacheTreeInvalidate(root, "c/d/e/new")
+    assert not cacheTreeFind(root, "c").valid()
+    assert cacheTreeFind(root, "a/x").valid()
+
+
+def testAddInvalidates(repo):
+    root = cacheTreeRead(indexRead(repo))
+    assert all(cacheTreeFind(root, d).valid() for d in ("", "a", "a/b", "c", "bb", "a-b"))
+    filesWrite(repo.worktree, [ "a/b/two" ], "changed\n")
+    vfadd(repo, [ "a/b/two" ])
+    root = cacheTreeRead(indexRead(vfREPO(repo.worktree)))
+    assert [ d for d in ("", "a", "a/b", "c", "bb", "a-b") if not cacheTreeFind(root, d).valid() ] == [
+        "", "a", "a/b" ]
+
+
+def testCommitWritesChangedTrees(repo, monkeypatch):
+    filesWrite(repo.worktree, [ "a/b/two" ], "changed\n")
+    vfadd(repo, [ "a/b/two" ])
+
+    written = list()
+    objectWrite = vf_commit.objectWrite
+    monkeypatch.setattr(vf_commit, "objectWrite",
+                        lambda obj, repo: written.append(obj) or objectWrite(obj, repo))
+    index = indexRead(repo)
+    tree = treeFromIndex(repo, index)
+    assert sorted(len(t.items) for t in written) == [ 2, 2, 5 ] # a/b, a and the root
+
+    # The same tree as without a cache
+    index = indexRead(repo)
+    del index.extensions[b"TREE"]
+    assert treeFromIndex(repo, index) == tree
+    # And nothing to write once the cache tree is saved
+    index = indexRead(repo)
+    treeFromIndex(repo, index)
+    indexWrite(repo, index)
+    written.clear()
+    assert treeFromIndex(repo, indexRead(repo)) == tree
+    assert written == []
+
+
+def testStatusSkipsUnchangedDirs(repo, monkeypatch):
+    filesWrite(repo.worktree, [ "a/b/two" ], "changed\n")
+    filesWrite(repo.worktree, [ "c/new" ])
+    vfadd(repo, [ "a/b/two", "c/new" ])
+
+    read = list()
+    objectRead = vf_status.objectRead
+    monkeypatch.setattr(vf_status, "objectRead",
+                        lambda repo, sha: read.append(sha) or objectRead(repo, sha))
+    status = statusCompute(vfREPO(repo.worktree))
+    assert status.staged == [ ("modified", "a/b/two"), ("added", "c/new") ]
+    # bb and a-b are skipped, their trees not even read
+    skipped = [ leaf.sha for leaf in vfobject.objectRead(vfREPO(repo.worktree), repo.tree).items
+                if leaf.path in ("bb", "a-b") ]
+    assert len(skipped) == 2
+    assert not set(skipped) & set(read)
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason = "needs git")
+def testGitTree(tmp_path):
+    # Same trees, and the same extension, as git write-tree
+    path = tmp_path / "repo"
+    filesWrite(str(path), FILES + [ "link-1" ])
+    # Sorted as a file, before link-1, not as a directory
+    os.symlink("top", path / "link")
+    git = lambda *args: subprocess.run([ "git", "-C", str(path) ] + list(args), check = True,
+                                       env = dict(os.environ, GIT_CONFIG_NOSYSTEM = "1", HOME = str(tmp_path)),
+                                       stdout = subprocess.PIPE).stdout
+    git("init", "-q")
+    git("config", "index.version", "2")
+    git("add", ".")
+    sha = git("write-tree").decode().strip()
+    shutil.copytree(path / ".git", path / ".ver_flow")
+
+    repo = vfREPO(str(path))
+    index = indexRead(repo)
+    data = index.extensions.pop(b"TREE")
+    assert cacheTreeSerialize(cacheTreeParse(data)) == data
+    assert treeFromIndex(repo, index) == sha
+    assert index.extensions[b"TREE"] == data
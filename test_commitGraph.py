@@ -0,0 +1,131 @@
+# test_commitGraph.py
+# The commit-graph gives the same commits as the object store, and the
+# generation numbers it's for.
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from object import GitBlob, GitCommit, objectWrite, objectReadRaw
+from verFlowRepository import repoCreate, vfREPO
+from vfRefs import refWrite
+from vf_commitGraph import (commitGraphWrite, commitGraphLoad, commitGraphPath, commitLookup,
+                            commitParse, GENERATION_INFINITY)
+
+# The empty tree
+TREE = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+
+
+def commitWrite(repo, parents, date, message):
+    commit = GitCommit()
+    commit.kvlm[b"tree"] = TREE.encode("ascii")
+    if parents:
+        commit.kvlm[b"parent"] = [ p.encode("ascii") for p in parents ]
+    person = "A <a@b> {0} +0000".format(date).encode("utf8")
+    commit.kvlm[b"author"] = person
+    commit.kvlm[b"committer"] = person
+    commit.kvlm[None] = message.encode("utf8")
+    return objectWrite(commit, repo)
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """A small history: a line, a side branch merged back, an octopus
+    merge, and a commit dated after 2106, which needs the 34 bits of
+    the date.  HEAD is at its tip.  repo.generations has the generation
+    of each commit."""
+    repo = repoCreate(str(tmp_path / "repo"))
+    date = 1700000000
+    gen = dict()
+
+    def commit(parents, message):
+        nonlocal date
+        date += 60
+        sha = commitWrite(repo, parents, date, message)
+        gen[sha] = 1 + max([ gen[p] for p in parents ], default = 0)
+        return sha
+
+    root = commit([], "root")
+    line = [ root ]
+    for i in range(5):
+        line.append(commit([ line[-1] ], "line {0}".format(i)))
+    side = commit([ line[1] ], "side")
+    merge = commit([ line[-1], side ], "merge")
+    others = [ commit([ root ], "other {0}".format(i)) for i in range(2) ]
+    octopus = commit([ merge ] + others, "octopus")
+    future = commitWrite(repo, [ octopus ], 5000000000, "future")
+    gen[future] = gen[octopus] + 1
+
+    refWrite(repo, "HEAD", future)
+    repo.generations = gen
+    repo.tip = future
+    return repo
+
+
+def parsed(repo, sha):
+    return commitParse(sha, objectReadRaw(repo, sha)[1])
+
+
+def assertSame(one, two):
+    assert (one.sha, one.tree, one.parents, one.date) == (two.sha, two.tree, two.parents, two.date)
+
+
+def testLookupMatchesParse(repo):
+    assert commitGraphWrite(repo) == len(repo.generations)
+    fresh = vfREPO(repo.worktree)
+    graph = commitGraphLoad(fresh)
+    assert graph is not None
+    for sha, generation in repo.generations.items():
+        assert graph.find(sha) is not None
+        info = commitLookup(fresh, sha)
+        assertSame(info, parsed(fresh, sha))
+        assert info.generation == generation
+    assert commitLookup(fresh, repo.tip).date == 5000000000
+    # The octopus merge, through the EDGE chunk
+    assert [ len(commitLookup(fresh, sha).parents) for sha in repo.generations ].count(3) == 1
+
+
+def testCommitsAfterTheGraph(repo):
+    commitGraphWrite(repo)
+    # Made after: read from the object store, without a generation
+    later = commitWrite(repo, [ repo.tip ], 5000000060, "later")
+    fresh = vfREPO(repo.worktree)
+    info = commitLookup(fresh, later)
+    assertSame(info, parsed(fresh, later))
+    assert info.generation == GENERATION_INFINITY
+    assert commitLookup(fresh, repo.tip).generation == repo.generations[repo.tip]
+
+
+def testNotACommit(repo):
+    commitGraphWrite(repo)
+    blob = GitBlob()
+    blob.blobdata = b"data\n"
+    sha = objectWrite(blob, repo)
+    with pytest.raises(Exception, match = "Not a commit"):
+        commitLookup(vfREPO(repo.worktree), sha)
+    with pytest.raises(Exception, match = "Missing object"):
+        commitLookup(vfREPO(repo.worktree), "0" * 40)
+
+
+def git(repo, *args):
+    return subprocess.run([ "git", "--git-dir", repo.gitdir ] + list(args), check = True,
+                          env = dict(os.environ, GIT_CONFIG_NOSYSTEM = "1", HOME = repo.worktree),
+                          stdout = subprocess.PIPE, stderr = subprocess.PIPE).stdout
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason = "needs git")
+def testGitCompatible(repo):
+    # Ours passes git's checks
+    commitGraphWrite(repo)
+    git(repo, "commit-graph", "verify")
+
+    # And git's gives the same commits and generations
+    os.unlink(commitGraphPath(repo))
+    git(repo, "-c", "commitGraph.generationVersion=1", "commit-graph", "write", "--reachable")
+    fresh = vfREPO(repo.worktree)
+    assert commitGraphLoad(fresh) is not None
+    for sha, generation in repo.generations.items():
+        info = commitLookup(fresh, sha)
+        assertSame(info, parsed(fresh, sha))
+        assert info.generation == generation
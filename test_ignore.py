@@ -0,0 +1,145 @@
+# test_ignore.py
+# Ignore patterns, with git's semantics.  Every expected answer below is
+# what git check-ignore says for the same rules and path.
+import argparse
+import io
+import os
+
+import pytest
+
+import commandBridge
+from verFlowRepository import repoCreate
+from vf_ignore import vfIgnore, vfIgnoreRules, vfignoreParse
+from vf_walk import pathIgnored
+
+# (lines of the ignore file, path, is it a directory, result of the
+# last matching rule: True excluded, False included back, None if none)
+PATTERNS = [
+    # No slash: matches the name at any depth
+    (["*.o"], "a.o", False, True),
+    (["*.o"], "d/e/a.o", False, True),
+    (["*.o"], "a.oo", False, None),
+    (["*.o"], ".o", False, True),
+    (["*.o"], "a.o", True, True),
+    (["build"], "build", False, True),
+    (["build"], "src/build", True, True),
+    (["build"], "build.c", False, None),
+    (["build"], "rebuild", False, None),
+    # Trailing slash: directories only
+    (["build/"], "build", True, True),
+    (["build/"], "build", False, None),
+    (["build/"], "src/build", True, True),
+    (["foo/"], "x/foo", True, True),
+    # Any other slash anchors the pattern
+    (["/root.txt"], "root.txt", False, True),
+    (["/root.txt"], "d/root.txt", False, None),
+    (["doc/*.txt"], "doc/a.txt", False, True),
+    (["doc/*.txt"], "doc/x/a.txt", False, None),
+    (["doc/*.txt"], "x/doc/a.txt", False, None),
+    (["foo/bar"], "foo/bar", False, True),
+    (["foo/bar"], "x/foo/bar", False, None),
+    (["foo/*"], "foo/bar", False, True),
+    # **
+    (["**/logs"], "logs", True, True),
+    (["**/logs"], "a/b/logs", True, True),
+    (["**/logs"], "a/b/logs", False, True),
+    (["**/logs/debug.log"], "logs/debug.log", False, True),
+    (["**/logs/debug.log"], "a/logs/debug.log", False, True),
+    (["**/logs/debug.log"], "a/logs/x/debug.log", False, None),
+    (["logs/**"], "logs/a", False, True),
+    (["logs/**"], "logs/a/b", False, True),
+    (["logs/**"], "logs", True, None),
+    (["a/**/b"], "a/b", False, True),
+    (["a/**/b"], "a/x/b", False, True),
+    (["a/**/b"], "a/x/y/b", False, True),
+    (["a/**/b"], "a/xb", False, None),
+    (["a/**/b"], "x/a/b", False, None),
+    (["a**b"], "axyb", False, True),
+    (["a**b"], "d/axyb", False, True),
+    # ? and classes, which don't match /
+    (["?.c"], "a.c", False, True),
+    (["?.c"], "ab.c", False, None),
+    (["d?c"], "d/c", False, None),
+    (["[abc].c"], "b.c", False, True),
+    (["[abc].c"], "d.c", False, None),
+    (["[!abc].c"], "d.c", False, True),
+    (["[!abc].c"], "a.c", False, None),
+    (["[a-c]x"], "bx", False, True),
+    (["[a-c]x"], "dx", False, None),
+    (["x[0-9][0-9]"], "x42", False, True),
+    (["x[0-9][0-9]"], "x4a", False, None),
+    # Comments, blank lines and escapes
+    (["#comment"], "#comment", False, None),
+    (["\\#notcomment"], "#notcomment", False, True),
+    (["\\!bang"], "!bang", False, True),
+    (["a\\*b"], "a*b", False, True),
+    (["a\\*b"], "axb", False, None),
+    (["a\\?"], "a?", False, True),
+    (["a\\?"], "ab", False, None),
+    (["", "   ", "*.tmp"], "x.tmp", False, True),
+    # The last matching rule wins
+    (["*.log", "!keep.log"], "a.log", False, True),
+    (["*.log", "!keep.log"], "keep.log", False, False),
+    (["!keep.log", "*.log"], "keep.log", False, True),
+    (["*.log", "!keep.log", "keep*"], "keep.log", False, True),
+    (["*", "!*.c"], "a.c", False, False),
+    (["*", "!*.c"], "a.h", False, True),
+    (["*", "!*/"], "d", True, False),
+    (["*", "!*/"], "d", False, True),
+]
+
+
+@pytest.mark.parametrize("lines, path, is_dir, expected", PATTERNS)
+def testPattern(lines, path, is_dir, expected):
+    assert vfIgnoreRules(vfignoreParse(lines)).match(path, is_dir) is expected
+
+
+# .vfignore files by directory, and info/exclude
+SCOPED = { "": [ "*.log", "/top", "foo/*", "build/", "!build/keep" ],
+           "sub": [ "!keep.log", "/x", "deep/*.tmp" ] }
+EXCLUDE = [ "*.bak", "!*.log" ]
+
+SCOPED_PATHS = [
+    ("a.log", False, True),
+    ("sub/a.log", False, True),
+    # The closest .vfignore wins
+    ("sub/keep.log", False, False),
+    # Anchored to the directory of their .vfignore
+    ("top", False, True),
+    ("sub/top", False, False),
+    ("sub/x", False, True),
+    ("x", False, False),
+    ("sub/y/x", False, False),
+    ("sub/deep/a.tmp", False, True),
+    ("deep/a.tmp", False, False),
+    ("sub/y/deep/a.tmp", False, False),
+    # info/exclude comes after every .vfignore
+    ("a.bak", False, True),
+    ("sub/a.bak", False, True),
+    # In an ignored directory: ignored, whatever its own rules say
+    ("foo/bar/baz", False, True),
+    ("build/keep", False, True),
+    ("build", True, True),
+    ("src/a.c", False, False),
+]
+
+
+@pytest.mark.parametrize("path, is_dir, expected", SCOPED_PATHS)
+def testScoped(path, is_dir, expected):
+    ignore = vfIgnore(absolute = [ vfIgnoreRules(vfignoreParse(EXCLUDE)) ],
+                      scoped = dict((d, vfIgnoreRules(vfignoreParse(lines)))
+                                    for d, lines in SCOPED.items()))
+    assert pathIgnored(ignore, path, is_dir) is expected
+
+
+def testCheckIgnoreStdin(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "config"))
+    repo = repoCreate(str(tmp_path / "repo"))
+    os.makedirs(os.path.join(repo.gitdir, "info"), exist_ok = True)
+    with open(os.path.join(repo.gitdir, "info", "exclude"), "w") as f:
+        f.write("*.o\nbuild/\n!keep.o\n")
+    os.makedirs(os.path.join(repo.worktree, "out"))
+    monkeypatch.chdir(repo.worktree)
+    monkeypatch.setattr("sys.stdin", io.StringIO("b.o\nkeep.o\nbuild\nbuild/\nbuild/x\nout\nsrc/c.c\n"))
+    commandBridge.cmd_check_ignore(argparse.Namespace(path = [ "a.o" ], stdin = True))
+    assert capsys.readouterr().out == "a.o\nb.o\nbuild/\nbuild/x\n"
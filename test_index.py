@@ -0,0 +1,182 @@
+# test_index.py
+# The index file: what's read is written back byte for byte, extensions
+# included, a damaged file is refused, and index.lock is taken
+# exclusively.
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from verFlowRepository import repoCreate, vfREPO
+from vf_indexFile import vfIndex, vfIndexEntry, indexRead, indexWrite
+
+
+def entry(name, i, mode_type = 0b1000, mode_perms = 0o644, stage = 0, assume_valid = False):
+    return vfIndexEntry(ctime = (1700000000 + i, 123456789), mtime = (1700000100 + i, 987654321),
+                        dev = 2049, ino = 1000 + i, mode_type = mode_type, mode_perms = mode_perms,
+                        uid = 1000, gid = 100, fsize = 10 * i, sha = "{0:040x}".format(0xabc + i),
+                        flag_assume_valid = assume_valid, flag_stage = stage, name = name)
+
+
+@pytest.fixture
+def repo(tmp_path):
+    return repoCreate(str(tmp_path / "repo"))
+
+
+def indexBytes(repo):
+    with open(os.path.join(repo.gitdir, "index"), "rb") as f:
+        return f.read()
+
+
+def sampleIndex():
+    """Entries with names of every padding length, a long name, a
+    symlink, an executable, a gitlink and an assume-valid one."""
+    entries = [ entry("f" * n, n) for n in range(1, 17) ]
+    entries.append(entry("d/" + "x" * 5000, 20))
+    entries.append(entry("link", 21, mode_type = 0b1010, mode_perms = 0))
+    entries.append(entry("run.sh", 22, mode_perms = 0o755))
+    entries.append(entry("sub", 23, mode_type = 0b1110, mode_perms = 0))
+    entries.append(entry("valid", 24, assume_valid = True))
+    entries.sort(key = lambda e: e.name)
+    return vfIndex(entries = entries)
+
+
+def testRoundTrip(repo):
+    index = sampleIndex()
+    index.extensions[b"TREE"] = b"\x00-1 0\n"
+    indexWrite(repo, index)
+    written = indexBytes(repo)
+
+    # Straight from the columns, without materializing the entries
+    index = indexRead(vfREPO(repo.worktree))
+    assert index._entries is None
+    indexWrite(repo, index)
+    assert indexBytes(repo) == written
+
+    # From the entries
+    index = indexRead(vfREPO(repo.worktree))
+    expected = sampleIndex().entries
+    assert [ e.name for e in index.entries ] == [ e.name for e in expected ]
+    for got, want in zip(index.entries, expected):
+        for field in vfIndexEntry.__slots__:
+            assert getattr(got, field) == getattr(want, field), (got.name, field)
+    indexWrite(repo, index)
+    assert indexBytes(repo) == written
+
+
+def testUnknownExtensions(repo):
+    index = sampleIndex()
+    index.extensions[b"ZZZZ"] = b"some data \x00\xff"
+    index.extensions[b"TREE"] = b"\x00-1 0\n"
+    index.extensions[b"link"] = b""
+    indexWrite(repo, index)
+
+    index = indexRead(vfREPO(repo.worktree))
+    assert list(index.extensions.items()) == [
+        (b"ZZZZ", b"some data \x00\xff"), (b"TREE", b"\x00-1 0\n"), (b"link", b"") ]
+    # Still there, in the same order, when entries change
+    index.entries = index.entries[1:]
+    indexWrite(repo, index)
+    assert list(indexRead(vfREPO(repo.worktree)).extensions) == [ b"ZZZZ", b"TREE", b"link" ]
+
+
+def testOldIndexWithoutChecksum(repo):
+    # As written by older versions of verFlow: entries only
+    indexWrite(repo, sampleIndex())
+    raw = indexBytes(repo)
+    with open(os.path.join(repo.gitdir, "index"), "wb") as f:
+        f.write(raw[:-20])
+    assert len(indexRead(vfREPO(repo.worktree))) == len(sampleIndex())
+
+
+@pytest.mark.parametrize("damage, error", [
+    (lambda raw: raw[:-1] + bytes([ raw[-1] ^ 1 ]), "bad checksum"),
+    (lambda raw: raw[:-30] + bytes([ raw[-30] ^ 1 ]) + raw[-29:], "bad checksum"),
+    (lambda raw: raw[:-8], "bad checksum"),
+    (lambda raw: raw + b"x", "bad checksum"),
+    # Less than a checksum after the entries
+    (lambda raw: raw[:-(8 + 7 + 10)], "truncated"),
+    # In the middle of an entry, or of its name
+    (lambda raw: raw[:100], "truncated"),
+    (lambda raw: raw[:12 + 62 + 1], "truncated"),
+    (lambda raw: raw[:-(20 + 8 + 7 + 4000)], "truncated"),
+])
+def testDamaged(repo, damage, error):
+    index = sampleIndex()
+    index.extensions[b"TREE"] = b"\x00-1 0\n"
+    indexWrite(repo, index)
+    raw = indexBytes(repo)
+    with open(os.path.join(repo.gitdir, "index"), "wb") as f:
+        f.write(damage(raw))
+    with pytest.raises(Exception, match = error):
+        indexRead(vfREPO(repo.worktree))
+
+
+def testLockHeld(repo):
+    indexWrite(repo, sampleIndex())
+    before = indexBytes(repo)
+    lock = os.path.join(repo.gitdir, "index.lock")
+    with open(lock, "w") as f:
+        f.write("theirs")
+
+    index = indexRead(vfREPO(repo.worktree))
+    index.entries = index.entries[1:]
+    with pytest.raises(Exception, match = "Unable to create"):
+        indexWrite(repo, index)
+    assert indexWrite(repo, index, if_able = True) is False
+    # Neither the index nor their lock changed
+    assert indexBytes(repo) == before
+    with open(lock) as f:
+        assert f.read() == "theirs"
+
+    os.unlink(lock)
+    assert indexWrite(repo, index) is True
+    assert not os.path.exists(lock)
+    assert len(indexRead(vfREPO(repo.worktree))) == len(sampleIndex()) - 1
+
+
+def testIfAbleStale(repo):
+    indexWrite(repo, sampleIndex())
+    # Read, then someone else writes it
+    index = indexRead(vfREPO(repo.worktree))
+    other = indexRead(vfREPO(repo.worktree))
+    other.entries = other.entries[:3]
+    indexWrite(repo, other)
+    written = indexBytes(repo)
+
+    index.extensions[b"TREE"] = b"\x00-1 0\n"
+    assert indexWrite(repo, index, if_able = True) is False
+    assert indexBytes(repo) == written
+    assert not os.path.exists(os.path.join(repo.gitdir, "index.lock"))
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason = "needs git")
+def testGitIndex(tmp_path):
+    # An index written by git, with its own extensions, is read and
+    # written back unchanged
+    path = tmp_path / "repo"
+    os.makedirs(path / "a" / "b")
+    for name in ("top", "a/one", "a/b/two"):
+        (path / name).write_text(name + "\n")
+    env = dict(os.environ, GIT_CONFIG_NOSYSTEM = "1", HOME = str(tmp_path))
+    git = lambda *args: subprocess.run([ "git", "-C", str(path) ] + list(args), env = env,
+                                       check = True, stdout = subprocess.PIPE).stdout
+    git("init", "-q")
+    git("config", "index.version", "2")
+    git("add", ".")
+    git("write-tree")
+    git("update-index", "--untracked-cache")
+    git("status", "--porcelain")
+    shutil.copytree(path / ".git", path / ".ver_flow")
+
+    repo = vfREPO(str(path))
+    raw = indexBytes(repo)
+    index = indexRead(repo)
+    assert index.names() == [ "a/b/two", "a/one", "top" ]
+    assert b"TREE" in index.extensions and b"UNTR" in index.extensions
+    indexWrite(repo, index)
+    assert indexBytes(repo) == raw
+    index.entries
+    indexWrite(repo, index)
+    assert indexBytes(repo) == raw
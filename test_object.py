@@ -0,0 +1,58 @@
+# test_object.py
+# Range reads of objects, loose, packed as deltas, and cached.
+import pytest
+
+from object import GitBlob, objectWrite, objectReadRaw, objectReadRange
+from verFlowRepository import repoCreate, vfREPO
+from vf_pack import packsLoad, PACK_TYPE_TO_FMT
+from vf_repack import repack
+
+
+def blobWrite(repo, data):
+    blob = GitBlob()
+    blob.blobdata = data
+    return objectWrite(blob, repo)
+
+
+def packedRepo(tmp_path):
+    """A repository with two similar blobs packed, the second one most
+    likely as a delta of the first.  Returns (path, base, delta, data of
+    delta)."""
+    repo = repoCreate(str(tmp_path / "repo"))
+    lines = [ "line {0}\n".format(i).encode() for i in range(2000) ]
+    base = blobWrite(repo, b"".join(lines))
+    lines[1000] = b"changed\n"
+    data = b"".join(lines)
+    delta = blobWrite(repo, data)
+    repack(repo, prune = True)
+    return repo.worktree, base, delta, data
+
+
+def testRangeDeltaPacked(tmp_path):
+    path, base, delta, data = packedRepo(tmp_path)
+    repo = vfREPO(path)
+    deltified = [ sha for sha in (base, delta)
+                  for pack in packsLoad(repo)
+                  if pack.find(sha) is not None
+                  and not pack.entryHeader(pack.find(sha))[0] in PACK_TYPE_TO_FMT ]
+    assert deltified
+
+    sha = deltified[0]
+    expected = data if sha == delta else objectReadRaw(vfREPO(path), base)[1]
+    assert objectReadRange(repo, sha, 100, 50) == expected[100:150]
+    assert objectReadRange(repo, sha, len(expected) - 10, 50) == expected[-10:]
+
+
+def testRangeCached(tmp_path):
+    path, base, delta, data = packedRepo(tmp_path)
+    repo = vfREPO(path)
+    assert objectReadRaw(repo, delta)[1] == data
+    # Now served from the object cache
+    assert objectReadRange(repo, delta, 0, 10) == data[:10]
+    assert objectReadRange(repo, delta, 5000, 100) == data[5000:5100]
+
+
+def testRangeMissing(tmp_path):
+    path, base, delta, data = packedRepo(tmp_path)
+    with pytest.raises(Exception, match = "Missing object"):
+        objectReadRange(vfREPO(path), "0" * 40, 0, 10)
@@ -0,0 +1,313 @@
+# test_refs.py
+# Ref transactions: what's left in packed-refs and loose files after
+# commits that succeed, and after those that fail.
+import argparse
+import io
+import os
+import sys
+
+import pytest
+
+import commandBridge
+from object import GitBlob, objectWrite
+from verFlowRepository import repoCreate, vfREPO
+from vfRefs import vfRefTransaction, refNameCheck, refResolver, refWrite, packRefs
+from vfRefs import PACKED_REFS_HEADER, REF_ZERO
+
+
+def blobWrite(repo, data):
+    blob = GitBlob()
+    blob.blobdata = data
+    return objectWrite(blob, repo)
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """A new repository, and three objects refs can point to."""
+    repo = repoCreate(str(tmp_path / "repo"))
+    repo.shas = [ blobWrite(repo, "object {0}\n".format(i).encode()) for i in range(3) ]
+    return repo
+
+
+def gitdir(repo, *path):
+    return os.path.join(repo.gitdir, *path)
+
+
+def loose(repo, name):
+    """The content of loose ref name, or None."""
+    try:
+        with open(gitdir(repo, name)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def packed(repo):
+    """The content of packed-refs, or None."""
+    try:
+        with open(gitdir(repo, "packed-refs"), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def locks(repo):
+    """Lock files left anywhere in the repository."""
+    return [ os.path.join(root, f) for root, _, files in os.walk(repo.gitdir)
+             for f in files if f.endswith(".lock") ]
+
+
+def resolve(repo, name):
+    # A new repository object: nothing cached
+    return refResolver(vfREPO(repo.worktree), name)
+
+
+def testUpdateLoose(repo):
+    one, two, _ = repo.shas
+    refWrite(repo, "refs/heads/a", one)
+    assert loose(repo, "refs/heads/a") == one + "\n"
+    refWrite(repo, "refs/heads/a", two, old = one)
+    assert loose(repo, "refs/heads/a") == two + "\n"
+    assert packed(repo) is None
+    assert locks(repo) == []
+
+
+def testOldMismatch(repo):
+    one, two, three = repo.shas
+    refWrite(repo, "refs/heads/a", one)
+    with pytest.raises(Exception, match = "is at {0} but expected {1}".format(one, two)):
+        refWrite(repo, "refs/heads/a", three, old = two)
+    assert loose(repo, "refs/heads/a") == one + "\n"
+    assert locks(repo) == []
+
+
+def testCreateExisting(repo):
+    one, two, _ = repo.shas
+    refWrite(repo, "refs/heads/a", one)
+    transaction = vfRefTransaction(repo)
+    transaction.create("refs/heads/a", two)
+    with pytest.raises(Exception, match = "expected " + REF_ZERO):
+        transaction.commit()
+    assert resolve(repo, "refs/heads/a") == one
+
+
+def testLockConflict(repo):
+    one, two, _ = repo.shas
+    refWrite(repo, "refs/heads/a", one)
+    # Someone else is updating it
+    with open(gitdir(repo, "refs", "heads", "a.lock"), "w") as f:
+        f.write("theirs\n")
+    transaction = vfRefTransaction(repo)
+    transaction.update("refs/heads/a", two)
+    transaction.update("refs/heads/b", two)
+    with pytest.raises(Exception, match = "Unable to create"):
+        transaction.commit()
+    assert loose(repo, "refs/heads/a") == one + "\n"
+    assert loose(repo, "refs/heads/b") is None
+    assert packed(repo) is None
+    # Their lock is left alone, ours are gone
+    assert locks(repo) == [ gitdir(repo, "refs", "heads", "a.lock") ]
+    with open(gitdir(repo, "refs", "heads", "a.lock")) as f:
+        assert f.read() == "theirs\n"
+
+
+def testMultiPacked(repo):
+    one, two, three = repo.shas
+    refWrite(repo, "refs/heads/old", three)
+    transaction = vfRefTransaction(repo)
+    transaction.create("refs/tags/v1", one)
+    transaction.create("refs/heads/b", two)
+    transaction.update("refs/heads/old", one, old = three)
+    transaction.commit()
+
+    assert packed(repo) == PACKED_REFS_HEADER + "".join(
+        "{0} {1}\n".format(sha, name) for name, sha in sorted(
+            [ ("refs/tags/v1", one), ("refs/heads/b", two), ("refs/heads/old", one) ])).encode()
+    # The loose file of the one that was loose is gone: it'd hide the
+    # packed value
+    for name in ("refs/tags/v1", "refs/heads/b", "refs/heads/old"):
+        assert loose(repo, name) is None
+    assert not os.path.exists(gitdir(repo, "refs", "tags", "v1"))
+    assert resolve(repo, "refs/heads/old") == one
+    assert locks(repo) == []
+
+
+def testMultiFailedChangesNothing(repo):
+    one, two, three = repo.shas
+    refWrite(repo, "refs/heads/a", one)
+    refWrite(repo, "refs/heads/p", one)
+    packRefs(repo, all = True)
+    before = packed(repo)
+    refWrite(repo, "refs/heads/a", two)
+
+    transaction = vfRefTransaction(repo)
+    transaction.update("refs/heads/a", three, old = two)
+    transaction.update("refs/heads/p", three, old = two)
+    transaction.delete("refs/heads/c")
+    with pytest.raises(Exception, match = "refs/heads/p"):
+        transaction.commit()
+    assert packed(repo) == before
+    assert loose(repo, "refs/heads/a") == two + "\n"
+    assert resolve(repo, "refs/heads/p") == one
+    assert locks(repo) == []
+
+
+def testDeletePacked(repo):
+    one, two, _ = repo.shas
+    refWrite(repo, "refs/heads/a", one)
+    refWrite(repo, "refs/heads/b", two)
+    packRefs(repo, all = True)
+    assert loose(repo, "refs/heads/a") is None
+
+    transaction = vfRefTransaction(repo)
+    transaction.delete("refs/heads/a", old = two)
+    with pytest.raises(Exception, match = "expected " + two):
+        transaction.commit()
+    assert resolve(repo, "refs/heads/a") == one
+
+    transaction = vfRefTransaction(repo)
+    transaction.delete("refs/heads/a", old = one)
+    transaction.commit()
+    assert packed(repo) == PACKED_REFS_HEADER + "{0} refs/heads/b\n".format(two).encode()
+    assert resolve(repo, "refs/heads/a") is None
+    assert resolve(repo, "refs/heads/b") == two
+
+
+def testDeleteLooseAndPacked(repo):
+    one, two, _ = repo.shas
+    refWrite(repo, "refs/heads/a", one)
+    packRefs(repo, all = True)
+    refWrite(repo, "refs/heads/a", two)
+    transaction = vfRefTransaction(repo)
+    transaction.delete("refs/heads/a")
+    transaction.commit()
+    assert loose(repo, "refs/heads/a") is None
+    assert packed(repo) == PACKED_REFS_HEADER
+    assert resolve(repo, "refs/heads/a") is None
+
+
+def testSymbolicDeref(repo):
+    one, two, _ = repo.shas
+    # HEAD is "ref: refs/heads/master"
+    refWrite(repo, "HEAD", one, old = REF_ZERO)
+    assert loose(repo, "refs/heads/master") == one + "\n"
+    assert loose(repo, "HEAD") == "ref: refs/heads/master\n"
+
+    # Checked against what it points to
+    with pytest.raises(Exception, match = "expected " + two):
+        refWrite(repo, "HEAD", two, old = two)
+
+    transaction = vfRefTransaction(repo)
+    transaction.update("HEAD", two, old = one, deref = False)
+    transaction.commit()
+    assert loose(repo, "HEAD") == two + "\n"
+    assert loose(repo, "refs/heads/master") == one + "\n"
+
+
+def testSymbolicTargetChecked(repo):
+    one = repo.shas[0]
+    with open(gitdir(repo, "HEAD"), "w") as f:
+        f.write("ref: refs/../config\n")
+    with pytest.raises(Exception, match = "bad name"):
+        refWrite(repo, "HEAD", one)
+    assert locks(repo) == []
+
+
+@pytest.mark.parametrize("name, valid", [
+    ("HEAD", True),
+    ("refs/heads/master", True),
+    ("refs/heads/feature/x-1.2", True),
+    ("refs/tags/v1.0", True),
+    ("refs/heads/@", True),
+    ("refs/heads/été", True),
+    ("refs/x", True),
+    ("config", False),
+    ("refs", False),
+    ("refs/../config", False),
+    ("refs/heads/a..b", False),
+    ("refs/heads/x.lock", False),
+    ("refs/heads/x.lock/y", False),
+    ("refs//x", False),
+    ("refs/heads/", False),
+    ("refs/heads/.hidden", False),
+    ("refs/heads/a.", False),
+    ("refs/heads/a b", False),
+    ("refs/heads/a\x01", False),
+    ("refs/heads/a\x7f", False),
+    ("refs/heads/a@{1}", False),
+    ("refs/heads/a~1", False),
+    ("refs/heads/a^", False),
+    ("refs/heads/a:b", False),
+    ("refs/heads/a?", False),
+    ("refs/heads/a*", False),
+    ("refs/heads/a[", False),
+    ("refs/heads/a\\b", False),
+])
+def testRefNameCheck(name, valid):
+    if valid:
+        refNameCheck(name)
+    else:
+        with pytest.raises(Exception, match = "bad name"):
+            refNameCheck(name)
+
+
+def testBadNameNothingLocked(repo):
+    transaction = vfRefTransaction(repo)
+    with pytest.raises(Exception, match = "bad name"):
+        transaction.update("refs/../config", repo.shas[0])
+    assert transaction.updates == dict()
+    assert locks(repo) == []
+
+
+def updateRefStdin(monkeypatch, repo, data, z = False):
+    """Run update-ref --stdin in repo, with data as input."""
+    monkeypatch.chdir(repo.worktree)
+    monkeypatch.setattr(sys, "stdin", argparse.Namespace(buffer = io.BytesIO(data)))
+    commandBridge.cmd_update_ref(argparse.Namespace(
+        stdin = True, z = z, no_deref = False, delete = False, args = []))
+
+
+def testStdinBatch(monkeypatch, repo):
+    one, two, three = repo.shas
+    refWrite(repo, "refs/heads/a", one)
+    refWrite(repo, "refs/heads/v", one)
+    updateRefStdin(monkeypatch, repo, "\n".join([
+        "update refs/heads/a {0} {1}".format(two, one),
+        "create refs/heads/b {0}".format(three),
+        "verify refs/heads/v {0}".format(one),
+        "" ]).encode())
+    assert packed(repo) == PACKED_REFS_HEADER + "{0} refs/heads/a\n{1} refs/heads/b\n".format(
+        two, three).encode()
+    assert loose(repo, "refs/heads/a") is None
+    # Only verified: left as it was
+    assert loose(repo, "refs/heads/v") == one + "\n"
+
+
+def testStdinAllOrNothing(monkeypatch, repo):
+    one, two, _ = repo.shas
+    refWrite(repo, "refs/heads/a", one)
+    with pytest.raises(Exception, match = "bad name"):
+        updateRefStdin(monkeypatch, repo, "create refs/heads/ok {0}\ncreate refs/heads/a..b {0}\n".format(
+            two).encode())
+    with pytest.raises(Exception, match = "expected"):
+        updateRefStdin(monkeypatch, repo, "create refs/heads/ok {0}\nupdate refs/heads/a {0} {0}\n".format(
+            two).encode())
+    assert loose(repo, "refs/heads/ok") is None
+    assert loose(repo, "refs/heads/a") == one + "\n"
+    assert packed(repo) is None
+    assert locks(repo) == []
+
+
+def testStdinNul(monkeypatch, repo):
+    one, two, _ = repo.shas
+    refWrite(repo, "refs/heads/a", one)
+    updateRefStdin(monkeypatch, repo, "update refs/heads/a\0{0}\0{1}\0".format(two, one).encode(), z = True)
+    assert resolve(repo, "refs/heads/a") == two
+    # An empty old value isn't checked; an empty new one is an error
+    updateRefStdin(monkeypatch, repo, "update refs/heads/a\0{0}\0\0".format(one).encode(), z = True)
+    assert resolve(repo, "refs/heads/a") == one
+    for data in (b"update refs/heads/a\0\0\0", b"create refs/heads/c\0\0"):
+        with pytest.raises(Exception, match = "missing <new-oid>"):
+            updateRefStdin(monkeypatch, repo, data, z = True)
+    assert resolve(repo, "refs/heads/a") == one
+    assert loose(repo, "refs/heads/c") is None
@@ -0,0 +1,142 @@
+# test_renames.py
+# Rename and copy detection: files paired by content, exactly or by
+# similarity, and how -M and -C tell renames from copies.
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import libVerFlow
+from object import GitBlob, GitTree, objectWrite
+from verFlowRepository import repoCreate, vfREPO
+from verFlowTree import GitTreeLeaf
+from vf_renames import diffRenames, renameThresholdParse
+from vf_treeDiff import treeDiff
+
+
+@pytest.fixture
+def repo(tmp_path):
+    return repoCreate(str(tmp_path / "repo"))
+
+
+def treeWrite(repo, spec):
+    """Write the tree described by spec: name -> content (a file),
+    (mode, content) for other modes or a dict for a subtree.  Returns
+    its SHA."""
+    tree = GitTree()
+    for name, value in spec.items():
+        if isinstance(value, dict):
+            mode, sha = b"040000", treeWrite(repo, value)
+        else:
+            mode, content = (b"100644", value) if isinstance(value, str) else value
+            blob = GitBlob()
+            blob.blobdata = content.encode("utf8")
+            sha = objectWrite(blob, repo)
+        tree.items.append(GitTreeLeaf(mode, name, sha))
+    return objectWrite(tree, repo)
+
+
+def lines(count, changed = ()):
+    """A file of count lines, those in changed different."""
+    return "".join("line {0}{1} of some file\n".format(i, " (changed)" if i in changed else "")
+                   for i in range(count))
+
+
+TEXT = lines(20)
+OTHER = "".join("something else entirely, {0}\n".format(i) for i in range(20))
+
+# (old tree, new tree, copies, threshold, changes)
+CASES = [
+    # Same content
+    ({ "a": TEXT }, { "b": TEXT }, False, 50, [ "R100\ta\tb" ]),
+    ({ "d": { "a": TEXT } }, { "e": { "f": { "a": TEXT } } }, False, 50, [ "R100\td/a\te/f/a" ]),
+    # Of two identical files, the one with the same name
+    ({ "x": { "f": TEXT }, "y": { "g": TEXT } }, { "z": { "g": TEXT } }, False, 50,
+     [ "D\tx/f", "R100\ty/g\tz/g" ]),
+    # Similar: 2 lines of 20 changed
+    ({ "a": TEXT }, { "b": lines(20, (3, 9)) }, False, 50, [ "R086\ta\tb" ]),
+    ({ "a": TEXT }, { "b": lines(20, (3, 9)) }, False, 90, [ "D\ta", "A\tb" ]),
+    # Not similar enough
+    ({ "a": TEXT }, { "b": lines(20, range(12)) }, False, 50, [ "D\ta", "A\tb" ]),
+    ({ "a": TEXT }, { "b": OTHER }, False, 0, [ "D\ta", "A\tb" ]),
+    # The best match
+    ({ "a": TEXT, "b": lines(20, (1, 2, 3)) }, { "c": lines(20, (1, 2)) }, False, 50,
+     [ "D\ta", "R093\tb\tc" ]),
+    # Files and symlinks aren't renames of each other
+    ({ "a": TEXT }, { "l": (b"120000", TEXT) }, False, 50, [ "D\ta", "A\tl" ]),
+    ({ "l": (b"120000", "a") }, { "m": (b"120000", "a") }, False, 50, [ "R100\tl\tm" ]),
+    # One deleted file, two new ones: a rename, the other added
+    ({ "a": TEXT }, { "b": TEXT, "c": TEXT }, False, 50, [ "R100\ta\tb", "A\tc" ]),
+    # And with copies, a copy then a rename
+    ({ "a": TEXT }, { "b": TEXT, "c": TEXT }, True, 50, [ "C100\ta\tb", "R100\ta\tc" ]),
+    # Copies of a modified file only with copies
+    ({ "src": TEXT, "gone": OTHER },
+     { "src": lines(20, (0,)), "copy": TEXT, "moved": OTHER }, False, 50,
+     [ "A\tcopy", "R100\tgone\tmoved", "M\tsrc" ]),
+    ({ "src": TEXT, "gone": OTHER },
+     { "src": lines(20, (0,)), "copy": TEXT, "moved": OTHER }, True, 50,
+     [ "C100\tsrc\tcopy", "R100\tgone\tmoved", "M\tsrc" ]),
+    ({ "src": TEXT }, { "src": lines(20, (0,)), "copy": lines(20, (5,)) }, True, 50,
+     [ "C092\tsrc\tcopy", "M\tsrc" ]),
+]
+
+
+def renames(repo, old, new, copies, threshold, candidates = None):
+    changes = list(treeDiff(repo, treeWrite(repo, old), treeWrite(repo, new)))
+    return [ c.name() for c in diffRenames(repo, changes, copies, threshold, candidates) ]
+
+
+@pytest.mark.parametrize("old, new, copies, threshold, expected", CASES)
+def testRenames(repo, old, new, copies, threshold, expected):
+    assert renames(repo, old, new, copies, threshold) == expected
+
+
+def testCandidates(repo):
+    old = { "a": TEXT, "b": OTHER }
+    new = { "c": TEXT, "d": OTHER + "one more line\n" }
+    assert renames(repo, old, new, False, 50) == [ "R100\ta\tc", "R097\tb\td" ]
+    # Without candidates to score, only the same content
+    assert renames(repo, old, new, False, 50, candidates = 0) == [ "D\tb", "R100\ta\tc", "A\td" ]
+    # Which is also what the config says
+    repo = vfREPO(repo.worktree)
+    repo.conf.read_dict({ "diff": { "renameCandidates": "0" } })
+    assert renames(repo, old, new, False, 50) == [ "D\tb", "R100\ta\tc", "A\td" ]
+
+
+@pytest.mark.parametrize("value, threshold", [
+    ("60%", 60), ("6", 60), ("60", 60), ("05", 5), ("050", 5), ("100%", 100), ("150%", 100), ("0", 0) ])
+def testThresholdParse(value, threshold):
+    assert renameThresholdParse(value) == threshold
+
+
+def testThresholdInvalid():
+    with pytest.raises(Exception, match = "Invalid similarity threshold"):
+        renameThresholdParse("6x")
+
+
+@pytest.mark.parametrize("args, tree, renames, copies", [
+    ([ "-M", "a", "b" ], [ "a", "b" ], "", None),
+    ([ "-M60%", "a", "b" ], [ "a", "b" ], "60%", None),
+    ([ "a", "-M", "b" ], [ "a", "b" ], "", None),
+    ([ "--find-renames=7", "a", "b" ], [ "a", "b" ], "7", None),
+    ([ "-r", "-C", "a", "b" ], [ "a", "b" ], None, ""),
+    ([ "-C75", "a" ], [ "a" ], None, "75"),
+    ([ "a", "b" ], [ "a", "b" ], None, None),
+])
+def testOptions(args, tree, renames, copies):
+    args = libVerFlow.argparser.parse_args([ "diff-tree" ] + args)
+    assert (args.tree, args.find_renames, args.find_copies) == (tree, renames, copies)
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason = "needs git")
+@pytest.mark.parametrize("old, new, copies, threshold, expected", CASES)
+def testGitCompatible(repo, old, new, copies, threshold, expected):
+    # git finds the same renames and copies, with the same scores
+    old, new = treeWrite(repo, old), treeWrite(repo, new)
+    option = "-C{0}%" if copies else "-M{0}%"
+    out = subprocess.run([ "git", "--git-dir", repo.gitdir, "diff-tree", "-r", "--name-status",
+                           option.format(threshold), old, new ],
+                         check = True, stdout = subprocess.PIPE,
+                         env = dict(os.environ, GIT_CONFIG_NOSYSTEM = "1", HOME = repo.worktree)).stdout
+    assert out.decode("utf8").splitlines() == expected
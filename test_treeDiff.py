@@ -0,0 +1,163 @@
+# test_treeDiff.py
+# Comparing two trees: what changed, in git's order and with git's
+# statuses, without reading the subtrees that didn't change.
+import argparse
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import commandBridge
+import vf_treeDiff
+from object import GitBlob, GitCommit, GitTree, objectWrite
+from verFlowRepository import repoCreate, vfREPO
+from verFlowTree import GitTreeLeaf
+from vf_treeDiff import treeDiff, vfTreeChange, MODE_TREE
+
+
+@pytest.fixture
+def repo(tmp_path):
+    return repoCreate(str(tmp_path / "repo"))
+
+
+def treeWrite(repo, spec):
+    """Write the tree described by spec: name -> content (a file),
+    (mode, content) for other modes (a gitlink's content being its
+    SHA) or a dict for a subtree.  Returns its SHA."""
+    tree = GitTree()
+    for name, value in spec.items():
+        if isinstance(value, dict):
+            mode, sha = b"040000", treeWrite(repo, value)
+        else:
+            mode, content = (b"100644", value) if isinstance(value, str) else value
+            if mode == b"160000":
+                sha = content
+            else:
+                blob = GitBlob()
+                blob.blobdata = content.encode("utf8")
+                sha = objectWrite(blob, repo)
+        tree.items.append(GitTreeLeaf(mode, name, sha))
+    return objectWrite(tree, repo)
+
+
+def diff(repo, old, new, recursive = True):
+    return [ c.name() for c in treeDiff(repo, treeWrite(repo, old), treeWrite(repo, new),
+                                        recursive = recursive) ]
+
+
+BASE = { "top": "top\n", "a": { "one": "one\n", "b": { "two": "two\n" } }, "c": { "three": "3\n" } }
+
+# (old tree, new tree, changes with -r, changes without)
+CASES = [
+    # Added, deleted and modified, deep down
+    (BASE, { "top": "top\n", "new": "new\n",
+             "a": { "one": "1\n", "b": { "two": "two\n", "x": "x\n" } } },
+     [ "A\ta/b/x", "M\ta/one", "D\tc/three", "A\tnew" ],
+     [ "M\ta", "D\tc", "A\tnew" ]),
+    # A file becoming a directory, with names sorted between them
+    ({ "a": "a\n", "a-b": "ab\n", "a.c": "ac\n" },
+     { "a": { "x": "x\n" }, "a-b": "ab\n", "a.c": "ac\n" },
+     [ "D\ta", "A\ta/x" ],
+     [ "D\ta", "A\ta" ]),
+    # And the other way round
+    ({ "a": { "x": "x\n", "y": { "z": "z\n" } }, "a-b": "ab\n" },
+     { "a": "a\n", "a-b": "ab\n" },
+     [ "A\ta", "D\ta/x", "D\ta/y/z" ],
+     [ "A\ta", "D\ta" ]),
+    # Mode only, and type changes
+    ({ "run": "run\n", "link": "top\n", "file": "top\n" },
+     { "run": (b"100755", "run\n"), "link": (b"120000", "top\n"), "file": (b"120000", "top\n") },
+     [ "T\tfile", "T\tlink", "M\trun" ],
+     [ "T\tfile", "T\tlink", "M\trun" ]),
+    # A gitlink isn't a tree to recurse into
+    ({ "sub": (b"160000", "1" * 40) }, { "sub": (b"160000", "2" * 40) },
+     [ "M\tsub" ], [ "M\tsub" ]),
+]
+
+
+@pytest.mark.parametrize("old, new, recursive, flat", CASES)
+def testDiff(repo, old, new, recursive, flat):
+    assert diff(repo, old, new) == recursive
+    assert diff(repo, old, new, recursive = False) == flat
+
+
+def testRaw(repo):
+    old = treeWrite(repo, { "run": "run\n", "d": { "f": "f\n" } })
+    new = treeWrite(repo, { "run": (b"100755", "run\n"), "d": "d\n" })
+    changes = list(treeDiff(repo, old, new, recursive = False))
+    # The file sorts before the directory
+    assert [ c.name() for c in changes ] == [ "A\td", "D\td", "M\trun" ]
+    blob, tree, run = changes
+    assert (tree.old_mode, tree.new_mode, blob.old_mode, blob.new_mode) == (MODE_TREE, 0, 0, 0o100644)
+    assert (run.old_mode, run.new_mode) == (0o100644, 0o100755)
+    assert run.raw() == ":100644 100755 {0} {0} M\trun".format(run.old_sha)
+    # Compared with nothing: no mode, and SHAs of zeros
+    added = list(treeDiff(repo, None, new))
+    assert [ c.status for c in added ] == [ "A", "A" ]
+    assert added[0].raw() == ":000000 100644 {0} {1} A\td".format("0" * 40, added[0].new_sha)
+    assert vfTreeChange("R", "b", 0o100644, 0o100644, "1" * 40, "2" * 40, "a", 87).name() == "R087\ta\tb"
+
+
+def testSkipsUnchangedTrees(repo, monkeypatch):
+    big = dict(("d{0}".format(i), { "f": "{0}\n".format(i) }) for i in range(20))
+    old = treeWrite(repo, dict(big, top = "top\n"))
+    new = treeWrite(repo, dict(big, top = "changed\n"))
+    read = list()
+    objectReadRaw = vf_treeDiff.objectReadRaw
+    monkeypatch.setattr(vf_treeDiff, "objectReadRaw",
+                        lambda repo, sha: read.append(sha) or objectReadRaw(repo, sha))
+    assert [ c.name() for c in treeDiff(repo, old, new) ] == [ "M\ttop" ]
+    # Only the two root trees
+    assert read == [ old, new ]
+    read.clear()
+    assert list(treeDiff(repo, old, old)) == [] and read == []
+
+
+def commitWrite(repo, tree, parents, message):
+    commit = GitCommit()
+    commit.kvlm[b"tree"] = tree.encode("ascii")
+    if parents:
+        commit.kvlm[b"parent"] = [ p.encode("ascii") for p in parents ]
+    commit.kvlm[b"author"] = b"A <a@b> 1700000000 +0000"
+    commit.kvlm[b"committer"] = b"A <a@b> 1700000000 +0000"
+    commit.kvlm[None] = message.encode("utf8")
+    return objectWrite(commit, repo)
+
+
+def diffTree(tree, recursive = False, name_status = False):
+    commandBridge.cmd_diff_tree(argparse.Namespace(
+        tree = tree, recursive = recursive, name_only = False, name_status = name_status,
+        find_renames = None, find_copies = None, rename_candidates = None))
+
+
+def testCommand(repo, monkeypatch, capsys):
+    monkeypatch.chdir(repo.worktree)
+    one = treeWrite(repo, BASE)
+    two = treeWrite(repo, dict(BASE, top = "changed\n"))
+    three = treeWrite(repo, dict(BASE, new = "new\n"))
+    root = commitWrite(repo, one, [], "root")
+    left = commitWrite(repo, two, [ root ], "left")
+    right = commitWrite(repo, three, [ root ], "right")
+    merge = commitWrite(repo, three, [ left, right ], "merge")
+
+    diffTree([ left ], name_status = True)
+    assert capsys.readouterr().out == "{0}\nM\ttop\n".format(left)
+    diffTree([ one, three ], name_status = True)
+    assert capsys.readouterr().out == "A\tnew\n"
+    # Like git, nothing for a root commit or a merge
+    diffTree([ root ])
+    diffTree([ merge ])
+    assert capsys.readouterr().out == ""
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason = "needs git")
+@pytest.mark.parametrize("old, new", [ case[:2] for case in CASES ])
+def testGitCompatible(repo, old, new):
+    old, new = treeWrite(repo, old), treeWrite(repo, new)
+    for recursive in (True, False):
+        args = [ "git", "--git-dir", repo.gitdir, "diff-tree" ] + ([ "-r" ] if recursive else [])
+        out = subprocess.run(args + [ old, new ], check = True, stdout = subprocess.PIPE,
+                             env = dict(os.environ, GIT_CONFIG_NOSYSTEM = "1", HOME = repo.worktree)).stdout
+        assert out.decode("utf8").splitlines() == [
+            c.raw() for c in treeDiff(vfREPO(repo.worktree), old, new, recursive = recursive) ]
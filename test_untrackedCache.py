@@ -0,0 +1,132 @@
+# test_untrackedCache.py
+# The VFUC index extension: its format, directories listed from it
+# instead of the disk, and what makes status read them again.
+import os
+import time
+
+import pytest
+
+from commandBridge import vfadd
+from verFlowRepository import repoCreate, vfREPO
+from vf_indexFile import indexRead
+from vf_status import statusCompute
+from vf_untrackedCache import (vfUntrackedCache, vfUntrackedDir, untrackedCacheParse,
+                               untrackedCacheSerialize, UNTRACKED_EXT)
+
+FILES = [ "top", "a/tracked", "a/u", "b/c/u2", "b/c/d/u3", "b/x.log", "build/out" ]
+# The worktree and its directories
+DIRS = [ "", "a", "b", "b/c", "b/c/d" ]
+
+
+def filesWrite(worktree, names, content = "{0}\n"):
+    for name in names:
+        path = os.path.join(worktree, name)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, "w") as f:
+            f.write(content.format(name))
+
+
+def age(worktree):
+    """Make every directory look modified a while ago, so that status
+    trusts their listings."""
+    past = time.time() - 100
+    for root, dirs, _ in os.walk(worktree):
+        if ".ver_flow" in dirs:
+            dirs.remove(".ver_flow")
+        os.utime(root, (past, past))
+
+
+def status(repo):
+    return statusCompute(vfREPO(repo.worktree))
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """A repository with a few untracked files, build/ ignored by
+    info/exclude and *.log by b/.vfignore, both tracked."""
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "config"))
+    repo = repoCreate(str(tmp_path / "repo"))
+    monkeypatch.chdir(repo.worktree)
+    filesWrite(repo.worktree, FILES)
+    os.makedirs(os.path.join(repo.gitdir, "info"), exist_ok = True)
+    with open(os.path.join(repo.gitdir, "info", "exclude"), "w") as f:
+        f.write("build/\n")
+    with open(os.path.join(repo.worktree, "b", ".vfignore"), "w") as f:
+        f.write("*.log\n")
+    vfadd(repo, [ "a/tracked", "b/.vfignore" ])
+    age(repo.worktree)
+    return repo
+
+
+UNTRACKED = [ "a/u", "b/c/d/u3", "b/c/u2", "top" ]
+
+
+def testRoundTrip():
+    root = vfUntrackedDir((1, 2, 3), b"f" * 20)
+    root.files = [ "x", "é" ]
+    sub = vfUntrackedDir(None, b"g" * 20)
+    sub.dirs["deep"] = vfUntrackedDir((4, 5, 6), b"h" * 20)
+    root.dirs = { "sub": sub, "empty": vfUntrackedDir((7, 8, 9), b"i" * 20) }
+    data = untrackedCacheSerialize(vfUntrackedCache(b"b" * 20, root))
+    cache = untrackedCacheParse(data)
+    assert cache.fingerprint == b"b" * 20
+    assert cache.root.files == [ "x", "é" ]
+    assert cache.root.dirs["sub"].stat is None
+    assert cache.root.dirs["sub"].dirs["deep"].stat == (4, 5, 6)
+    assert untrackedCacheSerialize(cache) == data
+
+
+def testCached(repo):
+    first = status(repo)
+    assert sorted(first.untracked) == UNTRACKED
+    assert first.dirs_read == len(DIRS)
+    assert UNTRACKED_EXT in indexRead(vfREPO(repo.worktree)).extensions
+
+    second = status(repo)
+    assert sorted(second.untracked) == UNTRACKED
+    assert (second.dirs_read, second.dirs_cached) == (0, len(DIRS))
+
+
+def testChangeInCachedDir(repo):
+    status(repo)
+    # New files, deep in the cached directories, and one gone
+    filesWrite(repo.worktree, [ "b/c/new", "b/c/d/e/newer" ])
+    os.unlink(os.path.join(repo.worktree, "a", "u"))
+    result = status(repo)
+    assert sorted(result.untracked) == [ "b/c/d/e/newer", "b/c/d/u3", "b/c/new", "b/c/u2", "top" ]
+    # Only the directories that changed, and the new one
+    assert result.dirs_read == 4
+    # Still ignored where they appear
+    filesWrite(repo.worktree, [ "b/c/new.log" ])
+    assert "b/c/new.log" not in status(repo).untracked
+
+
+def testVfignoreChange(repo):
+    status(repo)
+    # Changing b/.vfignore only invalidates b and below
+    with open(os.path.join(repo.worktree, "b", ".vfignore"), "w") as f:
+        f.write("u2\n")
+    vfadd(repo, [ "b/.vfignore" ])
+    result = status(repo)
+    assert sorted(result.untracked) == [ "a/u", "b/c/d/u3", "b/x.log", "top" ]
+    assert (result.dirs_read, result.dirs_cached) == (3, 2)
+
+
+def testExcludeChange(repo):
+    status(repo)
+    # info/exclude applies everywhere: nothing is trusted anymore
+    with open(os.path.join(repo.gitdir, "info", "exclude"), "w") as f:
+        f.write("u*\n")
+    result = status(repo)
+    assert sorted(result.untracked) == [ "build/out", "top" ]
+    assert result.dirs_cached == 0
+
+
+def testDisabled(repo):
+    repo = vfREPO(repo.worktree)
+    repo.conf.set("core", "untrackedCache", "false")
+    with open(os.path.join(repo.gitdir, "config"), "w") as f:
+        repo.conf.write(f)
+    result = status(repo)
+    assert sorted(result.untracked) == UNTRACKED
+    assert UNTRACKED_EXT not in indexRead(vfREPO(repo.worktree)).extensions
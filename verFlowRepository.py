@@ -7,6 +7,22 @@ class vfREPO(object):
   worktree = None
   gitdir = None
   conf = None
+  # Packfiles, opened on first use (see vf_pack.packsLoad)
+  packs = None
+  # (fmt, size) of objects, filled by object.objectReadHeader
+  header_cache = None
+  # Inflated objects, see vf_cache.repoObjectCache
+  object_cache = None
+  # See vf_commitGraph.commitGraphLoad
+  commit_graph = None
+  # See vf_bitmap.bitmapLoad
+  bitmap = None
+  # See vf_oidIndex.oidIndex
+  oid_index = None
+  # See vfRefs.refCache
+  ref_cache = None
+  # Blob SHA -> rename sketch, see vf_renames.renameSketchOf
+  sketch_cache = None
 
   def __init__(self, path, force=False):
     self.worktree = path
@@ -51,7 +67,8 @@ def repoDir(repo, *path, mkdir=False):
       raise Exception("Not a directory %s" % path)
 
   if mkdir:
-    os.makedirs(path)
+    # Another thread may be creating it at the same time
+    os.makedirs(path, exist_ok=True)
     return path
   else:
     return None
@@ -17,8 +17,9 @@ def treeParseSingle(raw, start = 0):
 
     mode = raw[start:x]
     
+    # Normalize to six bytes: git writes trees as "40000"
     if len(mode) == 5:
-        mode = b" " + mode
+        mode = b"0" + mode
     
     #Find the null terminator of the path
     y = raw.find(b'\00', x)
@@ -45,10 +46,11 @@ def treeParser(raw):
 
 
 def treeLeafSortKey(leaf):
-    if leaf.mode.startswith(b"10"):
-        return leaf.path
-    else:
+    # Directories sort as if their name ended with "/"
+    if int(leaf.mode, 8) & 0o170000 == 0o040000:
         return leaf.path + "/"
+    else:
+        return leaf.path
     
 
 def treeSerialize(obj):
@@ -56,7 +58,7 @@ def treeSerialize(obj):
     ret = b''
 
     for i in obj.items:
-        ret += i.mode #mode
+        ret += i.mode.lstrip(b"0") #mode, without the leading 0 of trees, like git
         ret += b' ' #space
         ret += i.path.encode("utf8") #path to utf-8
         ret += b'\x00' #null terminator
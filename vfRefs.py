@@ -10,50 +10,520 @@ import hashlib
 from math import ceil
 import re
 import zlib
+import bisect
 
-from verFlowRepository import repoFile, repoDir
+from verFlowRepository import repoFile, repoDir, repoPath
 # This section will describe the uses of refs.
 
 # they’re text files, in the .git/refs hierarchy;
 # they hold the SHA-1 identifier of an object, or a reference to another reference, ultimately to a SHA-1 (no loops!)
 # example ref : 6071c08bcb4757d8c89a30d9755d2466cef8c1de or ref: refs/remotes/origin/master
 
-def refResolver(repo, ref):
-    """Takes repo and reference and resolves it"""
-    path = repoFile(repo,ref)
+# Refs may also be packed, in .ver_flow/packed-refs, as git does: one
+# "<sha> <name>" line per ref, sorted by name, each followed by a
+# "^<sha>" line with what it peels to if it points to a tag.  A loose
+# ref takes precedence over a packed one of the same name.  With many
+# refs (tags, mostly), reading one file beats opening one per ref.
+#
+# Refs are cached on the repository (see refCache): packed-refs is read
+# once, and again only if it changed on disk, and loose refs are read
+# once per process.  Refs written or deleted through refWrite and
+# refDelete keep the cache up to date.
+
+PACKED_REFS_HEADER = b"# pack-refs with: peeled fully-peeled sorted \n"
+
+# Symbolic refs pointing to symbolic refs: more than that is a loop
+REF_MAX_DEPTH = 5
+
+# As an expected old value: the ref doesn't exist.  As a new one: delete it.
+REF_ZERO = "0" * 40
+
+# What git check-ref-format refuses anywhere in a ref name: control
+# characters, space, ~ ^ : ? * [ \, "..", "@{" and "//"
+REF_NAME_BAD = re.compile(r"[\x00-\x20\x7f~^:?*\[\\]|\.\.|@\{|//")
+
+
+class vfPackedRefs(object):
+    """A packed-refs file, read at once.  Its records are sorted by name,
+    so a ref is found by binary search, without parsing the others."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            # To tell whether the file changed since
+            st = os.fstat(f.fileno())
+            self.stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+            self.data = f.read()
 
-    # Sometimes, an indirect reference may be broken.  This is normal
-    # in one specific case: we're looking for HEAD on a new repository
-    # with no commits.  In that case, .git/HEAD points to "ref:
-    # refs/heads/main", but .git/refs/heads/main doesn't exist yet
-    # (since there's no commit for it to refer to).
+        self.start = 0
+        traits = []
+        if self.data.startswith(b"# pack-refs with:"):
+            self.start = self.data.find(b"\n") + 1
+            traits = self.data[17:self.start].split()
+        # Files from old gits may be unsorted
+        self.sorted = b"sorted" in traits
+        # (name, sha, peeled or None), sorted, see entries
+        self.refs = None
+        self.names = None
 
-    if not os.path.isfile(path):
+    def recordStart(self, pos):
+        """Start of the record pos is in: a ref line, and its peel line."""
+        start = self.data.rfind(b"\n", 0, pos) + 1
+        while start > self.start and self.data[start] == 0x5e:    # "^"
+            start = self.data.rfind(b"\n", 0, start - 1) + 1
+        return max(start, self.start)
+
+    def find(self, name):
+        """(sha, peeled or None) of ref name, or None."""
+        if not self.sorted:
+            i = self.entryIndex(name)
+            return None if i is None else self.refs[i][1:]
+
+        target = name.encode()
+        lo, hi = self.start, len(self.data)
+        while lo < hi:
+            start = self.recordStart((lo + hi) // 2)
+            end = self.data.find(b"\n", start)
+            if end < 0:
+                end = len(self.data)
+            cur = self.data[start + 41:end]
+            if cur == target:
+                peeled = None
+                if self.data[end + 1:end + 2] == b"^":
+                    peeled = self.data[end + 2:end + 42].decode("ascii")
+                return self.data[start:start + 40].decode("ascii"), peeled
+            if cur > target:
+                hi = start
+            else:
+                # Next record, after the peel line if any
+                lo = end + 1
+                if self.data[lo:lo + 1] == b"^":
+                    lo = self.data.find(b"\n", lo) + 1 or len(self.data)
         return None
-    
-    with open (path, 'r') as fp:
-        data = fp.read()[:-1]
-        # Drop final \n ^^^^^
 
-        if data.startswith("ref: "):
-            return refResolver(repo, data[5:])
-        else:
+    def entries(self):
+        """All the refs, as (name, sha, peeled or None), sorted."""
+        if self.refs is None:
+            refs = list()
+            for line in self.data[self.start:].decode().split("\n"):
+                if line.startswith("^"):
+                    name, sha, _ = refs[-1]
+                    refs[-1] = (name, sha, line[1:])
+                elif line and not line.startswith("#"):
+                    refs.append((line[41:], line[:40], None))
+            if not self.sorted:
+                refs.sort()
+            self.refs = refs
+        return self.refs
+
+    def entryIndex(self, name):
+        if self.names is None:
+            self.names = [ ref[0] for ref in self.entries() ]
+        i = bisect.bisect_left(self.names, name)
+        return i if i < len(self.names) and self.names[i] == name else None
+
+
+class vfRefCache(object):
+    """The refs of a repository, as read so far."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        # vfPackedRefs, False if there's no packed-refs, None if not read
+        self.packed = None
+        # Loose ref name -> its content (a SHA, or "ref: <name>"), or
+        # None if there's no such loose ref
+        self.loose = dict()
+
+    def packedRefs(self):
+        """The vfPackedRefs of the repository, or None.  Read again if
+        the file changed since it was read."""
+        path = repoPath(self.repo, "packed-refs")
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.packed = False
+            return None
+        if not self.packed or self.packed.stat != (st.st_mtime_ns, st.st_size, st.st_ino):
+            self.packed = vfPackedRefs(path)
+        return self.packed
+
+    def looseRead(self, name):
+        if name in self.loose:
+            return self.loose[name]
+        try:
+            with open(repoPath(self.repo, name), "r") as fp:
+                data = fp.read().rstrip("\n")
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            data = None
+        self.loose[name] = data
+        return data
+
+    def read(self, name):
+        """The content of ref name: a SHA or "ref: <name>", loose first,
+        then packed.  None if there's no such ref."""
+        data = self.looseRead(name)
+        if data is None and name.startswith("refs/"):
+            packed = self.packedRefs()
+            if packed is not None:
+                found = packed.find(name)
+                if found is not None:
+                    data = found[0]
+        return data
+
+    def looseNames(self, prefix):
+        """Names of the loose refs under prefix (a directory, ending with
+        "/"), sorted."""
+        names = list()
+        stack = [ prefix ]
+        while stack:
+            current = stack.pop()
+            try:
+                entries = list(os.scandir(repoPath(self.repo, current)))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append(current + entry.name + "/")
+                elif not entry.name.endswith(".lock"):
+                    names.append(current + entry.name)
+        return sorted(names)
+
+
+def refCache(repo):
+    """The vfRefCache of repo, made once and kept on it."""
+    if repo.ref_cache is None:
+        repo.ref_cache = vfRefCache(repo)
+    return repo.ref_cache
+
+
+def refResolver(repo, ref):
+    """Takes repo and reference and resolves it"""
+    cache = refCache(repo)
+    for _ in range(REF_MAX_DEPTH):
+        # Sometimes, an indirect reference may be broken.  This is normal
+        # in one specific case: we're looking for HEAD on a new repository
+        # with no commits.  In that case, .git/HEAD points to "ref:
+        # refs/heads/main", but .git/refs/heads/main doesn't exist yet
+        # (since there's no commit for it to refer to).
+        data = cache.read(ref)
+        if data is None or not data.startswith("ref: "):
             return data
+        ref = data[5:]
+    raise Exception("Too many levels of symbolic refs: {0}".format(ref))
 
 
-def refsList(repo, path = None):
-    if not path:
-        path = repoDir(repo, "refs")
-    # Git shows refs sorted.  To do the same, we use
-    # an OrderedDict and sort the output of listdir
-    ret = collections.OrderedDict()
+def refsAll(repo, prefix = "refs/"):
+    """The refs whose name starts with prefix, as (name, sha), sorted by
+    name.  Loose refs take precedence over packed ones.  Broken symbolic
+    refs are left out."""
+    cache = refCache(repo)
+    refs = dict()
+    packed = cache.packedRefs()
+    if packed is not None:
+        for name, sha, _ in packed.entries():
+            if name.startswith(prefix):
+                refs[name] = sha
 
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path,f)
-        if os.path.isdir(can):
-            ret[f] = refsList(repo, can)
-        else:
-            ret[f] = refResolver(repo,can)
-    
-    return ret
+    # Only the directories the prefix can be in need to be looked at
+    directory = prefix[:prefix.rfind("/") + 1]
+    for name in cache.looseNames(directory):
+        if name.startswith(prefix):
+            sha = refResolver(repo, name)
+            if sha:
+                refs[name] = sha
+            else:
+                refs.pop(name, None)
+    return sorted(refs.items())
+
+
+def refsTips(repo):
+    """The SHAs the refs and HEAD point to, sorted, without duplicates.
+    Tags aren't peeled."""
+    shas = set(sha for _, sha in refsAll(repo))
+    head = refResolver(repo, "HEAD")
+    if head:
+        shas.add(head)
+    return sorted(shas)
+
+
+def refPeel(repo, sha):
+    """What sha peels to if it is a tag (recursively), else None."""
+    # Peeling needs objects, and objects resolve refs
+    from object import objectReadHeader, objectRead
+
+    target = sha
+    while objectReadHeader(repo, target)[0] == b'tag':
+        target = objectRead(repo, target).kvlm[b'object'].decode("ascii")
+    return target if target != sha else None
+
+
+def refNameCheck(name):
+    """Raise unless name is a ref that may be written: HEAD, or a name
+    under refs/ following git's check-ref-format rules.  Among others,
+    no component starts with "." or ends with ".lock", so a name can't
+    lead out of refs/ nor onto a lock file."""
+    if name == "HEAD":
+        return
+    if (not name.startswith("refs/") or REF_NAME_BAD.search(name)
+        or name.endswith((".", "/"))
+        or any(not part or part.startswith(".") or part.endswith(".lock")
+               for part in name.split("/"))):
+        raise Exception("Refusing to update ref with bad name '{0}'".format(name))
+
+
+def lockTake(path):
+    """Create path.lock, failing if it exists: whoever made it is about
+    to replace path.  Returns its file descriptor."""
+    try:
+        return os.open(path + ".lock", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        raise Exception("Unable to create {0}.lock: File exists.  Another verFlow process "
+                        "seems to be running, or one crashed: remove it if so".format(path))
+
+
+def lockCommit(fd, path, data):
+    """Write data to the lock of path, and put it in place of path."""
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".lock", path)
+
+
+def packedRefsData(refs):
+    """The content of a packed-refs file with refs, a list of (name, sha,
+    peeled or None) sorted by name."""
+    out = [ PACKED_REFS_HEADER ]
+    for name, sha, peeled in refs:
+        out.append("{0} {1}\n".format(sha, name).encode())
+        if peeled:
+            out.append("^{0}\n".format(peeled).encode())
+    return b"".join(out)
+
+
+def packedRefsWrite(repo, refs):
+    """Replace packed-refs with refs, see packedRefsData."""
+    path = repoPath(repo, "packed-refs")
+    lockCommit(lockTake(path), path, packedRefsData(refs))
+    refCache(repo).packed = None
+
+
+class vfRefTransaction(object):
+    """Updates to refs, applied together, or not at all if one of the
+    refs isn't at the value expected.
+
+    Every ref involved is locked (<ref>.lock) before anything is checked
+    or written, so concurrent writers fail instead of losing updates,
+    and new values are written to the lock, then renamed over the ref:
+    a crash can't leave a truncated ref.  A transaction changing one ref
+    writes it loose; one changing more rewrites packed-refs with all the
+    new values instead, one file and one fsync whatever their number,
+    and drops their loose files."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        # Ref name -> (new, old).  new is REF_ZERO to delete the ref,
+        # None to only check old; old is REF_ZERO if the ref must not
+        # exist, None not to check.
+        self.updates = dict()
+
+    def target(self, name, deref):
+        """The ref an update of name changes: with deref, the one name
+        points to if it's a symbolic ref, as git does."""
+        cache = refCache(self.repo)
+        for _ in range(REF_MAX_DEPTH):
+            if not deref:
+                return name
+            # The value at commit time is what counts
+            cache.loose.pop(name, None)
+            data = cache.looseRead(name)
+            if data is None or not data.startswith("ref: "):
+                return name
+            name = data[5:]
+        raise Exception("Too many levels of symbolic refs: {0}".format(name))
+
+    def update(self, name, new, old = None, deref = True):
+        # Before reading it: the name is a path under .ver_flow/.  What
+        # a symbolic ref points to is checked too.
+        refNameCheck(name)
+        name = self.target(name, deref)
+        refNameCheck(name)
+        if name in self.updates:
+            raise Exception("Multiple updates for ref '{0}' not allowed".format(name))
+        self.updates[name] = (new, old)
+
+    def create(self, name, new, deref = True):
+        self.update(name, new, REF_ZERO, deref)
+
+    def delete(self, name, old = None, deref = True):
+        self.update(name, REF_ZERO, old, deref)
+
+    def verify(self, name, old = None, deref = True):
+        self.update(name, None, old or REF_ZERO, deref)
+
+    def commit(self):
+        """Apply the updates.  Raises, having changed nothing, if a ref
+        is locked by someone else or not at its expected value."""
+        repo = self.repo
+        cache = refCache(repo)
+        names = sorted(self.updates)
+        changed = [ name for name in names if self.updates[name][0] is not None ]
+        # HEAD can't be packed
+        packing = set(name for name in changed if len(changed) > 1 and name.startswith("refs/")
+                      and self.updates[name][0] != REF_ZERO)
+
+        locks = dict()
+        packed_path = repoPath(repo, "packed-refs")
+        packed_lock = None
+        try:
+            for name in names:
+                repoFile(repo, *name.split("/"), mkdir = True)
+                locks[name] = lockTake(repoPath(repo, name))
+            if packing or REF_ZERO in (self.updates[name][0] for name in changed):
+                packed_lock = lockTake(packed_path)
+
+            # Now that nobody else can change them, check the refs
+            packed = cache.packedRefs()
+            packed_entries = { ref[0]: ref for ref in packed.entries() } if packed is not None else dict()
+            for name in names:
+                new, old = self.updates[name]
+                cache.loose.pop(name, None)
+                current = cache.read(name)
+                if current is not None and current.startswith("ref: "):
+                    # Not dereferenced: it is compared by what it points to
+                    current = refResolver(repo, name)
+                if old is not None and (current or REF_ZERO) != old:
+                    raise Exception("Cannot lock ref '{0}': is at {1} but expected {2}".format(
+                        name, current or REF_ZERO, old))
+
+            deleted = [ name for name in changed if self.updates[name][0] == REF_ZERO ]
+            if packing or any(name in packed_entries for name in deleted):
+                for name in deleted:
+                    packed_entries.pop(name, None)
+                for name in packing:
+                    new = self.updates[name][0]
+                    packed_entries[name] = (name, new, refPeel(repo, new))
+                refs = [ packed_entries[name] for name in sorted(packed_entries) ]
+                lockCommit(packed_lock, packed_path, packedRefsData(refs))
+                packed_lock = None
+                cache.packed = None
+
+            for name in changed:
+                new = self.updates[name][0]
+                path = repoPath(repo, name)
+                if new == REF_ZERO or name in packing:
+                    # Loose files would hide what packed-refs says
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                    cache.loose[name] = None
+                else:
+                    lockCommit(locks.pop(name), path, (new + "\n").encode())
+                    cache.loose[name] = new
+        finally:
+            for name, fd in locks.items():
+                os.close(fd)
+                os.unlink(repoPath(repo, name) + ".lock")
+            if packed_lock is not None:
+                os.close(packed_lock)
+                os.unlink(packed_path + ".lock")
+            # Those which are only packed, or gone, and failed ones
+            refDirsPrune(repo, locks)
+        self.updates = dict()
+
+
+def refWrite(repo, name, sha, old = None):
+    """Point ref name (e.g. "refs/heads/master", or "HEAD" and so the
+    branch it points to) to sha, if it is at old when given."""
+    transaction = vfRefTransaction(repo)
+    transaction.update(name, sha, old)
+    transaction.commit()
+
+
+def refDelete(repo, name, old = None):
+    """Delete ref name, loose and packed."""
+    transaction = vfRefTransaction(repo)
+    transaction.delete(name, old)
+    transaction.commit()
+
+
+def packRefs(repo, all = False, prune = True):
+    """Move loose refs to packed-refs, like git pack-refs: tags and refs
+    already packed, or with all every ref.  Symbolic refs stay loose.
+    Unless not prune, the loose files are removed.  Returns the number
+    of refs packed."""
+    # Broken refs are found reading objects, which resolve refs
+    from object import objectReadHeader
+
+    cache = refCache(repo)
+    packed = cache.packedRefs()
+    refs = dict()
+    if packed is not None:
+        for name, sha, peeled in packed.entries():
+            refs[name] = (sha, peeled, False)
+
+    moved = list()
+    for name in cache.looseNames("refs/"):
+        data = cache.looseRead(name)
+        if not data or data.startswith("ref: "):
+            continue
+        if not (all or name.startswith("refs/tags/") or name in refs):
+            continue
+        if objectReadHeader(repo, data) is None:
+            # Broken ref: git leaves them alone
+            continue
+        refs[name] = (data, None, True)
+        moved.append((name, data))
+
+    result = list()
+    for name in sorted(refs):
+        sha, peeled, loose = refs[name]
+        if loose:
+            # Written "fully-peeled": every ref to a tag gets its peel line
+            peeled = refPeel(repo, sha)
+        result.append((name, sha, peeled))
+    packedRefsWrite(repo, result)
+
+    if prune:
+        refDirsPrune(repo, [ name for name, sha in moved if refPrune(repo, name, sha) ])
+    return len(moved)
+
+
+def refPrune(repo, name, sha):
+    """Remove loose ref name now that it is packed, unless it was changed
+    meanwhile.  Returns whether it was removed."""
+    cache = refCache(repo)
+    cache.loose.pop(name, None)
+    if cache.looseRead(name) != sha:
+        return False
+    os.unlink(repoPath(repo, name))
+    cache.loose[name] = None
+    return True
+
+
+def refDirsPrune(repo, names):
+    """Remove the directories of the loose refs names that are empty now
+    they are gone, down to refs/*/, which stay."""
+    directories = set()
+    for name in names:
+        parts = name.split("/")
+        for i in range(3, len(parts)):
+            directories.add("/".join(parts[:i]))
+    # Deepest first: a directory may only hold others
+    for directory in sorted(directories, key = len, reverse = True):
+        try:
+            os.rmdir(repoPath(repo, directory))
+        except OSError:
+            # Not empty
+            pass
+
+
+def getActiveBranch(repo):
+    """Name of the branch HEAD points to, or False if it's detached."""
+    with open(repoFile(repo,"HEAD"),"r") as f:
+        head = f.read()
     
+    if head.startswith("ref: refs/heads/"):
+        return(head[16:-1])
+    else:
+        return False
@@ -0,0 +1,186 @@
+# vf_ancestry.py
+# Ancestry queries: merge bases, and whether a commit is an ancestor of
+# another.
+#
+# Merge bases are found like git does, by painting: the commits reachable
+# from one side get PARENT1, those reachable from the other PARENT2, and
+# a commit with both is a common ancestor, whose own ancestors are STALE
+# (they can't be the best one).  Commits are taken from a queue, highest
+# generation first, so a commit always comes after all its descendants
+# that are being walked, and the walk ends as soon as everything left in
+# the queue is stale: it only covers the commits between the tips and
+# their merge bases, not the whole history.
+#
+# Generation numbers come from the commit-graph (see vf_commitGraph).
+# Commits that aren't in it have GENERATION_INFINITY, so they come first,
+# by date; without a graph, everything is ordered by date.
+import heapq
+
+from vf_commitGraph import commitLookup, GENERATION_INFINITY
+
+PARENT1 = 1
+PARENT2 = 2
+STALE = 4
+RESULT = 8
+
+# Without generation numbers, isAncestor walks everything below the
+# descendant, to be exact whatever the dates.  When asked to, with
+# core.ancestryDateSlop (in seconds, git uses a day), it takes commits
+# that much older than the ancestor not to lead to it, and doesn't walk
+# through them: faster, but wrong when clocks were off by more than
+# that, or history was imported with old dates.
+
+
+def ancestryDateSlop(repo):
+    """core.ancestryDateSlop if set, else None: exact walks."""
+    if repo.conf is not None and repo.conf.has_option("core", "ancestryDateSlop"):
+        return repo.conf.getint("core", "ancestryDateSlop")
+    return None
+
+
+class vfAncestryWalk(object):
+    """The state of a walk: commits looked up, their flags, and the
+    queue of commits to visit next."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.commits = dict()
+        self.flags = dict()
+        self.queue = list()
+        self.counter = 0
+        # Number of entries of the queue that aren't STALE
+        self.nonstale = 0
+        # sha -> how many times it is in the queue
+        self.queued = dict()
+        # Commits taken out of the queue, to measure the work done
+        self.visited = 0
+
+    def lookup(self, sha):
+        info = self.commits.get(sha)
+        if info is None:
+            info = commitLookup(self.repo, sha)
+            self.commits[sha] = info
+        return info
+
+    def mark(self, sha, flags):
+        """Add flags to sha.  If it just became STALE, its entries in the
+        queue don't count as pending anymore."""
+        old = self.flags.get(sha, 0)
+        self.flags[sha] = old | flags
+        if flags & STALE and not old & STALE:
+            self.nonstale -= self.queued.get(sha, 0)
+
+    def push(self, sha):
+        info = self.lookup(sha)
+        # The counter keeps insertion order when everything else is equal
+        heapq.heappush(self.queue, (-info.generation, -info.date, self.counter, sha))
+        self.counter += 1
+        self.queued[sha] = self.queued.get(sha, 0) + 1
+        if not self.flags.get(sha, 0) & STALE:
+            self.nonstale += 1
+
+    def pop(self):
+        sha = heapq.heappop(self.queue)[3]
+        self.queued[sha] -= 1
+        if not self.flags.get(sha, 0) & STALE:
+            self.nonstale -= 1
+        self.visited += 1
+        return self.lookup(sha)
+
+
+def paintDownToCommon(walk, one, twos):
+    """Paint from one (PARENT1) and twos (PARENT2) until every commit
+    left to visit is a known common ancestor or below one.  Returns the
+    common ancestors found, some of which may be ancestors of others."""
+    walk.mark(one, PARENT1)
+    walk.push(one)
+    for sha in twos:
+        walk.mark(sha, PARENT2)
+        walk.push(sha)
+
+    result = list()
+    while walk.nonstale:
+        info = walk.pop()
+        flags = walk.flags[info.sha] & (PARENT1 | PARENT2 | STALE)
+        if flags == PARENT1 | PARENT2:
+            if not walk.flags[info.sha] & RESULT:
+                walk.mark(info.sha, RESULT)
+                result.append(info.sha)
+            # Its ancestors are common too, but not the best ones
+            flags |= STALE
+        for p in info.parents:
+            if walk.flags.get(p, 0) & flags == flags:
+                continue
+            walk.mark(p, flags)
+            walk.push(p)
+
+    # Those found stale after being found common are below another one
+    return [ sha for sha in result if not walk.flags[sha] & STALE ]
+
+
+def isAncestor(repo, ancestor, descendant, walk = None, date_slop = None):
+    """Whether ancestor can be reached from descendant (a commit is its
+    own ancestor).  Walks down from descendant, and stops at ancestor;
+    commits with a generation not above ancestor's can't lead to it and
+    aren't walked through.  Without generation numbers, neither are
+    commits more than date_slop seconds older than ancestor, if given:
+    otherwise the walk is exact.  Commits already looked up by walk, if
+    given, are reused."""
+    if ancestor == descendant:
+        return True
+    if walk is None:
+        walk = vfAncestryWalk(repo)
+    target = walk.lookup(ancestor)
+    generation = target.generation
+    # With generation numbers, no need for dates
+    by_date = generation == GENERATION_INFINITY
+    min_date = target.date - date_slop if by_date and date_slop is not None else None
+
+    info = walk.lookup(descendant)
+    queue = [ (-info.generation, -info.date, descendant) ]
+    seen = { descendant }
+    while queue:
+        info = walk.lookup(heapq.heappop(queue)[2])
+        walk.visited += 1
+        for p in info.parents:
+            if p == ancestor:
+                return True
+            if p in seen:
+                continue
+            seen.add(p)
+            parent = walk.lookup(p)
+            if not by_date:
+                # Only commits of a higher generation can lead to it
+                if parent.generation <= generation:
+                    continue
+            elif parent.generation != GENERATION_INFINITY:
+                # Commits in the graph can't lead to one that isn't
+                continue
+            elif min_date is not None and parent.date < min_date:
+                continue
+            heapq.heappush(queue, (-parent.generation, -parent.date, p))
+    return False
+
+
+def removeRedundant(repo, shas, walk = None):
+    """Drop from shas the commits that are ancestors of another one."""
+    if walk is None:
+        walk = vfAncestryWalk(repo)
+    return [ sha for sha in shas
+             if not any(other != sha and isAncestor(repo, sha, other, walk) for other in shas) ]
+
+
+def mergeBases(repo, one, twos, all = False, walk = None):
+    """The best common ancestors of one and the commits in twos (as if
+    they were merged together), most recent first.  Only the first one
+    unless all.  Empty when there's none."""
+    if walk is None:
+        walk = vfAncestryWalk(repo)
+    if one in twos:
+        return [ one ]
+
+    result = paintDownToCommon(walk, one, twos)
+    if len(result) > 1:
+        result = removeRedundant(repo, result, walk)
+    result.sort(key = lambda sha: -walk.lookup(sha).date)
+    return result if all else result[:1]
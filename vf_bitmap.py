@@ -0,0 +1,423 @@
+# vf_bitmap.py
+# Reachability bitmaps.  For a pack holding every object reachable from
+# the refs, a bitmap index (pack-<sha>.bitmap, next to the pack) stores,
+# for some of its commits, the set of objects reachable from it, as a
+# bitset over the objects of the pack in pack order (bit i is the i-th
+# object by offset).  The objects reachable from a set of commits are
+# then the OR of the bitmaps of the closest selected commits, plus what
+# is found walking the few commits between them.
+#
+# The format is git's (version 1), so git can use ours and we can use
+# git's:
+#
+#  - a header: "BITM", version 1, options (BITMAP_OPT_FULL_DAG, and
+#    BITMAP_OPT_HASH_CACHE when there is a name-hash table at the end,
+#    which we don't write), the number of entries, and the checksum of
+#    the pack;
+#  - four EWAH bitmaps telling which objects are commits, trees, blobs
+#    and tags;
+#  - the entries: the index position (in the .idx, by SHA) of the
+#    commit, a XOR offset, flags and an EWAH bitmap.  With a XOR offset
+#    of n, the real bitmap is the stored one XOR that of the entry n
+#    before (we always write 0);
+#  - the SHA-1 of everything before.
+#
+# EWAH compresses a bitset as 64 bits words: a "running length word"
+# tells how many words of all 0 or all 1 (bit 0 tells which) come first
+# (bits 1 to 32), then how many literal words follow it (bits 33 to 63).
+# Each bitmap is stored as its size in bits, its number of words, the
+# words (big endian) and the position of the last running length word.
+#
+# In memory, bitsets are Python ints: bit i is (bits >> i) & 1, and OR
+# and AND of big ints are fast.
+import os
+import mmap
+import time
+import struct
+import hashlib
+
+from object import objectReadRaw, objectReadHeader, objectRead
+from vf_pack import packsLoad, PACK_TYPE_TO_FMT, PACK_OBJ_OFS_DELTA
+from vf_commitGraph import commitLookup, commitGraphTips
+from vf_revWalk import revWalk
+
+BITMAP_SIGNATURE = b"BITM"
+BITMAP_HEADER = struct.Struct(">4sHHI20s")
+BITMAP_ENTRY = struct.Struct(">IBB")
+BITMAP_OPT_FULL_DAG = 0x1
+BITMAP_OPT_HASH_CACHE = 0x4
+
+EWAH_HEADER = struct.Struct(">II")
+EWAH_WORD_FULL = 0xFFFFFFFFFFFFFFFF
+EWAH_MAX_RUN = 0xFFFFFFFF
+EWAH_MAX_LITERALS = 0x7FFFFFFF
+
+# One commit every that many, newest first, gets a bitmap, on top of
+# the tips of the refs.  Queries walk at most about that many commits.
+BITMAP_INTERVAL = 100
+
+
+def ewahEncode(bits):
+    """The EWAH serialization of bitset bits."""
+    size = bits.bit_length()
+    count = (size + 63) // 64
+    words = struct.unpack("<{0}Q".format(count), bits.to_bytes(count * 8, "little"))
+
+    out = list()
+    rlw = 0
+    i = 0
+    while True:
+        run = 0
+        run_bit = 0
+        if i < count and (words[i] == 0 or words[i] == EWAH_WORD_FULL):
+            clean = words[i]
+            run_bit = 1 if clean else 0
+            while i < count and words[i] == clean and run < EWAH_MAX_RUN:
+                i += 1
+                run += 1
+        start = i
+        while (i < count and words[i] != 0 and words[i] != EWAH_WORD_FULL
+               and i - start < EWAH_MAX_LITERALS):
+            i += 1
+        rlw = len(out)
+        out.append(run_bit | (run << 1) | ((i - start) << 33))
+        out.extend(words[start:i])
+        if i >= count:
+            break
+
+    return (EWAH_HEADER.pack(size, len(out))
+            + struct.pack(">{0}Q".format(len(out)), *out)
+            + rlw.to_bytes(4, "big"))
+
+
+def ewahDecode(data, pos):
+    """Decode the EWAH bitmap at pos in data.  Returns (bits, position
+    after it)."""
+    _, count = EWAH_HEADER.unpack_from(data, pos)
+    pos += EWAH_HEADER.size
+    words = struct.unpack_from(">{0}Q".format(count), data, pos)
+    pos += 8 * count + 4
+
+    out = bytearray()
+    i = 0
+    while i < count:
+        rlw = words[i]
+        i += 1
+        run = (rlw >> 1) & EWAH_MAX_RUN
+        literals = rlw >> 33
+        if run:
+            out += (b'\xff' if rlw & 1 else b'\x00') * (8 * run)
+        if literals:
+            out += struct.pack("<{0}Q".format(literals), *words[i:i + literals])
+            i += literals
+    return int.from_bytes(out, "little"), pos
+
+
+def ewahSkip(data, pos):
+    """Position right after the EWAH bitmap at pos."""
+    _, count = EWAH_HEADER.unpack_from(data, pos)
+    return pos + EWAH_HEADER.size + 8 * count + 4
+
+
+def bitsFromPositions(positions):
+    """The bitset with the given bits set."""
+    positions = list(positions)
+    if not positions:
+        return 0
+    out = bytearray(max(positions) // 8 + 1)
+    for pos in positions:
+        out[pos >> 3] |= 1 << (pos & 7)
+    return int.from_bytes(out, "little")
+
+
+def bitsPositions(bits):
+    """The positions of the bits set in bits, in order."""
+    ret = list()
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for i, byte in enumerate(data):
+        while byte:
+            low = byte & -byte
+            ret.append(i * 8 + low.bit_length() - 1)
+            byte ^= low
+    return ret
+
+
+class vfBitmapIndex(object):
+    """The bitmap index of a pack, mapped in memory.  Without a path,
+    an empty one, that bitmapWrite fills."""
+
+    def __init__(self, pack, path = None):
+        self.pack = pack
+        self.path = path
+        self.data = None
+        self.size = 0
+        # Commit SHA -> (position of its bitmap in the file, XOR offset,
+        # entry number), and entry number -> commit SHA
+        self.entries = dict()
+        self.entry_shas = list()
+        # Commit SHA -> bitmap, for those already decoded
+        self.bitmaps = dict()
+        # SHA -> bit position, when many lookups are worth building it
+        self.positions = None
+        self.commits = self.trees = self.blobs = self.tags = 0
+        if path is None:
+            return
+
+        self.size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, options, count, checksum = BITMAP_HEADER.unpack_from(self.data, 0)
+        if signature != BITMAP_SIGNATURE or version != 1:
+            raise Exception("Unsupported bitmap index {0}".format(path))
+        if not options & BITMAP_OPT_FULL_DAG:
+            raise Exception("Bitmap index {0} isn't for a full history".format(path))
+        if checksum != pack.pack[-20:]:
+            raise Exception("Bitmap index {0} doesn't match its pack".format(path))
+
+        pos = BITMAP_HEADER.size
+        self.commits, pos = ewahDecode(self.data, pos)
+        self.trees, pos = ewahDecode(self.data, pos)
+        self.blobs, pos = ewahDecode(self.data, pos)
+        self.tags, pos = ewahDecode(self.data, pos)
+        for i in range(count):
+            idx_pos, xor_offset, _ = BITMAP_ENTRY.unpack_from(self.data, pos)
+            pos += BITMAP_ENTRY.size
+            sha = pack.shaAt(idx_pos).hex()
+            self.entries[sha] = (pos, xor_offset, i)
+            self.entry_shas.append(sha)
+            pos = ewahSkip(self.data, pos)
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+
+    def positionsLoad(self):
+        """Build the table of the bit position of every object, faster
+        than binary searches in the .idx for a walk of the whole pack."""
+        order = self.pack.packOrder()[0]
+        self.positions = { self.pack.shaAt(i).hex(): pos for pos, i in enumerate(order) }
+
+    def position(self, sha):
+        """Bit position of object sha, or None if it's not in the pack."""
+        if self.positions is not None:
+            return self.positions.get(sha)
+        i = self.pack.findPosition(bytes.fromhex(sha))
+        if i is None:
+            return None
+        return self.pack.packOrder()[1][i]
+
+    def shaAt(self, pos):
+        return self.pack.shaAt(self.pack.packOrder()[0][pos]).hex()
+
+    def bitmapFor(self, sha):
+        """The bitmap of commit sha, or None if it has none."""
+        bits = self.bitmaps.get(sha)
+        if bits is not None or not sha in self.entries:
+            return bits
+        pos, xor_offset, i = self.entries[sha]
+        bits = ewahDecode(self.data, pos)[0]
+        if xor_offset:
+            bits ^= self.bitmapFor(self.entry_shas[i - xor_offset])
+        self.bitmaps[sha] = bits
+        return bits
+
+
+def bitmapPath(pack):
+    return pack.path[:-5] + ".bitmap"
+
+
+def bitmapLoad(repo, reload = False):
+    """The bitmap index of repo, or None if none of its packs has one.
+    It is opened once and kept on the repository object."""
+    if repo.bitmap is not None and not reload:
+        return repo.bitmap or None
+    if repo.bitmap:
+        repo.bitmap.close()
+
+    # False: we looked, there is none
+    repo.bitmap = False
+    for pack in packsLoad(repo):
+        path = bitmapPath(pack)
+        if os.path.exists(path):
+            repo.bitmap = vfBitmapIndex(pack, path)
+            break
+    return repo.bitmap or None
+
+
+def treeChildren(data):
+    """(sha, is_tree) for the entries of the raw tree data, without the
+    submodules (mode 160000, commits of another repository).  Only what
+    a reachability walk needs, so quicker than treeParser."""
+    ret = list()
+    pos = 0
+    end = len(data)
+    while pos < end:
+        space = data.index(b' ', pos)
+        nul = data.index(b'\x00', space)
+        mode = data[pos:space]
+        pos = nul + 21
+        if mode != b'160000':
+            ret.append((data[nul + 1:pos].hex(), mode == b'40000' or mode == b'040000'))
+    return ret
+
+
+class vfReachStats(object):
+    def __init__(self):
+        # Bitmaps OR'ed in, and commits and trees read because they had
+        # none and weren't covered by one
+        self.bitmaps = 0
+        self.commits = 0
+        self.trees = 0
+        self.seconds = 0.0
+
+
+def bitmapReachable(repo, index, tips, stats = None):
+    """The objects reachable from tips (SHAs of any type of object).
+    Returns (bits, extra): bits has those in the pack of index, extra
+    maps the SHA of the others (say, loose objects newer than the pack)
+    to their type."""
+    if stats is None:
+        stats = vfReachStats()
+    start = time.time()
+    bits = 0
+    # bits as bytes, to test bits without shifting a big int
+    covered = b''
+    found = set()
+    extra = dict()
+
+    def mark(sha, fmt):
+        """Whether sha wasn't seen yet, and mark it."""
+        pos = index.position(sha)
+        if pos is None:
+            if sha in extra:
+                return False
+            extra[sha] = fmt
+            return True
+        if pos in found or (pos >> 3 < len(covered) and covered[pos >> 3] >> (pos & 7) & 1):
+            return False
+        found.add(pos)
+        return True
+
+    commits = list()
+    trees = list()
+    for sha in tips:
+        fmt = objectReadHeader(repo, sha)[0]
+        # Peel tags, keeping the tags themselves
+        while fmt == b'tag':
+            mark(sha, fmt)
+            tag = objectRead(repo, sha)
+            sha = tag.kvlm[b'object'].decode("ascii")
+            fmt = tag.kvlm[b'type']
+        if fmt == b'commit':
+            commits.append(sha)
+        elif fmt == b'tree':
+            trees.append(sha)
+        else:
+            mark(sha, fmt)
+
+    while commits:
+        sha = commits.pop()
+        bitmap = index.bitmapFor(sha)
+        if bitmap is not None:
+            pos = index.position(sha)
+            if not (pos >> 3 < len(covered) and covered[pos >> 3] >> (pos & 7) & 1):
+                bits |= bitmap
+                covered = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+                stats.bitmaps += 1
+            continue
+        if not mark(sha, b'commit'):
+            continue
+        stats.commits += 1
+        info = commitLookup(repo, sha)
+        commits.extend(info.parents)
+        trees.append(info.tree)
+
+    while trees:
+        sha = trees.pop()
+        if not mark(sha, b'tree'):
+            continue
+        stats.trees += 1
+        for child, is_tree in treeChildren(objectReadRaw(repo, sha)[1]):
+            if is_tree:
+                trees.append(child)
+            else:
+                mark(child, b'blob')
+
+    bits |= bitsFromPositions(found)
+    stats.seconds += time.time() - start
+    return bits, extra
+
+
+def bitmapTypes(repo, pack):
+    """The bit positions of the commits, trees, blobs and tags of pack,
+    as a dict of lists.  Objects are read in pack order, so the base of
+    a delta, which comes first, already has its type."""
+    types = { b'commit': list(), b'tree': list(), b'blob': list(), b'tag': list() }
+    by_offset = dict()
+    order = pack.packOrder()[0]
+    for pos, i in enumerate(order):
+        offset = pack.offsetAt(i)
+        type, _, _, base = pack.entryHeader(offset)
+        if type in PACK_TYPE_TO_FMT:
+            fmt = PACK_TYPE_TO_FMT[type]
+        elif type == PACK_OBJ_OFS_DELTA:
+            fmt = by_offset[base]
+        else:
+            fmt = objectReadHeader(repo, base)[0]
+        by_offset[offset] = fmt
+        types[fmt].append(pos)
+    return types
+
+
+def bitmapSelect(repo, tips, interval = BITMAP_INTERVAL):
+    """The commits to give a bitmap to, oldest first: the tips and one
+    in every interval, by date."""
+    ret = list()
+    for i, info in enumerate(revWalk(repo, tips)):
+        if i % interval == 0 or info.sha in tips:
+            ret.append(info.sha)
+    ret.reverse()
+    return ret
+
+
+def bitmapWrite(repo, pack, tips = None, interval = BITMAP_INTERVAL):
+    """Write the bitmap index of pack, which must hold every object
+    reachable from tips (by default the refs and HEAD).  Returns the
+    number of bitmaps written."""
+    if tips is None:
+        tips = commitGraphTips(repo)
+    index = vfBitmapIndex(pack)
+    index.positionsLoad()
+
+    # Oldest first, so that most of the history of a commit is already
+    # covered by the bitmaps of its ancestors
+    selected = bitmapSelect(repo, set(tips), interval)
+    for sha in selected:
+        bits, extra = bitmapReachable(repo, index, [ sha ])
+        if extra:
+            raise Exception("Can't write bitmaps: {0} objects reachable from {1} are not in {2}"
+                            .format(len(extra), sha, os.path.basename(pack.path)))
+        index.bitmaps[sha] = bits
+
+    types = bitmapTypes(repo, pack)
+
+    out = bytearray(BITMAP_HEADER.pack(BITMAP_SIGNATURE, 1, BITMAP_OPT_FULL_DAG,
+                                       len(selected), pack.pack[-20:]))
+    for fmt in (b'commit', b'tree', b'blob', b'tag'):
+        out.extend(ewahEncode(bitsFromPositions(types[fmt])))
+    for sha in selected:
+        out.extend(BITMAP_ENTRY.pack(pack.findPosition(bytes.fromhex(sha)), 0, 0))
+        out.extend(ewahEncode(index.bitmaps[sha]))
+    out.extend(hashlib.sha1(out).digest())
+
+    path = bitmapPath(pack)
+    with open(path + ".lock", "wb") as f:
+        f.write(out)
+        f.flush()
+        os.fsync(f.fileno())
+    # The old one may be mapped: forget it before replacing it
+    if repo.bitmap:
+        repo.bitmap.close()
+    repo.bitmap = None
+    os.replace(path + ".lock", path)
+    return len(selected)
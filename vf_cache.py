@@ -0,0 +1,110 @@
+# vf_cache.py
+# A cache of inflated objects, shared by everything that runs during a
+# command.  Trees, commits and tags are read again and again (ls-tree,
+# status, log, ignore rules...) while blobs are mostly read once, so
+# they get separate budgets: blobs can't push the small, hot objects out.
+#
+# The budget is in bytes of inflated data, read from core.objectCacheLimit
+# in the repository config (with an optional k, m or g suffix).
+import os
+import sys
+import atexit
+import collections
+
+OBJECT_CACHE_DEFAULT = 96 * 1024 * 1024
+
+
+def configSize(value):
+    """Parse a size as written in git config: a number with an optional
+    k, m or g suffix."""
+    value = value.strip().lower()
+    units = {"k": 1024, "m": 1024**2, "g": 1024**3}
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+
+class vfObjectCache(object):
+    """Two LRUs of (fmt, data) keyed by SHA, weighed by len(data)."""
+
+    def __init__(self, limit = OBJECT_CACHE_DEFAULT):
+        self.limit = limit
+        # Blobs get a quarter of the budget, and a single blob may not
+        # take more than a quarter of that.
+        self.blob_limit = limit // 4
+        self.blob_max = self.blob_limit // 4
+        self.meta_limit = limit - self.blob_limit
+
+        self.meta = collections.OrderedDict()
+        self.blobs = collections.OrderedDict()
+        self.meta_size = 0
+        self.blob_size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, sha):
+        for lru in (self.meta, self.blobs):
+            if sha in lru:
+                lru.move_to_end(sha)
+                self.hits += 1
+                return lru[sha]
+        self.misses += 1
+        return None
+
+    def peek(self, sha):
+        """Same as get, without touching the LRU order or counters."""
+        if sha in self.meta:
+            return self.meta[sha]
+        return self.blobs.get(sha)
+
+    def put(self, sha, fmt, data):
+        size = len(data)
+        if fmt == b'blob':
+            if size > self.blob_max or sha in self.blobs:
+                return
+            self.blobs[sha] = (fmt, data)
+            self.blob_size += size
+            while self.blob_size > self.blob_limit:
+                _, (_, old) = self.blobs.popitem(last=False)
+                self.blob_size -= len(old)
+                self.evictions += 1
+        else:
+            if size > self.meta_limit or sha in self.meta:
+                return
+            self.meta[sha] = (fmt, data)
+            self.meta_size += size
+            while self.meta_size > self.meta_limit:
+                _, (_, old) = self.meta.popitem(last=False)
+                self.meta_size -= len(old)
+                self.evictions += 1
+
+    def stats(self):
+        return collections.OrderedDict([
+            ("hits", self.hits),
+            ("misses", self.misses),
+            ("evictions", self.evictions),
+            ("objects", len(self.meta) + len(self.blobs)),
+            ("bytes", self.meta_size + self.blob_size),
+            ("limit", self.limit),
+        ])
+
+
+def objectCacheStatsPrint(cache):
+    print("object cache: " + ", ".join("{0}={1}".format(k, v) for k, v in cache.stats().items()),
+          file=sys.stderr)
+
+
+def repoObjectCache(repo):
+    """The object cache of repo, created on first use.  Set
+    VERFLOW_CACHE_STATS in the environment to print its counters when
+    the command exits."""
+    if repo.object_cache is None:
+        limit = OBJECT_CACHE_DEFAULT
+        if repo.conf is not None and repo.conf.has_option("core", "objectCacheLimit"):
+            limit = configSize(repo.conf.get("core", "objectCacheLimit"))
+        repo.object_cache = vfObjectCache(limit)
+        if os.environ.get("VERFLOW_CACHE_STATS"):
+            atexit.register(objectCacheStatsPrint, repo.object_cache)
+    return repo.object_cache
@@ -0,0 +1,122 @@
+# vf_cacheTree.py
+# The cache tree is an index extension (signature TREE) that remembers,
+# for each directory of the index, the SHA of the tree object it was
+# last written as, and how many index entries it covers.  When a path
+# is added or removed, only the directories above it are invalidated,
+# so a commit only needs to write the trees of directories that
+# changed, and status can skip directories identical to HEAD.
+#
+# Its format is git's: directories in pre-order, each as
+#
+#   <name> \0 <entry count> SP <number of subtrees> \n <20 bytes SHA>
+#
+# where name is relative to the parent (empty for the root) and the SHA
+# is absent when the entry count is -1, meaning invalid.  Like git,
+# subtrees are written shortest name first, then by name.
+import bisect
+
+
+class vfCacheTree(object):
+    __slots__ = ("entry_count", "sha", "subtrees")
+
+    def __init__(self):
+        # -1 when the directory changed since sha was computed
+        self.entry_count = -1
+        self.sha = None
+        # Name -> vfCacheTree
+        self.subtrees = dict()
+
+    def valid(self):
+        return self.entry_count >= 0
+
+
+def cacheTreeParse(data):
+    """Parse the content of a TREE extension.  Returns the root."""
+
+    def parseNode(pos):
+        nul = data.index(b'\x00', pos)
+        name = data[pos:nul].decode("utf8")
+        nl = data.index(b'\n', nul)
+        count, subtrees = data[nul + 1:nl].split(b' ')
+        node = vfCacheTree()
+        node.entry_count = int(count)
+        pos = nl + 1
+        if node.entry_count >= 0:
+            node.sha = data[pos:pos + 20].hex()
+            pos += 20
+        for _ in range(int(subtrees)):
+            child_name, child, pos = parseNode(pos)
+            node.subtrees[child_name] = child
+        return name, node, pos
+
+    return parseNode(0)[1]
+
+
+def cacheTreeSerialize(root):
+    out = bytearray()
+
+    def writeNode(name, node):
+        out.extend(name.encode("utf8") + b'\x00')
+        out.extend("{0} {1}\n".format(node.entry_count, len(node.subtrees)).encode("ascii"))
+        if node.valid():
+            out.extend(bytes.fromhex(node.sha))
+        for child_name in sorted(node.subtrees, key = lambda n: (len(n.encode("utf8")), n.encode("utf8"))):
+            writeNode(child_name, node.subtrees[child_name])
+
+    writeNode("", root)
+    return bytes(out)
+
+
+def cacheTreeRead(index):
+    """The cache tree of index, or an empty (invalid) one."""
+    data = index.extensions.get(b"TREE")
+    if data:
+        return cacheTreeParse(data)
+    return vfCacheTree()
+
+
+def cacheTreeStore(index, root):
+    index.extensions[b"TREE"] = cacheTreeSerialize(root)
+
+
+def cacheTreeInvalidate(root, path):
+    """Invalidate every directory containing path."""
+    node = root
+    node.entry_count = -1
+    for name in path.split("/")[:-1]:
+        node = node.subtrees.get(name)
+        if node is None:
+            return
+        node.entry_count = -1
+
+
+def cacheTreeFind(root, path):
+    """The node of directory path ("" for the root), or None."""
+    node = root
+    for name in path.split("/") if path else []:
+        node = node.subtrees.get(name)
+        if node is None:
+            return None
+    return node
+
+
+def indexLevel(names, prefix, lo, hi):
+    """Split the sorted index names[lo:hi], which all start with prefix,
+    into what's directly in that directory.  Yields (name, i, None) for
+    a file at position i, and (name, lo, hi) for a subdirectory whose
+    entries are names[lo:hi]."""
+    i = lo
+    plen = len(prefix)
+    while i < hi:
+        rest = names[i][plen:]
+        slash = rest.find("/")
+        if slash < 0:
+            yield rest, i, None
+            i += 1
+        else:
+            name = rest[:slash]
+            # All the names starting with "name/" are contiguous, and
+            # "0" is the character right after "/".
+            end = bisect.bisect_left(names, prefix + name + "0", i, hi)
+            yield name, i, end
+            i = end
@@ -0,0 +1,111 @@
+# vf_checkout.py
+# Checkout of a tree into a directory.
+#
+# This happens in two steps: we first walk the trees to plan the
+# checkout (the list of directories, and of blobs with their
+# destination), then create the directories in order, parents first,
+# and finally write the blobs.  Blobs are independent from each other,
+# so with more than one worker they're inflated and written by a pool
+# of processes, each reading the repository on its own.
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from verFlowRepository import vfREPO
+from object import objectRead, objectReadStream
+
+# Number of blobs handed to a worker at once
+CHECKOUT_BATCH = 256
+
+# The repository, in each worker process
+checkout_repo = None
+
+
+def checkoutWorkers(repo, jobs = None):
+    """Number of workers to use: jobs if given, else checkout.workers
+    from the config, else 1.  Less than 1 means one per core."""
+    if jobs is None:
+        jobs = 1
+        if repo.conf is not None and repo.conf.has_option("checkout", "workers"):
+            jobs = repo.conf.getint("checkout", "workers")
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    return jobs
+
+
+def checkoutPlan(repo, tree, path, dirs = None, blobs = None):
+    """Walk tree, returning (dirs, blobs): the directories to create
+    under path, parents first, and the (sha, destination) of every
+    blob.  Only trees are read, types are taken from the modes."""
+    if dirs is None:
+        dirs = list()
+        blobs = list()
+
+    for item in tree.items:
+        dest = os.path.join(path, item.path)
+        kind = int(item.mode, 8) & 0o170000
+        if kind == 0o040000:
+            dirs.append(dest)
+            checkoutPlan(repo, objectRead(repo, item.sha), dest, dirs, blobs)
+        elif kind == 0o160000:
+            # A submodule commit, not in this repo
+            continue
+        else:
+            # @TODO Support symlinks (identified by mode 12****)
+            blobs.append((item.sha, dest))
+    return dirs, blobs
+
+
+def checkoutBlob(repo, sha, dest):
+    # Blobs go straight from the inflater to the file
+    stream = objectReadStream(repo, sha)
+    if stream is None:
+        raise Exception("Missing object {0}".format(sha))
+    _, _, chunks = stream
+    with open(dest, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def checkoutWorkerInit(worktree):
+    global checkout_repo
+    checkout_repo = vfREPO(worktree)
+
+
+def checkoutWorkerBatch(start, batch):
+    """Write a batch of blobs.  Returns the errors as (position in the
+    plan, message), so the parent can report them in a stable order."""
+    errors = list()
+    for i, (sha, dest) in enumerate(batch):
+        try:
+            checkoutBlob(checkout_repo, sha, dest)
+        except Exception as e:
+            errors.append((start + i, "{0}: {1}".format(dest, e)))
+    return errors
+
+
+def treeCheckout(repo, tree, path, workers = 1):
+    """Write the content of tree in the existing directory path."""
+    dirs, blobs = checkoutPlan(repo, tree, path)
+
+    for d in dirs:
+        os.mkdir(d)
+
+    errors = list()
+    if workers <= 1 or len(blobs) <= CHECKOUT_BATCH:
+        for i, (sha, dest) in enumerate(blobs):
+            try:
+                checkoutBlob(repo, sha, dest)
+            except Exception as e:
+                errors.append((i, "{0}: {1}".format(dest, e)))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=checkoutWorkerInit,
+                                 initargs=(repo.worktree,)) as pool:
+            futures = [ pool.submit(checkoutWorkerBatch, start, blobs[start:start + CHECKOUT_BATCH])
+                        for start in range(0, len(blobs), CHECKOUT_BATCH) ]
+            for f in futures:
+                errors.extend(f.result())
+
+    if errors:
+        errors.sort()
+        raise Exception("Checkout failed for {0} file(s):\n - {1}".format(
+            len(errors), "\n - ".join(msg for _, msg in errors)))
@@ -3,6 +3,7 @@ import os
 from object import GitTree, objectWrite
 from verFlowTree import GitTreeLeaf
 from vf_indexFile import vfIndexEntry
+from vf_cacheTree import vfCacheTree, cacheTreeRead, cacheTreeStore, indexLevel
 def vfConfigRead():
     xdg_config_home = os.environ["XDG_CONFIG_HOME"] if "XDG_CONFIG_HOME" in os.environ else "~/.config"
     configfiles = [
@@ -21,59 +22,46 @@ def getUserFromConfig(config):
     return None
 
 def treeFromIndex(repo, index):
-    contents = dict()
-    contents[""] = list()
+    """Write the trees of the index, and return the SHA of the root.
+    Directories still valid in the index's cache tree are not written
+    again: their SHA is reused.  The cache tree is updated on index,
+    which the caller may then write back."""
+    names = index.names()
+    if any(names[i] > names[i+1] for i in range(len(names) - 1)):
+        # We rely on the index being sorted, as git writes it.
+        index.entries = sorted(index.entries, key = lambda e: e.name)
+        names = index.names()
 
-    # Enumerate entries, and turn them into a dictionary where keys
-    # are directories, and values are lists of directory contents.
+    root = cacheTreeRead(index)
+    sha = treeFromIndexLevel(repo, index, names, root, "", 0, len(names))
+    cacheTreeStore(index, root)
+    return sha
 
-    for entry in index.entries:
-        dirname = os.path.dirname(entry.name)
-        # We create all dictonary entries up to root ("").  We need
-        # them *all*, because even if a directory holds no files it
-        # will contain at least a tree.
+def treeFromIndexLevel(repo, index, names, node, prefix, lo, hi):
+    """Write the tree of the directory prefix, whose entries are
+    names[lo:hi], and return its SHA.  node is its cache tree node."""
+    if node.valid() and node.entry_count == hi - lo:
+        return node.sha
 
-        key = dirname
+    tree = GitTree()
+    subtrees = dict()
+    for name, start, end in indexLevel(names, prefix, lo, hi):
+        if end is None: # Regular entry (a file)
+            # We transcode the mode: the entry stores it as integers,
+            # we need an octal ASCII representation for the tree.
+            mode = index.mode(start)
+            leaf_mode = "{:02o}{:04o}".format(mode >> 12, mode & 0o777).encode("ascii")
+            leaf = GitTreeLeaf(mode = leaf_mode,path= name,sha= index.sha(start))
+        else: # A subdirectory: get its SHA first, from the cache or not
+            child = node.subtrees.get(name) or vfCacheTree()
+            subtrees[name] = child
+            sha = treeFromIndexLevel(repo, index, names, child, prefix + name + "/", start, end)
+            leaf = GitTreeLeaf(mode = b"040000", path=name, sha=sha)
+        tree.items.append(leaf)
 
-        while key != "":
-            if not key in contents:
-                contents[key] = list()
-            key = os.path.dirname(key)
-        #simply store the entry in the list.
-        contents[dirname].append(entry)
-
-    # Get keys (= directories) and sort them by length, descending.
-    # This means that we'll always encounter a given path before its
-    # parent, which is all we need, since for each directory D we'll
-    # need to modify its parent P to add D's tree.
-    sorted_paths = sorted(contents.keys(), key = len, reverse= True)
-
-    # This variable will store the current tree's SHA-1.  After we're
-    # done iterating over our dict, it will contain the hash for the
-    # root tree.
-    sha = None
-
-    for path in sorted_paths:
-        tree = GitTree()
-
-        for entry in contents[path]:
-            # An entry can be a normal GitIndexEntry read from the
-            # index, or a tree we've created.
-            if isinstance(entry,  vfIndexEntry): # Regular entry (a file)
-                # We transcode the mode: the entry stores it as integers,
-                # we need an octal ASCII representation for the tree.
-                leaf_mode = "{:02o}{:04o}".format(entry.mode_type, entry.mode_perms).encode("ascii")
-                leaf = GitTreeLeaf(mode = leaf_mode,path= os.path.basename(entry.name),sha= entry.sha)
-            else: # Tree.  We've stored it as a pair: (basename, SHA)
-                leaf = GitTreeLeaf(mode = b"040000", path=entry[0], sha=entry[1])
-            tree.items.append(leaf)
-        # Write the new tree object to the store.
-        sha = objectWrite(tree, repo)
-
-        # Add the new tree hash to the current dictionary's parent, as
-        # a pair (basename, SHA)
-        parent = os.path.dirname(path)
-        base = os.path.basename(path)
-        contents[parent].append((base, sha))
-    
-    return sha
\ No newline at end of file
+    # Write the new tree object to the store.
+    node.sha = objectWrite(tree, repo)
+    node.entry_count = hi - lo
+    # Directories that are gone are dropped from the cache
+    node.subtrees = subtrees
+    return node.sha
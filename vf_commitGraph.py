@@ -0,0 +1,310 @@
+# vf_commitGraph.py
+# The commit-graph file (.ver_flow/objects/info/commit-graph) stores,
+# for every commit reachable from the refs, what history walks need:
+# its parents, root tree, commit date and generation number, so they
+# don't have to inflate and parse each commit.
+#
+# The format is git's (version 1, SHA-1):
+#
+#  - a header: "CGPH", version 1, hash version 1, the number of chunks,
+#    and the number of base graphs (always 0 here);
+#  - the chunk table: (4 bytes id, 8 bytes offset) per chunk, then a
+#    zero id with the offset of the end of the last chunk;
+#  - OIDF: fanout table of 256 counters, as in pack indexes;
+#  - OIDL: the sorted binary SHAs of the commits;
+#  - CDAT: per commit, the root tree SHA, the positions of the first two
+#    parents (GRAPH_PARENT_NONE if absent, or for the second one
+#    GRAPH_EXTRA_EDGES plus a position in EDGE if there are more than
+#    two), then the generation number in the top 30 bits of 4 bytes
+#    whose low 2 bits are the top bits of the 34 bits commit date, and
+#    the low 32 bits of the date;
+#  - EDGE: for octopus merges, the positions of the parents after the
+#    first one, the last one flagged with GRAPH_LAST_EDGE;
+#  - the SHA-1 of everything before.
+#
+# The generation number of a commit is 1 for root commits, and one more
+# than the highest of its parents otherwise: a commit can't be an
+# ancestor of one with a lower generation.
+#
+# Commits not in the graph (made after it was written) are read from
+# the object store, see commitLookup.
+import os
+import mmap
+import struct
+import hashlib
+
+from verFlowRepository import repoPath, repoDir
+from vfRefs import refsTips
+from object import objectReadRaw, objectFind
+
+GRAPH_SIGNATURE = b"CGPH"
+GRAPH_HEADER = struct.Struct(">4sBBBB")
+GRAPH_CHUNK = struct.Struct(">4sQ")
+GRAPH_COMMIT = struct.Struct(">20sIIII")
+
+GRAPH_CHUNK_FANOUT = b"OIDF"
+GRAPH_CHUNK_OIDS = b"OIDL"
+GRAPH_CHUNK_DATA = b"CDAT"
+GRAPH_CHUNK_EDGES = b"EDGE"
+
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+
+GENERATION_MAX = 0x3FFFFFFF
+# Generation of commits we only know from the object store
+GENERATION_INFINITY = 0xFFFFFFFF
+
+
+class vfCommitInfo(object):
+    """What history walks need to know about a commit."""
+    __slots__ = ("sha", "tree", "parents", "date", "generation")
+
+    def __init__(self, sha, tree, parents, date, generation = GENERATION_INFINITY):
+        self.sha = sha
+        self.tree = tree
+        # SHAs, in order
+        self.parents = parents
+        # Committer date, seconds since the epoch
+        self.date = date
+        self.generation = generation
+
+
+class vfCommitGraph(object):
+    """A commit-graph file, mapped in memory."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, hash_version, chunks, bases = GRAPH_HEADER.unpack_from(self.data, 0)
+        if signature != GRAPH_SIGNATURE or version != 1 or hash_version != 1:
+            raise Exception("Unsupported commit-graph {0}".format(path))
+        if bases:
+            raise Exception("Split commit-graphs are not supported: {0}".format(path))
+
+        self.chunks = dict()
+        pos = GRAPH_HEADER.size
+        for _ in range(chunks):
+            chunk_id, offset = GRAPH_CHUNK.unpack_from(self.data, pos)
+            self.chunks[chunk_id] = offset
+            pos += GRAPH_CHUNK.size
+
+        fanout = self.chunks[GRAPH_CHUNK_FANOUT]
+        self.fanout = struct.unpack_from(">256I", self.data, fanout)
+        self.count = self.fanout[255]
+        self.oids = self.chunks[GRAPH_CHUNK_OIDS]
+        self.commits = self.chunks[GRAPH_CHUNK_DATA]
+        self.edges = self.chunks.get(GRAPH_CHUNK_EDGES)
+
+    def close(self):
+        self.data.close()
+
+    def shaAt(self, i):
+        start = self.oids + 20*i
+        return self.data[start:start + 20].hex()
+
+    def findPosition(self, binsha):
+        """Position of binsha in the graph, or None."""
+        first = binsha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.oids + 20*mid
+            cur = self.data[start:start + 20]
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def find(self, sha):
+        return self.findPosition(bytes.fromhex(sha))
+
+    def parentPositions(self, i):
+        _, parent1, parent2, _, _ = GRAPH_COMMIT.unpack_from(self.data, self.commits + GRAPH_COMMIT.size*i)
+        if parent1 == GRAPH_PARENT_NONE:
+            return []
+        if parent2 == GRAPH_PARENT_NONE:
+            return [ parent1 ]
+        if not parent2 & GRAPH_EXTRA_EDGES:
+            return [ parent1, parent2 ]
+        ret = [ parent1 ]
+        pos = self.edges + 4 * (parent2 & ~GRAPH_EXTRA_EDGES)
+        while True:
+            edge = int.from_bytes(self.data[pos:pos + 4], "big")
+            ret.append(edge & ~GRAPH_LAST_EDGE)
+            if edge & GRAPH_LAST_EDGE:
+                return ret
+            pos += 4
+
+    def commitAt(self, i):
+        """The vfCommitInfo of the i-th commit."""
+        tree, _, _, gen_date, date = GRAPH_COMMIT.unpack_from(self.data, self.commits + GRAPH_COMMIT.size*i)
+        return vfCommitInfo(self.shaAt(i),
+                            tree.hex(),
+                            [ self.shaAt(p) for p in self.parentPositions(i) ],
+                            ((gen_date & 0x3) << 32) | date,
+                            gen_date >> 2)
+
+
+def commitGraphPath(repo):
+    return repoPath(repo, "objects", "info", "commit-graph")
+
+
+def commitGraphLoad(repo, reload = False):
+    """The commit-graph of repo, or None if it has none.  It is opened
+    once and kept on the repository object."""
+    if repo.commit_graph is not None and not reload:
+        return repo.commit_graph or None
+    if repo.commit_graph:
+        repo.commit_graph.close()
+
+    path = commitGraphPath(repo)
+    # False: we looked, there is none
+    repo.commit_graph = vfCommitGraph(path) if os.path.exists(path) else False
+    return repo.commit_graph or None
+
+
+def commitParse(sha, data):
+    """Build the vfCommitInfo of a commit from its raw data.  Only the
+    headers are read, not the message."""
+    tree = None
+    parents = list()
+    date = 0
+    for line in data[:data.find(b"\n\n")].split(b"\n"):
+        if line.startswith(b"tree "):
+            tree = line[5:].decode("ascii")
+        elif line.startswith(b"parent "):
+            parents.append(line[7:].decode("ascii"))
+        elif line.startswith(b"committer "):
+            # "<name> <<email>> <timestamp> <timezone>"
+            date = int(line.rsplit(b" ", 2)[1])
+    return vfCommitInfo(sha, tree, parents, date)
+
+
+def commitLookup(repo, sha):
+    """The vfCommitInfo of commit sha, from the commit-graph if it's in
+    there, else from the object store.  Raises if sha isn't a commit."""
+    graph = commitGraphLoad(repo)
+    if graph is not None:
+        pos = graph.find(sha)
+        if pos is not None:
+            return graph.commitAt(pos)
+
+    raw = objectReadRaw(repo, sha)
+    if raw is None:
+        raise Exception("Missing object {0}".format(sha))
+    if raw[0] != b'commit':
+        raise Exception("Not a commit: {0}".format(sha))
+    return commitParse(sha, raw[1])
+
+
+def commitGraphTips(repo):
+    """The commits the refs and HEAD point to, tags peeled."""
+    tips = set()
+    for sha in refsTips(repo):
+        commit = objectFind(repo, sha, fmt = b'commit')
+        if commit:
+            tips.add(commit)
+    return sorted(tips)
+
+
+def commitGraphWrite(repo, tips = None):
+    """Write the commit-graph of every commit reachable from tips (by
+    default, the refs and HEAD).  Returns the number of commits."""
+    if tips is None:
+        tips = commitGraphTips(repo)
+
+    # Walk the history, without recursion: histories can be deep
+    commits = dict()
+    stack = list(tips)
+    while stack:
+        sha = stack.pop()
+        if sha in commits:
+            continue
+        info = commitLookup(repo, sha)
+        commits[sha] = info
+        for p in info.parents:
+            if not p in commits:
+                stack.append(p)
+
+    # Generations: a commit's is known once its parents' are
+    for sha in tips:
+        stack = [ sha ]
+        while stack:
+            info = commits[stack[-1]]
+            if info.generation != GENERATION_INFINITY:
+                stack.pop()
+                continue
+            missing = [ p for p in info.parents if commits[p].generation == GENERATION_INFINITY ]
+            if missing:
+                stack.extend(missing)
+                continue
+            info.generation = min(GENERATION_MAX, 1 + max([ commits[p].generation for p in info.parents ], default = 0))
+            stack.pop()
+
+    order = sorted(commits)
+    positions = dict()
+    for i, sha in enumerate(order):
+        positions[sha] = i
+
+    fanout = [ 0 ] * 256
+    for sha in order:
+        fanout[int(sha[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    oids = bytearray()
+    data = bytearray()
+    edges = bytearray()
+    for sha in order:
+        info = commits[sha]
+        oids.extend(bytes.fromhex(sha))
+        parents = [ positions[p] for p in info.parents ]
+        parent1 = parents[0] if parents else GRAPH_PARENT_NONE
+        if len(parents) < 2:
+            parent2 = GRAPH_PARENT_NONE
+        elif len(parents) == 2:
+            parent2 = parents[1]
+        else:
+            parent2 = GRAPH_EXTRA_EDGES | (len(edges) // 4)
+            for p in parents[1:-1]:
+                edges.extend(p.to_bytes(4, "big"))
+            edges.extend((parents[-1] | GRAPH_LAST_EDGE).to_bytes(4, "big"))
+        date = info.date & 0x3FFFFFFFF
+        data.extend(GRAPH_COMMIT.pack(bytes.fromhex(info.tree), parent1, parent2,
+                                      (info.generation << 2) | (date >> 32), date & 0xFFFFFFFF))
+
+    chunks = [ (GRAPH_CHUNK_FANOUT, struct.pack(">256I", *fanout)),
+               (GRAPH_CHUNK_OIDS, bytes(oids)),
+               (GRAPH_CHUNK_DATA, bytes(data)) ]
+    if edges:
+        chunks.append((GRAPH_CHUNK_EDGES, bytes(edges)))
+
+    out = bytearray(GRAPH_HEADER.pack(GRAPH_SIGNATURE, 1, 1, len(chunks), 0))
+    offset = len(out) + GRAPH_CHUNK.size * (len(chunks) + 1)
+    for chunk_id, chunk in chunks:
+        out.extend(GRAPH_CHUNK.pack(chunk_id, offset))
+        offset += len(chunk)
+    out.extend(GRAPH_CHUNK.pack(b"\x00\x00\x00\x00", offset))
+    for _, chunk in chunks:
+        out.extend(chunk)
+    out.extend(hashlib.sha1(out).digest())
+
+    repoDir(repo, "objects", "info", mkdir = True)
+    path = commitGraphPath(repo)
+    with open(path + ".lock", "wb") as f:
+        f.write(out)
+        f.flush()
+        os.fsync(f.fileno())
+    # The old graph may be mapped: forget it before replacing it
+    if repo.commit_graph:
+        repo.commit_graph.close()
+    repo.commit_graph = None
+    os.replace(path + ".lock", path)
+    return len(order)
@@ -0,0 +1,401 @@
+# vf_fsmonitor.py
+# A filesystem monitor, so that status and add -A don't have to look at
+# every file of a big worktree.
+#
+# The daemon (verFlow fsmonitor) watches every directory of the worktree
+# with Linux inotify, and appends the path of every file that changes to
+# .ver_flow/fsmonitor-journal.  The first line of the journal is an id
+# that changes each time the daemon starts, or when it lost events.  A
+# position in the journal is a token: "<id> <offset>".
+#
+# After a scan, status saves in .ver_flow/fsmonitor-state the token it
+# read before scanning, a fingerprint of the ignore rules, and the paths
+# it found dirty (modified, deleted or untracked).  The next status only
+# needs to look at those paths, plus the ones in the journal after the
+# token.  When the daemon isn't running, the token is stale or the
+# ignore rules changed, we fall back to a full scan.
+#
+# Events reach the daemon, and then the journal, some time after the
+# change: the journal may not have a file written just before status
+# yet.  So, as git does, status first creates a cookie file in
+# .ver_flow/, and waits for the daemon to journal it.  The daemon
+# journals a batch of events in order, so by then everything that
+# happened before the cookie is in the journal.  If the cookie doesn't
+# show up in time, we don't trust the journal and scan everything.
+import os
+import sys
+import bisect
+import ctypes
+import ctypes.util
+import hashlib
+import itertools
+import signal
+import struct
+import tempfile
+import time
+import uuid
+
+from verFlowRepository import repoPath
+from vf_ignore import vfignoreBaseFingerprint
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# The journal is restarted (with a new id) past that size
+JOURNAL_MAX = 64 * 1024 * 1024
+
+# Cookie files are .ver_flow/<prefix><pid>-<n>, journaled as
+# .ver_flow/<name>.  How long we wait for one, in seconds.
+COOKIE_PREFIX = "fsmonitor-cookie-"
+COOKIE_TIMEOUT = 1.0
+cookie_counter = itertools.count()
+
+
+class vfInotify(object):
+    """Minimal inotify binding, through ctypes."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def addWatch(self, path, mask = WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_add_watch failed: {0}".format(os.strerror(err)), path)
+        return wd
+
+    def read(self):
+        """Block until events are available, and return them as a list
+        of (wd, mask, name)."""
+        buf = os.read(self.fd, 256 * 1024)
+        ret = list()
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, pos)
+            pos += INOTIFY_EVENT.size
+            name = buf[pos:pos + length].rstrip(b'\x00')
+            pos += length
+            ret.append((wd, mask, os.fsdecode(name)))
+        return ret
+
+
+def fsmonitorPaths(repo):
+    return (repoPath(repo, "fsmonitor-daemon"),
+            repoPath(repo, "fsmonitor-journal"),
+            repoPath(repo, "fsmonitor-state"))
+
+
+class vfFsmonitorDaemon(object):
+    def __init__(self, repo):
+        self.repo = repo
+        self.daemon_file, self.journal_file, _ = fsmonitorPaths(repo)
+        self.inotify = vfInotify()
+        # Watch descriptor -> directory, relative to the worktree
+        self.watches = dict()
+        self.journal = None
+
+    def journalRestart(self):
+        """Start a new journal with a new id: all tokens become stale."""
+        if self.journal:
+            self.journal.close()
+        self.journal = open(self.journal_file, "w")
+        self.journal.write(uuid.uuid4().hex + "\n")
+        self.journal.flush()
+
+    def watchTree(self, rel, changed = None):
+        """Watch directory rel and everything below it.  If changed is a
+        set, the files found are added to it: they may have been created
+        before the watch was in place."""
+        top = os.path.normpath(os.path.join(self.repo.worktree, rel))
+        for (root, dirs, files) in os.walk(top):
+            if root == self.repo.worktree and ".ver_flow" in dirs:
+                dirs.remove(".ver_flow")
+            root_rel = os.path.relpath(root, self.repo.worktree)
+            if root_rel == ".":
+                root_rel = ""
+            try:
+                self.watches[self.inotify.addWatch(root)] = root_rel
+            except FileNotFoundError:
+                continue
+            if changed is not None:
+                for f in files:
+                    changed.add(os.path.join(root_rel, f))
+
+    def run(self):
+        self.journalRestart()
+        self.watchTree("")
+        # Only for cookies: .ver_flow/ itself changes all the time,
+        # the journal first.
+        self.watches[self.inotify.addWatch(self.repo.gitdir, IN_CREATE)] = ".ver_flow"
+        with open(self.daemon_file, "w") as f:
+            f.write("{0}\n".format(os.getpid()))
+
+        while True:
+            changed = set()
+            cookies = list()
+            for wd, mask, name in self.inotify.read():
+                if mask & IN_Q_OVERFLOW:
+                    # We lost events: nobody can trust their token anymore
+                    self.journalRestart()
+                    changed.clear()
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if not wd in self.watches:
+                    continue
+                if self.watches[wd] == ".ver_flow":
+                    if name.startswith(COOKIE_PREFIX):
+                        cookies.append(".ver_flow/" + name)
+                    continue
+                path = os.path.join(self.watches[wd], name) if name else self.watches[wd]
+                if not path:
+                    continue
+                changed.add(path)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watchTree(path, changed)
+
+            if changed or cookies:
+                # Cookies last: once one can be read, so can the
+                # events that came before it
+                for path in sorted(changed) + cookies:
+                    self.journal.write(path + "\n")
+                self.journal.flush()
+                if self.journal.tell() > JOURNAL_MAX:
+                    self.journalRestart()
+
+
+def fsmonitorDaemonPid(repo):
+    """Pid of the running daemon, or None."""
+    daemon_file = fsmonitorPaths(repo)[0]
+    try:
+        with open(daemon_file, "r") as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        return None
+    return pid
+
+
+def fsmonitorRun(repo):
+    """Run the daemon in the foreground, until it gets SIGTERM."""
+    daemon_file = fsmonitorPaths(repo)[0]
+
+    def stop(signum, frame):
+        if os.path.exists(daemon_file):
+            os.unlink(daemon_file)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        vfFsmonitorDaemon(repo).run()
+    finally:
+        if os.path.exists(daemon_file):
+            os.unlink(daemon_file)
+
+
+def fsmonitorStart(repo):
+    """Start the daemon in the background.  Returns its pid."""
+    pid = fsmonitorDaemonPid(repo)
+    if pid:
+        return pid
+
+    r, w = os.pipe()
+    if os.fork():
+        os.close(w)
+        with os.fdopen(r) as f:
+            return int(f.read() or 0) or None
+
+    # Child: detach, and fork again so the daemon isn't a session leader
+    os.close(r)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    with os.fdopen(w, "w") as f:
+        f.write(str(os.getpid()))
+    try:
+        fsmonitorRun(repo)
+    finally:
+        os._exit(0)
+
+
+def fsmonitorStop(repo):
+    pid = fsmonitorDaemonPid(repo)
+    if pid:
+        os.kill(pid, signal.SIGTERM)
+    return pid
+
+
+def fsmonitorToken(repo):
+    """Current token of the daemon, or None if it isn't running."""
+    if not fsmonitorDaemonPid(repo):
+        return None
+    journal_file = fsmonitorPaths(repo)[1]
+    try:
+        with open(journal_file, "rb") as f:
+            journal_id = f.readline().strip().decode("ascii")
+            # The token must be at the end of a line: the daemon may be
+            # in the middle of writing one.
+            end = f.seek(0, os.SEEK_END)
+            start = max(end - 4096, 0)
+            f.seek(start)
+            end = start + f.read().rfind(b'\n') + 1
+            return "{0} {1}".format(journal_id, end)
+    except FileNotFoundError:
+        return None
+
+
+def fsmonitorSync(repo, timeout = COOKIE_TIMEOUT):
+    """Wait for the daemon to journal every change made until now, by
+    creating a cookie file and waiting for it to be journaled.  Returns
+    the token right after the cookie, or None if the daemon isn't
+    running or didn't journal it within timeout seconds."""
+    start = fsmonitorToken(repo)
+    if start is None:
+        return None
+    start_id, start_offset = start.split(" ")
+    journal_file = fsmonitorPaths(repo)[1]
+
+    name = "{0}{1}-{2}".format(COOKIE_PREFIX, os.getpid(), next(cookie_counter))
+    cookie = repoPath(repo, name)
+    line = (".ver_flow/" + name + "\n").encode()
+    os.close(os.open(cookie, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+    try:
+        deadline = time.monotonic() + timeout
+        delay = 0.0005
+        while True:
+            with open(journal_file, "rb") as f:
+                journal_id = f.readline().strip().decode("ascii")
+                # A restarted journal is read from its start
+                if journal_id == start_id:
+                    f.seek(int(start_offset))
+                pos = f.tell()
+                data = f.read()
+            # Where the cookie's line starts in data, if it's there
+            i = (b"\n" + data).find(b"\n" + line)
+            if i >= 0:
+                return "{0} {1}".format(journal_id, pos + i + len(line))
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+    finally:
+        os.unlink(cookie)
+
+
+def fsmonitorIgnoreFingerprint(repo, index):
+    """Fingerprint of everything the ignore rules come from.  If it
+    changes, files that were ignored may not be anymore."""
+    h = hashlib.sha1()
+    names = index.names()
+    for i, name in enumerate(names):
+        if name == ".vfignore" or name.endswith("/.vfignore"):
+            h.update("{0} {1}\n".format(name, index.sha(i)).encode("utf8"))
+    h.update(vfignoreBaseFingerprint(repo))
+    return h.hexdigest()
+
+
+def fsmonitorChanged(repo, index):
+    """Ask the monitor what may have changed since the last saved state.
+    Returns (token, paths): token is the one to save with
+    fsmonitorSave after the scan (None if no daemon is running), and
+    paths is the set of files to examine, or None if everything must
+    be."""
+    if not fsmonitorDaemonPid(repo):
+        return None, None
+    token = fsmonitorSync(repo)
+    if token is None:
+        # The daemon is behind: what the journal says can't be trusted,
+        # and a full scan from now on is what will be saved
+        return fsmonitorToken(repo), None
+
+    state_file = fsmonitorPaths(repo)[2]
+    journal_file = fsmonitorPaths(repo)[1]
+    try:
+        with open(state_file, "r") as f:
+            state = f.read().split("\n")
+    except FileNotFoundError:
+        return token, None
+
+    saved_token, fingerprint, dirty = state[0], state[1], state[2:]
+    journal_id, offset = saved_token.split(" ")
+    if not token.startswith(journal_id + " ") or fingerprint != fsmonitorIgnoreFingerprint(repo, index):
+        return token, None
+
+    changed = set(p for p in dirty if p)
+    with open(journal_file, "rb") as f:
+        # Read up to the new token: what's after will be seen next time
+        f.seek(int(offset))
+        data = f.read(int(token.split(" ")[1]) - int(offset))
+        changed.update(os.fsdecode(p) for p in data.split(b'\n') if p)
+
+    # A changed directory means anything below it may have changed, if
+    # it was created, moved or removed.
+    names = index.names()
+    if any(names[i] > names[i+1] for i in range(len(names) - 1)):
+        names = sorted(names)
+    paths = set()
+    for path in changed:
+        full = os.path.join(repo.worktree, path)
+        if path.split("/")[0] == ".ver_flow":
+            continue
+        if os.path.isdir(full):
+            for (root, dirs, files) in os.walk(full):
+                root_rel = os.path.relpath(root, repo.worktree)
+                paths.update(os.path.join(root_rel, f) for f in files)
+        else:
+            paths.add(path)
+        prefix = path + "/"
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix):
+            paths.add(names[i])
+            i += 1
+    return token, paths
+
+
+def fsmonitorSave(repo, token, index, dirty):
+    """Record that the worktree was examined as of token, and that only
+    the dirty paths differed from the index."""
+    state_file = fsmonitorPaths(repo)[2]
+    # A temporary file of our own, so that concurrent commands don't
+    # write over each other's.  Failing to save isn't an error: the
+    # next status does a full scan.
+    try:
+        fd, tmp = tempfile.mkstemp(prefix = "fsmonitor-state.", dir = os.path.dirname(state_file))
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(token + "\n")
+            f.write(fsmonitorIgnoreFingerprint(repo, index) + "\n")
+            for path in sorted(dirty):
+                f.write(path + "\n")
+        os.replace(tmp, state_file)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
@@ -21,9 +21,20 @@ from math import ceil
 import re
 import zlib
 
+import json
+import tempfile
+import time
+
+from verFlowRepository import repoPath
 from vf_indexFile import indexRead
 from object import objectRead
 
+# Parsed rules of the ignore files, see vfignoreCacheLoad
+IGNORE_CACHE_FILE = "vfignore-cache"
+IGNORE_CACHE_VERSION = 1
+# Files modified less than that before being read aren't cached
+IGNORE_CACHE_RACY_NS = 1000000000
+
 def vfignoreParse1(raw):
     """From the provided argument raw data checks if the file should be excluded or not.
     If file begins with ! it should be included else excluded. Outputs Data + bool"""
@@ -56,55 +67,303 @@ class vfIgnore (object):
         self.absolute = absolute
         self.scoped = scoped
 
-def vfignoreRead(repo):
-    # what to return? : a vfIgnore class object with list and dict
-    ret = vfIgnore(absolute=list(),scoped=dict())
-
-    # Read local configuration in .git/info/exclude
-    repo_file = os.path.join(repo.gitdir, "info/exclude")
-    if os.path.exists(repo_file):
-        with open(repo_file, "r") as f:
-            ret.absolute.append(vfignoreParse(f.readlines()))
-    
+def vfignoreFiles(repo):
+    """The ignore files that apply to the whole worktree: the
+    repository's info/exclude, and the global ignore file."""
     #Global Ignore config
     if "XDG_CONFIG_HOME" in os.environ:
         config_home = os.environ["XDG_CONFIG_HOME"]
     else:
         config_home = os.path.expanduser("~/.config")
-    global_file = os.path.join(config_home, "ver_flow/ignore")
+    return (os.path.join(repo.gitdir, "info/exclude"),
+            os.path.join(config_home, "ver_flow/ignore"))
+
+
+def vfignoreBaseFingerprint(repo):
+    """SHA-1 of the content of vfignoreFiles.  The .vfignore files come
+    on top of it, see vfignoreDirFingerprint."""
+    h = hashlib.sha1()
+    for path in vfignoreFiles(repo):
+        h.update(path.encode("utf8") + b'\x00')
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                h.update(hashlib.sha1(f.read()).digest())
+    return h.digest()
+
 
+def vfignoreDirFingerprint(parent, sha):
+    """Fingerprint of the rules that apply in a directory: parent is the
+    fingerprint of its parent directory (or vfignoreBaseFingerprint for
+    the root), and sha the SHA of its own .vfignore in the index, or
+    None.  Changing a .vfignore changes the fingerprint of its directory
+    and of everything below it, and nothing else."""
+    return hashlib.sha1(parent + (sha or "").encode("ascii")).digest()
 
-    if os.path.exists(global_file):
-        with open(global_file, "r") as f:
-            ret.absolute.append(vfignoreParse(f.readlines()))
+
+def vfignoreCacheLoad(repo):
+    """The cache of parsed ignore rules, in .ver_flow/vfignore-cache:
+    rules of info/exclude and the global ignore file by path, with the
+    mtime and size of the file they come from, and rules of .vfignore
+    files by blob SHA."""
+    try:
+        with open(repoPath(repo, IGNORE_CACHE_FILE), "r") as f:
+            cache = json.load(f)
+        if cache.get("version") == IGNORE_CACHE_VERSION:
+            return cache
+    except (OSError, ValueError):
+        pass
+    return { "version": IGNORE_CACHE_VERSION, "files": dict(), "blobs": dict() }
+
+
+def vfignoreCacheSave(repo, cache):
+    """Save cache, if we can: it's only a cache.  Each process writes
+    its own temporary file, so that concurrent commands don't write
+    over each other's, and the last rename wins."""
+    path = repoPath(repo, IGNORE_CACHE_FILE)
+    try:
+        fd, tmp = tempfile.mkstemp(prefix = IGNORE_CACHE_FILE + ".", dir = os.path.dirname(path))
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def vfignoreRead(repo, index = None):
+    """Read the ignore rules of repo: info/exclude, the global ignore
+    file and the .vfignore files of index (read if not given).  Parsed
+    rules are cached on disk, so when nothing changed neither the files
+    nor the object store are read."""
+    # what to return? : a vfIgnore class object with list and dict
+    ret = vfIgnore(absolute=list(),scoped=dict())
+    cache = vfignoreCacheLoad(repo)
+    changed = False
+
+    # Read local configuration in .git/info/exclude, then the global one
+    for path in vfignoreFiles(repo):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            if cache["files"].pop(path, None) is not None:
+                changed = True
+            continue
+        key = [ stat.st_mtime_ns, stat.st_size ]
+        cached = cache["files"].get(path)
+        if cached is not None and cached[:2] == key:
+            rules = cached[2]
+        else:
+            with open(path, "r") as f:
+                rules = vfignoreParse(f.readlines())
+            # A file modified right now may be modified again without
+            # its mtime changing: don't trust it.
+            if time.time_ns() - stat.st_mtime_ns >= IGNORE_CACHE_RACY_NS:
+                cache["files"][path] = key + [ rules ]
+                changed = True
+        ret.absolute.append(vfIgnoreRules([ tuple(rule) for rule in rules ]))
 
     # .gitignore files in the index
-    index = indexRead(repo)
-    for entry in index.entries:
-        if entry.name == ".vfignore" or entry.name.endswith("/.vfignore"):
-            dir_name = os.path.dirname(entry.name)
-            contents = objectRead(repo, entry.sha)
-            lines = contents.blobdata.decode("utf8").splitlines()
-            ret.scoped[dir_name] = vfignoreParse(lines)
+    if index is None:
+        index = indexRead(repo)
+    blobs = dict()
+    for i, name in enumerate(index.names()):
+        if name == ".vfignore" or name.endswith("/.vfignore"):
+            sha = index.sha(i)
+            rules = cache["blobs"].get(sha)
+            if rules is None:
+                contents = objectRead(repo, sha)
+                lines = contents.blobdata.decode("utf8").splitlines()
+                rules = vfignoreParse(lines)
+            blobs[sha] = rules
+            ret.scoped[os.path.dirname(name)] = vfIgnoreRules([ tuple(rule) for rule in rules ])
+
+    # Only keep the blobs still in use
+    if blobs.keys() != cache["blobs"].keys():
+        cache["blobs"] = blobs
+        changed = True
+    if changed:
+        vfignoreCacheSave(repo, cache)
     return ret
 
 
-def checkIgnoreHelper(rules,path):
-    """Matches a path against a set of rules, and return the result of the last matching rule. Its not a real boolean functions, since it has three possible return values: True, False but also None. It returns None if nothing matched, so that it should continue trying with more general ignore files (eg, go one directory level up)."""
-    result = None
+def vfignoreTranslate(pattern):
+    """Translate a glob pattern into a regex, following git: "*" and "?"
+    don't match "/", and "**" matches across directories in "**/x",
+    "x/**" and "x/**/y"."""
+    out = list()
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*" and pattern[i:i+2] == "**" and (i == 0 or pattern[i-1] == "/") and (i + 2 == n or pattern[i+2] == "/"):
+            if i + 2 == n:
+                # Trailing "/**": everything inside
+                out.append(".*")
+            else:
+                # Leading "**/" or inner "/**/": zero or more directories
+                out.append("(?:.*/)?")
+                i += 1
+            i += 2
+        elif c == "*":
+            while i < n and pattern[i] == "*":
+                i += 1
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            j = pattern.find("]", j)
+            if j < 0:
+                out.append(re.escape(c))
+                i += 1
+            else:
+                chars = pattern[i+1:j]
+                negate = chars[:1] in ("!", "^")
+                if negate:
+                    chars = chars[1:]
+                cls = list()
+                k = 0
+                while k < len(chars):
+                    if chars[k] == "\\" and k + 1 < len(chars):
+                        k += 1
+                        cls.append(re.escape(chars[k]))
+                    elif chars[k] == "-":
+                        cls.append("-")
+                    else:
+                        cls.append(re.escape(chars[k]))
+                    k += 1
+                out.append("(?!/)[{0}{1}]".format("^" if negate else "", "".join(cls)))
+                i = j + 1
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(pattern[i+1]))
+            i += 2
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return "".join(out)
+
+
+def vfignoreRegex(alternatives):
+    # Python returns the first alternative that matches: put the last
+    # rules first, so we get the last matching rule.
+    if not alternatives:
+        return None
+    return re.compile("|".join("(?P<r{0}>{1})".format(idx, regex) for idx, regex in reversed(alternatives)))
+
+
+class vfIgnoreRules(object):
+    """The rules of one ignore file, compiled.
+
+    As in git, a pattern with a slash (other than a trailing one) is
+    anchored to the directory of the ignore file, and matched against
+    the whole path relative to it.  A pattern without one matches at
+    any depth, so against the basename only.  Those are split further:
+    plain names ("build", ".DS_Store") and "*.ext" patterns, the most
+    common ones, are looked up in dicts, all the others are joined in a
+    few regexes: one per first character of the name, or first directory
+    of the path, when the pattern starts with a literal one, and one for
+    the rest.  Patterns ending with "/" only match directories, so
+    everything exists twice: for any path, and for directories."""
+
+    def __init__(self, rules):
+        # As parsed by vfignoreParse: (pattern, excluded)
+        self.rules = rules
+        self.values = [ excluded for _, excluded in rules ]
+        # Each table maps to the index of the last rule it comes from
+        self.names = (dict(), dict())
+        self.suffixes = (dict(), dict())
+        # Key ("" when the pattern doesn't start with a literal) ->
+        # list of (rule index, regex)
+        name_regex = (dict(), dict())
+        path_regex = (dict(), dict())
+
+        for idx, (pattern, excluded) in enumerate(rules):
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if not pattern:
+                continue
+            # Rules for anything are also rules for directories
+            kinds = (1,) if dir_only else (0, 1)
+            if "/" in pattern:
+                pattern = pattern.lstrip("/")
+                first = pattern.split("/")[0]
+                key = "" if any(c in first for c in "*?[\\") else first
+                regex = vfignoreTranslate(pattern)
+                for k in kinds:
+                    path_regex[k].setdefault(key, list()).append((idx, regex))
+            elif not any(c in pattern for c in "*?[\\"):
+                for k in kinds:
+                    self.names[k][pattern] = idx
+            elif (pattern.startswith("*.") and
+                  not any(c in pattern[2:] for c in "*?[\\.")):
+                for k in kinds:
+                    self.suffixes[k][pattern[1:]] = idx
+            else:
+                key = "" if pattern[0] in "*?[\\" else pattern[0]
+                regex = vfignoreTranslate(pattern)
+                for k in kinds:
+                    name_regex[k].setdefault(key, list()).append((idx, regex))
 
-    for pattern,value in rules:
-        if fnmatch(path,pattern):
-            result = value
-    return result
+        self.name_regex = tuple(dict((key, vfignoreRegex(r)) for key, r in table.items())
+                                for table in name_regex)
+        self.path_regex = tuple(dict((key, vfignoreRegex(r)) for key, r in table.items())
+                                for table in path_regex)
 
+    def match(self, path, is_dir = False):
+        """Result of the last rule matching path (relative to the
+        directory of the ignore file): True if excluded, False if
+        included back, None if no rule matched."""
+        k = 1 if is_dir else 0
+        name = path[path.rfind("/") + 1:]
+        best = self.names[k].get(name, -1)
 
-def checkIgnoreScoped(rules,path):
+        suffixes = self.suffixes[k]
+        if suffixes:
+            dot = name.rfind(".")
+            if dot >= 0:
+                best = max(best, suffixes.get(name[dot:], -1))
+
+        candidates = list()
+        table = self.name_regex[k]
+        if table:
+            candidates.append((table.get(name[:1]), name))
+            candidates.append((table.get(""), name))
+        table = self.path_regex[k]
+        if table:
+            candidates.append((table.get(path.split("/", 1)[0]), path))
+            candidates.append((table.get(""), path))
+        for regex, subject in candidates:
+            if regex is not None:
+                m = regex.fullmatch(subject)
+                if m is not None:
+                    best = max(best, int(m.lastgroup[1:]))
+
+        return self.values[best] if best >= 0 else None
+
+
+def checkIgnoreHelper(rules, path, is_dir = False):
+    """Matches a path against a set of rules, and return the result of the last matching rule. Its not a real boolean functions, since it has three possible return values: True, False but also None. It returns None if nothing matched, so that it should continue trying with more general ignore files (eg, go one directory level up)."""
+    return rules.match(path, is_dir)
+
+
+def checkIgnoreScoped(rules, path, is_dir = False):
+    # Rules of a .vfignore apply to paths relative to its directory
     parent = os.path.dirname(path)
 
     while True:
         if parent in rules:
-            result = checkIgnoreHelper(rules[parent], path)
+            relpath = path[len(parent) + 1:] if parent else path
+            result = checkIgnoreHelper(rules[parent], relpath, is_dir)
             if result != None:
                 return result
         if parent == "":
@@ -113,21 +372,22 @@ def checkIgnoreScoped(rules,path):
     
     return None
 
-def checkIgnoreAbsolute(rules, path):
-    parent = os.path.dirname(path)
+def checkIgnoreAbsolute(rules, path, is_dir = False):
     for ruleset in rules:
-        result = checkIgnoreHelper(ruleset, path)
+        result = checkIgnoreHelper(ruleset, path, is_dir)
         if result != None:
             return result
     return False # This is a reasonable default at this point
 
 
-def checkIgnore(rules, path):
+def checkIgnore(rules, path, is_dir = False):
+    """Whether path is ignored.  is_dir tells if it is a directory,
+    which patterns ending with "/" only match."""
     if os.path.isabs(path):
         raise Exception("This function requires path to be relative to the repository's root")
 
-    result = checkIgnoreScoped(rules.scoped, path)
+    result = checkIgnoreScoped(rules.scoped, path, is_dir)
     if result != None:
         return result
 
-    return checkIgnoreAbsolute(rules.absolute, path)
\ No newline at end of file
+    return checkIgnoreAbsolute(rules.absolute, path, is_dir)
@@ -10,11 +10,18 @@ import hashlib
 from math import ceil
 import re
 import zlib
+import mmap
+import struct
+from array import array
 
 from verFlowRepository import repoFile
 
 
 class vfIndexEntry (object):
+    __slots__ = ("ctime", "mtime", "dev", "ino", "mode_type", "mode_perms",
+                 "uid", "gid", "fsize", "sha", "flag_assume_valid",
+                 "flag_stage", "name")
+
     def __init__(self,ctime = None, mtime = None, dev = None, ino = None,
                  mode_type = None,mode_perms = None, uid = None, gid = None,
                  fsize = None, sha = None, flag_assume_valid = None,
@@ -47,22 +54,158 @@ class vfIndexEntry (object):
       # Name of the object (full path this time!)
       self.name = name
 
+
+
+def indexEntryFromStat(name, sha, stat):
+   """Build the index entry of a regular file from its os.stat result."""
+   return vfIndexEntry(ctime=(int(stat.st_ctime), stat.st_ctime_ns % 10**9),
+                       mtime=(int(stat.st_mtime), stat.st_mtime_ns % 10**9),
+                       dev=stat.st_dev, ino=stat.st_ino,
+                       mode_type=0b1000, mode_perms=0o644,
+                       uid=stat.st_uid, gid=stat.st_gid,
+                       fsize=stat.st_size, sha=sha,
+                       flag_assume_valid=False, flag_stage=False, name=name)
+
+
+def indexEntryStatMatches(entry, stat):
+   """True if the file described by stat looks unchanged since entry
+   was recorded, in which case it doesn't need to be hashed again.
+   Like git, only the low 32 bits of the fields are stored."""
+   mask = 0xFFFFFFFF
+   return (entry.mtime[0] & mask == int(stat.st_mtime) & mask
+           and entry.mtime[1] == stat.st_mtime_ns % 10**9
+           and entry.ctime[0] & mask == int(stat.st_ctime) & mask
+           and entry.ctime[1] == stat.st_ctime_ns % 10**9
+           and entry.fsize & mask == stat.st_size & mask
+           and entry.ino & mask == stat.st_ino & mask)
+
+    
+# Fixed part of an index entry: ctime (s, ns), mtime (s, ns), dev, ino,
+# mode (16 unused bits then the mode), uid, gid, size, binary SHA, flags.
+# The path name follows, null terminated and padded to 8 bytes.
+INDEX_ENTRY = struct.Struct(">10I20sH")
+INDEX_HEADER = struct.Struct(">4sII")
+INDEX_EXT_HEADER = struct.Struct(">4sI")
+# Entries parsed before being moved to the columns
+INDEX_BATCH = 4096
+
+# Names of the columns holding the stat data of entries
+INDEX_STAT_COLUMNS = ("ctime_s", "ctime_ns", "mtime_s", "mtime_ns", "dev",
+                      "ino", "mode", "uid", "gid", "fsize")
+
     
+class vfIndexColumns (object):
+   """The entries of an index file as parallel arrays, one per field.
+   This is a lot smaller and faster to build than one vfIndexEntry per
+   file; entries are only materialized when asked for."""
+   __slots__ = INDEX_STAT_COLUMNS + ("shas", "flags", "names")
+
+   def __init__(self):
+      for col in INDEX_STAT_COLUMNS:
+         setattr(self, col, array("I"))
+      # Binary SHAs, 20 bytes each, back to back
+      self.shas = bytearray()
+      self.flags = array("H")
+      self.names = list()
+
+   def __len__(self):
+      return len(self.names)
+
+   def sha(self, i):
+      return self.shas[20*i : 20*i + 20].hex()
+
+   def statMatches(self, i, stat):
+      """Same as indexEntryStatMatches, for the i-th entry."""
+      mask = 0xFFFFFFFF
+      return (self.mtime_s[i] == int(stat.st_mtime) & mask
+              and self.mtime_ns[i] == stat.st_mtime_ns % 10**9
+              and self.ctime_s[i] == int(stat.st_ctime) & mask
+              and self.ctime_ns[i] == stat.st_ctime_ns % 10**9
+              and self.fsize[i] == stat.st_size & mask
+              and self.ino[i] == stat.st_ino & mask)
+
+   def entry(self, i):
+      mode = self.mode[i]
+      flags = self.flags[i]
+      return vfIndexEntry(ctime=(self.ctime_s[i], self.ctime_ns[i]),
+                          mtime=(self.mtime_s[i], self.mtime_ns[i]),
+                          dev=self.dev[i],
+                          ino=self.ino[i],
+                          mode_type=mode >> 12,
+                          mode_perms=mode & 0b0000000111111111,
+                          uid=self.uid[i],
+                          gid=self.gid[i],
+                          fsize=self.fsize[i],
+                          sha=self.sha(i),
+                          flag_assume_valid=(flags & 0b1000000000000000) != 0,
+                          flag_stage=flags & 0b0011000000000000,
+                          name=self.names[i])
+
+
 class vfIndex (object):
    version = None
-   entries = []
+   # indexFileStat of the file it was read from, see indexWrite
+   file_stat = None
 
    #ext = None
    #sha = None
 
-   def __init__(self, version = 2, entries = None) -> None:
+   def __init__(self, version = 2, entries = None, columns = None, extensions = None) -> None:
       
-      if not entries:
+      if not entries and columns is None:
          entries = list()
 
       self.version = version
-      self.entries = entries
-
+      # Either entries is a list of vfIndexEntry, or it is built from
+      # the columns the first time it's used.
+      self._entries = entries
+      self.columns = columns
+      # Extensions we don't handle are kept as they are: an ordered
+      # dict of signature -> raw data.
+      if extensions is None:
+         extensions = collections.OrderedDict()
+      self.extensions = extensions
+
+   @property
+   def entries(self):
+      if self._entries is None:
+         self._entries = [ self.columns.entry(i) for i in range(len(self.columns)) ]
+      return self._entries
+
+   @entries.setter
+   def entries(self, entries):
+      # The caller is replacing the entries: columns are stale now.
+      self._entries = entries
+      self.columns = None
+
+   def __len__(self):
+      if self._entries is None:
+         return len(self.columns)
+      return len(self._entries)
+
+   def names(self):
+      """Names of all entries, without materializing them."""
+      if self._entries is None:
+         return self.columns.names
+      return [ e.name for e in self._entries ]
+
+   def sha(self, i):
+      """SHA of the i-th entry, without materializing it."""
+      if self._entries is None:
+         return self.columns.sha(i)
+      return self._entries[i].sha
+
+   def mode(self, i):
+      """Mode of the i-th entry, type and permissions together."""
+      if self._entries is None:
+         return self.columns.mode[i]
+      e = self._entries[i]
+      return (e.mode_type << 12) | e.mode_perms
+
+   def statMatches(self, i, stat):
+      if self._entries is None:
+         return self.columns.statMatches(i, stat)
+      return indexEntryStatMatches(self._entries[i], stat)
 
 
 def indexRead(repo):
@@ -71,80 +214,61 @@ def indexRead(repo):
    index_file_path = repoFile(repo, "index")
 
     # A new repo won't have an index file
-   if not os.path.exists(index_file_path):
-       return vfIndex()
-    # Read the contents of the file
-   with open(index_file_path, 'rb') as f:
-       raw = f.read()
+   if not os.path.exists(index_file_path) or os.path.getsize(index_file_path) == 0:
+       index = vfIndex()
+       index.file_stat = indexFileStat(index_file_path)
+       return index
 
-   header = raw[:12]
-   signature = header[:4]
+   with open(index_file_path, 'rb') as f:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+         with memoryview(m) as raw:
+            index = indexParse(raw)
+      index.file_stat = indexFileStat(f)
+   return index
+
+
+def indexFileStat(file):
+   """What tells an index file from the next one written: (inode, size,
+   mtime), or None if there is none.  file is a path or an open file."""
+   try:
+      st = os.fstat(file.fileno()) if hasattr(file, "fileno") else os.stat(file)
+   except FileNotFoundError:
+      return None
+   return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def indexParse(raw):
+   """Parse the content of an index file, a bytes-like object."""
+   signature, version, count = INDEX_HEADER.unpack_from(raw, 0)
    assert  signature == b"DIRC" #stands for Dir Cache
-   version = int.from_bytes(header[4:8],"big")
    assert version == 2, "verflow currently only supports index file version 2"
-   count = int.from_bytes(header[8:12],"big")
 
-   entries = list()
-   # content of the index file
-   content = raw[12:]
-   idx = 0
+   columns = vfIndexColumns()
+   names = columns.names
+   rows = list()
+   unpack = INDEX_ENTRY.unpack_from
+   entry_size = INDEX_ENTRY.size
+   idx = INDEX_HEADER.size
+   size = len(raw)
+
+   def flushRows():
+      # Turn the rows parsed so far into columns.  This is done by
+      # batches, so that we never hold a tuple per entry.
+      fields = list(zip(*rows))
+      for col, values in zip(INDEX_STAT_COLUMNS, fields):
+         getattr(columns, col).extend(values)
+      columns.shas += b''.join(fields[10])
+      columns.flags.extend(fields[11])
+      rows.clear()
 
    for i in range(0,count):
-        # Read creation time, as a unix timestamp (seconds since
-        # 1970-01-01 00:00:00, the "epoch")
-
-      ctime_s =  int.from_bytes(content[idx: idx+4], "big")
-        # Read creation time, as nanoseconds after that timestamps,
-        # for extra precision.
-      ctime_ns = int.from_bytes(content[idx+4: idx+8], "big")
-
-        # Same for modification time: first seconds from epoch.
-
-      mtime_s = int.from_bytes(content[idx+8 : idx + 12], "big")
-        # Then extra nanoseconds
-      mtime_ns = int.from_bytes(content[idx+12 : idx + 16], "big")
-
-        # Device ID
-      dev = int.from_bytes(content[idx+16 : idx + 20], "big")
-        # Inode
-      ino = int.from_bytes(content[idx+20: idx+24], "big")
-        # Ignored.
-      unused = int.from_bytes(content[idx+24: idx+26], "big")
-
-      assert 0 == unused
-
-      mode = int.from_bytes(content[idx+26: idx+28], "big")
-
-      mode_type = mode >> 12
-
-        #validate mode is one of the possible modes
-        
-      assert mode_type in [0b1000, 0b1010, 0b1110]
-
-      mode_perms = mode & 0b0000000111111111
-
-        # user ID
-      uid = int.from_bytes(content[idx+28 : idx+32],"big")
-
-        #group ID
-      gid = int.from_bytes(content[idx+32 : idx+36],"big")
-
-        #File Size
-      fsize = int.from_bytes(content[idx+36 : idx + 40],"big")
-
-        #SHA (object ID) Store it as lowercase hex for consistency accross source code
-      sha = format(int.from_bytes(content[idx+40 : idx+60],"big"),"040x")
-
-        #Flags ? Ignore for now
-      flags = int.from_bytes(content[idx+60 : idx+62],"big")
-
-        #Parse Flags
-      flag_assume_valid = (flags & 0b1000000000000000) != 0
-      flag_extended = (flags & 0b0100000000000000) != 0
-
-      assert not flag_extended
-
-      flag_stage = flags & 0b0011000000000000
+      if idx + entry_size > size:
+         raise Exception("Malformed index: truncated")
+      fields = unpack(raw, idx)
+      rows.append(fields)
+      if len(rows) == INDEX_BATCH:
+         flushRows()
+      flags = fields[11]
 
         # Length of the name.  This is stored on 12 bits, some max
         # value is 0xFFF, 4095.  Since names can occasionally go
@@ -152,109 +276,121 @@ def indexRead(repo):
         # 0xFFF, and looks for the final 0x00 to find the end of the
         # name --- at a small, and probably very rare, performance
         # cost.
-
       name_length = flags & 0b0000111111111111
-
-        #We've read 62 bytes so far from index file
-
-      idx+=62
+      idx += entry_size
       if name_length < 0xFFF:
-         assert content[idx+name_length] == 0x00
-         raw_name = content[idx : idx + name_length]
-         idx += name_length + 1
+         if idx + name_length >= size:
+            raise Exception("Malformed index: truncated")
+         assert raw[idx+name_length] == 0x00
+         end = idx + name_length
       else:
-         print("Notice: Name is 0x{:X} bytes long.".format(name_length))
-            # This probably wasn't tested enough.  It works with a
-            # path of exactly 0xFFF bytes.  Any extra bytes broke
-            # something between git, my shell and my filesystem.
-         null_idx = content.find(b'\x00', idx + 0xFFF)
-         raw_name = content[idx: null_idx]
-         idx = null_idx + 1
-
+         end = bytes(raw[idx + 0xFFF:]).find(b'\x00')
+         if end < 0:
+            raise Exception("Malformed index: truncated")
+         end += idx + 0xFFF
       # Just parse the name as utf8
-      name = raw_name.decode("utf8")
-      # Data is padded on multiples of eight bytes for pointer
-      # alignment, so we skip as many bytes as we need for the next
-      # read to start at the right position.
-
-      idx = 8 * ceil(idx/8)
-
-      entries.append(vfIndexEntry(ctime=(ctime_s, ctime_ns),
-                                     mtime=(mtime_s,  mtime_ns),
-                                     dev=dev,
-                                     ino=ino,
-                                     mode_type=mode_type,
-                                     mode_perms=mode_perms,
-                                     uid=uid,
-                                     gid=gid,
-                                     fsize=fsize,
-                                     sha=sha,
-                                     flag_assume_valid=flag_assume_valid,
-                                     flag_stage=flag_stage,
-                                     name=name))
-      
-   return vfIndex(version = version, entries = entries)
-
-
-def indexWrite(repo, index):
-    with open(repoFile(repo, "index"), "wb") as f:
-        # HEADER
-        # TYPE
-        f.write(b"DIRC")
-        
-        # VERSION
-        f.write(index.version.to_bytes(4, "big"))
-        
-        # Write the number of entries.
-        f.write(len(index.entries).to_bytes(4, "big"))
-
-        # ENTRIES
-        idx = 0
-        for e in index.entries:
-            f.write(e.ctime[0].to_bytes(4, "big"))
-            f.write(e.ctime[1].to_bytes(4, "big"))
-            f.write(e.mtime[0].to_bytes(4, "big"))
-            f.write(e.mtime[1].to_bytes(4, "big"))
-            f.write(e.dev.to_bytes(4, "big"))
-            f.write(e.ino.to_bytes(4, "big"))
-            
-            # MODE
-            mode = (e.mode_type << 12) | e.mode_perms
-            f.write(mode.to_bytes(4, "big"))
-            
-            # UID
-            f.write(e.uid.to_bytes(4, "big"))
-            
-            # GID
-            f.write(e.gid.to_bytes(4, "big"))
-            
-            # FILE SIZE
-            f.write(e.fsize.to_bytes(4, "big"))
-            
-            # SHA
-            f.write(int(e.sha, 16).to_bytes(20, "big"))
-            
-            # FLAGS
-            flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
-            name_bytes = e.name.encode("utf8")
-            bytes_len = len(name_bytes)
-            if bytes_len > 0xFFF:
-                name_length = 0xFFF
-            else:
-                name_length = bytes_len
-            
-            # FLAGS - write the flags field
-            flags = (flag_assume_valid | e.flag_stage | name_length) & 0xFFFF
-            f.write(flags.to_bytes(2, "big"))
-            
-            # Write the name
-            f.write(name_bytes)
-            f.write((0).to_bytes(1, "big"))
-            
-            idx += 62 + len(name_bytes) + 1
-            # Null bytes padding to ensure that the entry is a multiple of 8 bytes
-            if idx % 8 != 0:
-              pad = 8 - (idx % 8)
-              f.write((0).to_bytes(pad, "big"))
-              idx += pad
+      names.append(str(raw[idx:end], "utf8"))
 
+      # Data is padded on multiples of eight bytes for pointer
+      # alignment.  Since the header is 12 bytes, an entry always
+      # takes 1 to 8 null bytes after its name.
+      idx += ((end - idx + entry_size) // 8 + 1) * 8 - entry_size
+
+   if rows:
+      flushRows()
+
+   # The unused half of the mode must be zero, and the type valid
+   for mode in set(columns.mode):
+      assert mode >> 12 in [0b1000, 0b1010, 0b1110]
+   # Extended flags are a version 3 thing
+   assert not any(f & 0b0100000000000000 for f in columns.flags)
+
+   # What follows the entries are the extensions, then the SHA-1 of
+   # everything before it.  Indexes written by older versions of
+   # verFlow have neither.
+   extensions = collections.OrderedDict()
+   end = len(raw)
+   if idx < end:
+      if end - idx < 20:
+         raise Exception("Malformed index: truncated")
+      if hashlib.sha1(raw[:end - 20]).digest() != raw[end - 20:end]:
+         raise Exception("Malformed index: bad checksum")
+      while idx < end - 20:
+         sig, size = INDEX_EXT_HEADER.unpack_from(raw, idx)
+         idx += INDEX_EXT_HEADER.size
+         extensions[bytes(sig)] = bytes(raw[idx:idx + size])
+         idx += size
+
+   return vfIndex(version = version, columns = columns, extensions = extensions)
+
+
+def indexWrite(repo, index, if_able = False):
+   """Write index in one go, with its extensions and checksum.  It is
+   written to index.lock first, then renamed, so that readers never see
+   a half written index.  index.lock is created exclusively: if another
+   process holds it, that fails.
+
+   With if_able, used to save what is only a cache, the index isn't
+   written, and no error raised, if index.lock is held or the index was
+   changed since index was read: we'd overwrite that change with a stale
+   copy.  Returns whether the index was written."""
+   mask = 0xFFFFFFFF
+   buf = bytearray(INDEX_HEADER.pack(b"DIRC", index.version, len(index)))
+   pack = INDEX_ENTRY.pack
+
+   def entryPad(name_bytes):
+      # Null bytes padding to ensure that the entry is a multiple of 8 bytes
+      length = INDEX_ENTRY.size + len(name_bytes)
+      return bytes((length // 8 + 1) * 8 - length)
+
+   if index._entries is None:
+      # Nothing materialized: write straight from the columns
+      c = index.columns
+      for i, name in enumerate(c.names):
+         name_bytes = name.encode("utf8")
+         flags = (c.flags[i] & 0xF000) | min(len(name_bytes), 0xFFF)
+         buf += pack(c.ctime_s[i], c.ctime_ns[i], c.mtime_s[i], c.mtime_ns[i],
+                     c.dev[i], c.ino[i], c.mode[i], c.uid[i], c.gid[i], c.fsize[i],
+                     bytes(c.shas[20*i : 20*i + 20]), flags)
+         buf += name_bytes
+         buf += entryPad(name_bytes)
+   else:
+      for e in index.entries:
+         name_bytes = e.name.encode("utf8")
+         flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
+         flags = (flag_assume_valid | e.flag_stage | min(len(name_bytes), 0xFFF)) & 0xFFFF
+         buf += pack(e.ctime[0] & mask, e.ctime[1], e.mtime[0] & mask, e.mtime[1],
+                     e.dev & mask, e.ino & mask, (e.mode_type << 12) | e.mode_perms,
+                     e.uid & mask, e.gid & mask, e.fsize & mask,
+                     bytes.fromhex(e.sha), flags)
+         buf += name_bytes
+         buf += entryPad(name_bytes)
+
+   for sig, data in index.extensions.items():
+      buf += INDEX_EXT_HEADER.pack(sig, len(data))
+      buf += data
+
+   buf += hashlib.sha1(buf).digest()
+
+   path = repoFile(repo, "index")
+   try:
+      fd = os.open(path + ".lock", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+   except FileExistsError:
+      if if_able:
+         return False
+      raise Exception("Unable to create {0}.lock: File exists.  Another verFlow process "
+                      "seems to be running, or one crashed: remove it if so".format(path))
+   try:
+      if if_able and indexFileStat(path) != index.file_stat:
+         os.close(fd)
+         os.unlink(path + ".lock")
+         return False
+      with os.fdopen(fd, "wb") as f:
+         f.write(buf)
+      os.replace(path + ".lock", path)
+   except BaseException:
+      if os.path.exists(path + ".lock"):
+         os.unlink(path + ".lock")
+      raise
+   index.file_stat = indexFileStat(path)
+   return True
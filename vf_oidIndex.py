@@ -0,0 +1,127 @@
+# vf_oidIndex.py
+# Looking up objects by SHA prefix, and abbreviating SHAs.
+#
+# Objects are loose, in objects/xx/ where xx are the first two hex
+# digits of their SHA, or in packs, whose .idx have the sorted SHAs.  A
+# prefix of at least two digits falls in a single objects/xx directory:
+# its listing is read once, sorted, and kept on the repository, along
+# with the mtime of the directory.  A directory's mtime changes when an
+# object is added or removed in it, so a listing is only read again
+# when that happened.  Packs are binary searched.
+#
+# The abbreviation of a SHA is its shortest prefix that no other object
+# starts with, and not shorter than the default length.  It only
+# depends on the SHAs right before and after it in each sorted source.
+import os
+import time
+import bisect
+
+from verFlowRepository import repoPath
+from vf_pack import packsLoad
+
+# Below this, git doesn't abbreviate, whatever the number of objects
+ABBREV_MIN = 4
+ABBREV_DEFAULT = 7
+
+# A directory modified less than that before we list it may be modified
+# again within the same mtime tick: its listing isn't trusted next time.
+OID_RACY_NS = 1000000000
+
+
+class vfOidIndex(object):
+    """The loose SHAs of the repository, per objects/xx directory."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        # "xx" -> (mtime_ns, sorted list of full hex SHAs), mtime_ns
+        # None if the listing can't be trusted
+        self.loose = dict()
+        # Directory listings done, for stats
+        self.listed = 0
+
+    def looseDir(self, first):
+        """The sorted loose SHAs starting with the two hex digits first."""
+        path = repoPath(self.repo, "objects", first)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        cached = self.loose.get(first)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        listed = time.time_ns()
+        self.listed += 1
+        names = sorted(first + f for f in os.listdir(path) if len(f) == 38)
+        self.loose[first] = (mtime if listed - mtime >= OID_RACY_NS else None, names)
+        return names
+
+    def prefixMatch(self, prefix):
+        """The SHAs of all the objects starting with the lower case hex
+        prefix, sorted.  prefix has at least two digits."""
+        names = self.looseDir(prefix[:2])
+        ret = set()
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix):
+            ret.add(names[i])
+            i += 1
+        for pack in packsLoad(self.repo):
+            ret.update(pack.prefixMatch(prefix))
+        return sorted(ret)
+
+    def neighbours(self, sha):
+        """The SHAs right before and after sha in each source, other
+        than sha itself."""
+        ret = list()
+        names = self.looseDir(sha[:2])
+        i = bisect.bisect_left(names, sha)
+        if i > 0:
+            ret.append(names[i - 1])
+        if i < len(names) and names[i] == sha:
+            i += 1
+        if i < len(names):
+            ret.append(names[i])
+        # Neighbours in another objects/xx directory share no prefix
+        # longer than one digit: that's below ABBREV_MIN anyway.
+        binsha = bytes.fromhex(sha)
+        for pack in packsLoad(self.repo):
+            ret.extend(other.hex() for other in pack.neighbours(binsha))
+        return ret
+
+
+def oidIndex(repo):
+    """The vfOidIndex of repo, made once and kept on it."""
+    if repo.oid_index is None:
+        repo.oid_index = vfOidIndex(repo)
+    return repo.oid_index
+
+
+def oidAbbrevLength(repo):
+    """core.abbrev if set, else git's default: at least 7, and more for
+    big repositories, enough to expect no collision among the (packed)
+    objects."""
+    if repo.conf is not None and repo.conf.has_option("core", "abbrev"):
+        value = repo.conf.get("core", "abbrev")
+        if value == "no":
+            return 40
+        if value != "auto":
+            return max(ABBREV_MIN, min(40, int(value)))
+
+    count = sum(pack.count for pack in packsLoad(repo))
+    # With 2^bits objects, collisions are expected at bits / 2, and a
+    # hex digit is 4 bits
+    return max(ABBREV_DEFAULT, (count.bit_length() + 1) // 2)
+
+
+def oidAbbrev(repo, sha, length = None):
+    """The shortest prefix of sha, at least length long (by default,
+    oidAbbrevLength), that no other object of repo starts with."""
+    if length is None:
+        length = oidAbbrevLength(repo)
+    length = max(length, ABBREV_MIN)
+    for other in oidIndex(repo).neighbours(sha):
+        common = 0
+        while common < 40 and sha[common] == other[common]:
+            common += 1
+        length = max(length, common + 1)
+    return sha[:min(length, 40)]
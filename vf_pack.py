@@ -0,0 +1,661 @@
+# vf_pack.py
+# Packfiles store many objects in a single file, instead of one zlib
+# file per object under objects/xx/yyyy.  They live in
+# .ver_flow/objects/pack as pairs of files:
+#
+#  - pack-<sha>.pack: a "PACK" header, then every object as a small
+#    type/size header followed by zlib data.  An object can be stored
+#    whole, or as a delta against another object (its "base"), either
+#    by offset inside the same pack (OFS_DELTA) or by SHA (REF_DELTA).
+#
+#  - pack-<sha>.idx (version 2): a fanout table of 256 counters (the
+#    number of objects whose first SHA byte is <= i), the sorted table
+#    of binary SHAs, a CRC32 per object, and the 4 byte offset of each
+#    object in the pack (with a table of 8 byte offsets for big packs).
+#
+# The format is the same as git's, so packs written by git can be read
+# here and the other way around.
+import os
+import sys
+import mmap
+import array
+import zlib
+import hashlib
+import tempfile
+
+from verFlowRepository import repoDir
+from vf_cache import repoObjectCache
+
+# Object types as stored in the pack entry header
+PACK_OBJ_COMMIT = 1
+PACK_OBJ_TREE = 2
+PACK_OBJ_BLOB = 3
+PACK_OBJ_TAG = 4
+PACK_OBJ_OFS_DELTA = 6
+PACK_OBJ_REF_DELTA = 7
+
+PACK_TYPE_TO_FMT = {
+    PACK_OBJ_COMMIT: b'commit',
+    PACK_OBJ_TREE: b'tree',
+    PACK_OBJ_BLOB: b'blob',
+    PACK_OBJ_TAG: b'tag',
+}
+FMT_TO_PACK_TYPE = {v: k for k, v in PACK_TYPE_TO_FMT.items()}
+
+IDX_MAGIC = b'\xfftOc'
+
+
+def deltaApply(base, delta):
+    """Rebuild an object from its base and a delta in git's format:
+    two varints (source and target sizes) followed by copy and insert
+    instructions."""
+
+    def readSize(pos):
+        size = shift = 0
+        while True:
+            c = delta[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+            if not c & 0x80:
+                return pos, size
+
+    pos, src_size = readSize(0)
+    pos, dst_size = readSize(pos)
+    if src_size != len(base):
+        raise Exception("Delta base size mismatch: {0} != {1}".format(src_size, len(base)))
+
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy from base.  The low 7 bits of op tell which of the
+            # 4 offset bytes and 3 size bytes follow.
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out += base[offset:offset + size]
+        elif op:
+            # Insert the next op bytes literally
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise Exception("Invalid delta opcode 0")
+
+    if len(out) != dst_size:
+        raise Exception("Delta result size mismatch: {0} != {1}".format(len(out), dst_size))
+    return bytes(out)
+
+
+# Size of the chunks produced when inflating as a stream
+INFLATE_CHUNK = 1024 * 1024
+
+
+def inflateStream(read):
+    """Inflate a zlib stream, yielding chunks of at most INFLATE_CHUNK
+    bytes.  read(n) returns the next compressed bytes, or b'' at the
+    end of the input."""
+    d = zlib.decompressobj()
+    while not d.eof:
+        data = d.unconsumed_tail or read(INFLATE_CHUNK)
+        if not data:
+            raise Exception("Truncated zlib stream")
+        out = d.decompress(data, INFLATE_CHUNK)
+        if out:
+            yield out
+
+
+# Delta creation indexes the base by blocks of that many bytes.
+DELTA_BLOCK = 16
+# Largest size a single copy instruction is allowed to cover.
+DELTA_MAX_COPY = 0x10000
+
+
+def deltaSizeEncode(size):
+    ret = bytearray()
+    while True:
+        c = size & 0x7f
+        size >>= 7
+        if size:
+            ret.append(c | 0x80)
+        else:
+            ret.append(c)
+            return ret
+
+
+def deltaCreate(base, target, max_size=None):
+    """Compute a delta turning base into target, in the format read by
+    deltaApply.  The base is indexed by blocks of DELTA_BLOCK bytes;
+    matches found in the target are extended as far as possible and
+    emitted as copies, everything else as inserts.  Returns None if the
+    delta would be bigger than max_size."""
+    index = dict()
+    for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(base[i:i + DELTA_BLOCK], i)
+
+    out = deltaSizeEncode(len(base)) + deltaSizeEncode(len(target))
+    insert = bytearray()
+
+    def flushInsert():
+        for j in range(0, len(insert), 127):
+            chunk = insert[j:j + 127]
+            out.append(len(chunk))
+            out.extend(chunk)
+        insert.clear()
+
+    def emitCopy(offset, size):
+        while size:
+            chunk = min(size, DELTA_MAX_COPY)
+            op = 0x80
+            args = bytearray()
+            for k in range(4):
+                b = (offset >> (8 * k)) & 0xff
+                if b:
+                    op |= 1 << k
+                    args.append(b)
+            # A size of 0x10000 is encoded as no size bytes at all
+            chunk_size = chunk if chunk != 0x10000 else 0
+            for k in range(3):
+                b = (chunk_size >> (8 * k)) & 0xff
+                if b:
+                    op |= 0x10 << k
+                    args.append(b)
+            out.append(op)
+            out.extend(args)
+            offset += chunk
+            size -= chunk
+
+    n = len(target)
+    blen = len(base)
+    i = 0
+    while i < n:
+        offset = index.get(target[i:i + DELTA_BLOCK]) if i + DELTA_BLOCK <= n else None
+        if offset is None:
+            insert.append(target[i])
+            i += 1
+            if max_size and len(out) + len(insert) > max_size:
+                return None
+            continue
+
+        # Extend the match forward, a block at a time then byte by byte
+        length = DELTA_BLOCK
+        while (i + length + DELTA_BLOCK <= n and offset + length + DELTA_BLOCK <= blen and
+               target[i + length:i + length + DELTA_BLOCK] == base[offset + length:offset + length + DELTA_BLOCK]):
+            length += DELTA_BLOCK
+        while i + length < n and offset + length < blen and target[i + length] == base[offset + length]:
+            length += 1
+        # And backward, eating the pending insert
+        while insert and offset > 0 and base[offset - 1] == insert[-1]:
+            insert.pop()
+            offset -= 1
+            i -= 1
+            length += 1
+
+        flushInsert()
+        emitCopy(offset, length)
+        i += length
+        if max_size and len(out) > max_size:
+            return None
+
+    flushInsert()
+    if max_size and len(out) > max_size:
+        return None
+    return bytes(out)
+
+
+class vfPack(object):
+    """A pack file and its v2 index, both mapped in memory."""
+
+    def __init__(self, path):
+        # path is the .pack file; the index sits next to it.
+        self.path = path
+        self.idx_path = path[:-5] + ".idx"
+
+        with open(self.idx_path, "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.path, "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.idx[0:4] != IDX_MAGIC or int.from_bytes(self.idx[4:8], "big") != 2:
+            raise Exception("Unsupported pack index {0}".format(self.idx_path))
+        if self.pack[0:4] != b'PACK':
+            raise Exception("Not a pack file {0}".format(self.path))
+
+        self.fanout = [int.from_bytes(self.idx[8 + 4*i: 12 + 4*i], "big") for i in range(256)]
+        self.count = self.fanout[255]
+        # Offsets of the tables that follow the fanout in the index
+        self.sha_table = 8 + 256*4
+        self.crc_table = self.sha_table + 20 * self.count
+        self.ofs_table = self.crc_table + 4 * self.count
+        self.large_ofs_table = self.ofs_table + 4 * self.count
+        # See packOrder
+        self.pack_order = None
+
+    def close(self):
+        self.idx.close()
+        self.pack.close()
+
+    def shaAt(self, i):
+        """Binary SHA of the i-th object, in index order."""
+        start = self.sha_table + 20*i
+        return self.idx[start:start + 20]
+
+    def findPosition(self, binsha):
+        """Index position of binsha, or None.  The fanout table narrows
+        the search to the objects sharing the first byte."""
+        first = binsha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = self.shaAt(mid)
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def neighbours(self, binsha):
+        """The binary SHAs right before and after binsha in the index,
+        other than binsha itself."""
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.shaAt(mid) < binsha:
+                lo = mid + 1
+            else:
+                hi = mid
+        ret = list()
+        if lo > 0:
+            ret.append(self.shaAt(lo - 1))
+        if lo < self.count and self.shaAt(lo) == binsha:
+            lo += 1
+        if lo < self.count:
+            ret.append(self.shaAt(lo))
+        return ret
+
+    def offsetAt(self, i):
+        start = self.ofs_table + 4*i
+        offset = int.from_bytes(self.idx[start:start + 4], "big")
+        if offset & 0x80000000:
+            # The MSB means this is an index in the 8 bytes offsets table
+            start = self.large_ofs_table + 8 * (offset & 0x7fffffff)
+            offset = int.from_bytes(self.idx[start:start + 8], "big")
+        return offset
+
+    def packOrder(self):
+        """Index positions of the objects in the order they are in the
+        pack (by offset), and the reverse: the pack position of each
+        index position.  That's the order of bits in bitmaps.  Computed
+        once."""
+        if self.pack_order is None:
+            # The whole offset table at once, much faster than offsetAt
+            offsets = array.array("I", self.idx[self.ofs_table:self.ofs_table + 4*self.count])
+            if sys.byteorder == "little":
+                offsets.byteswap()
+            if offsets and max(offsets) & 0x80000000:
+                offsets = [ self.offsetAt(i) for i in range(self.count) ]
+            order = sorted(range(self.count), key = offsets.__getitem__)
+            positions = array.array("I", bytes(4 * self.count))
+            for pos, i in enumerate(order):
+                positions[i] = pos
+            self.pack_order = (order, positions)
+        return self.pack_order
+
+    def find(self, sha):
+        """Offset of hex sha inside the pack, or None."""
+        pos = self.findPosition(bytes.fromhex(sha))
+        if pos is None:
+            return None
+        return self.offsetAt(pos)
+
+    def prefixMatch(self, prefix):
+        """All hex SHAs in this pack that start with the hex prefix."""
+        # The lowest SHA that could match is the prefix padded with zeros
+        low = bytes.fromhex((prefix + "0" * 40)[:40])
+        first = low[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.shaAt(mid) < low:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        ret = list()
+        while lo < self.count:
+            sha = self.shaAt(lo).hex()
+            if not sha.startswith(prefix):
+                break
+            ret.append(sha)
+            lo += 1
+        return ret
+
+    def entryHeader(self, offset):
+        """Parse the entry header at offset.  Returns (type, size,
+        position of the data, base) where base is the base offset for
+        OFS_DELTA, the base hex SHA for REF_DELTA and None otherwise."""
+        pack = self.pack
+        c = pack[offset]
+        pos = offset + 1
+        type = (c >> 4) & 0x7
+        size = c & 0x0f
+        shift = 4
+        while c & 0x80:
+            c = pack[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+
+        base = None
+        if type == PACK_OBJ_OFS_DELTA:
+            # Offset encoding adds one at each continuation so that
+            # every value has a single representation.
+            c = pack[pos]
+            pos += 1
+            rel = c & 0x7f
+            while c & 0x80:
+                c = pack[pos]
+                pos += 1
+                rel = ((rel + 1) << 7) | (c & 0x7f)
+            base = offset - rel
+        elif type == PACK_OBJ_REF_DELTA:
+            base = pack[pos:pos + 20].hex()
+            pos += 20
+        return type, size, pos, base
+
+    def inflate(self, pos, size):
+        """Inflate the zlib stream starting at pos, expected to produce
+        size bytes."""
+        d = zlib.decompressobj()
+        out = list()
+        got = 0
+        chunk = max(size, 4096) + 64
+        while not d.eof:
+            data = self.pack[pos:pos + chunk]
+            if not data:
+                break
+            buf = d.decompress(data)
+            got += len(buf)
+            out.append(buf)
+            pos += len(data)
+        ret = b''.join(out)
+        if got != size:
+            raise Exception("Malformed pack entry in {0}: bad length".format(self.path))
+        return ret
+
+    def headerAt(self, offset, resolve=None):
+        """Type and size of the object at offset, as (fmt, size), without
+        inflating it.  For deltas, the type is that of the base at the
+        end of the chain, and the size is read from the first bytes of
+        the delta.  resolve(sha) gives (fmt, size) of REF_DELTA bases
+        that are not in this pack."""
+        type, size, pos, base = self.entryHeader(offset)
+
+        if type in PACK_TYPE_TO_FMT:
+            return PACK_TYPE_TO_FMT[type], size
+
+        if type == PACK_OBJ_OFS_DELTA:
+            fmt = self.headerAt(base, resolve)[0]
+        elif type == PACK_OBJ_REF_DELTA:
+            base_offset = self.find(base)
+            if base_offset is not None:
+                fmt = self.headerAt(base_offset, resolve)[0]
+            else:
+                found = resolve(base) if resolve else None
+                if found is None:
+                    raise Exception("Missing delta base {0} in {1}".format(base, self.path))
+                fmt = found[0]
+        else:
+            raise Exception("Unknown pack object type {0} in {1}".format(type, self.path))
+
+        # The delta starts with two varints: base size, then result size.
+        # 20 bytes are always enough for both.
+        d = zlib.decompressobj()
+        delta = b''
+        while len(delta) < 20 and not d.eof:
+            if d.unconsumed_tail:
+                data = d.unconsumed_tail
+            else:
+                data = self.pack[pos:pos + 64]
+                pos += len(data)
+            if not data:
+                break
+            delta += d.decompress(data, 20 - len(delta))
+
+        i = 0
+        for _ in range(2):
+            size = shift = 0
+            while True:
+                c = delta[i]
+                i += 1
+                size |= (c & 0x7f) << shift
+                shift += 7
+                if not c & 0x80:
+                    break
+        return fmt, size
+
+    def streamAt(self, offset, resolve=None):
+        """Same as readAt, but return (fmt, size, chunks) where chunks
+        iterates over the data.  Whole objects are inflated a chunk at a
+        time; deltas need their base in memory anyway, so they are
+        rebuilt entirely and returned as a single chunk."""
+        type, size, pos, base = self.entryHeader(offset)
+
+        if not type in PACK_TYPE_TO_FMT:
+            fmt, data = self.readAt(offset, resolve)
+            return fmt, len(data), iter([data])
+
+        def read(n):
+            nonlocal pos
+            data = self.pack[pos:pos + n]
+            pos += len(data)
+            return data
+
+        return PACK_TYPE_TO_FMT[type], size, inflateStream(read)
+
+    def readBase(self, offset, resolve=None, cache=None):
+        """readAt for delta bases, going through cache (a
+        vf_cache.vfObjectCache) so that reading objects along a
+        delta chain doesn't rebuild the whole chain every time."""
+        if cache is None:
+            return self.readAt(offset, resolve)
+        key = (self.path, offset)
+        ret = cache.get(key)
+        if ret is None:
+            ret = self.readAt(offset, resolve, cache)
+            cache.put(key, *ret)
+        return ret
+
+    def readAt(self, offset, resolve=None, cache=None):
+        """Read the object at offset, resolving deltas.  Returns (fmt,
+        data).  resolve(sha) is called for REF_DELTA bases that are
+        not in this pack and must return (fmt, data) or None."""
+        type, size, pos, base = self.entryHeader(offset)
+
+        if type in PACK_TYPE_TO_FMT:
+            return PACK_TYPE_TO_FMT[type], self.inflate(pos, size)
+
+        if type == PACK_OBJ_OFS_DELTA:
+            fmt, base_data = self.readBase(base, resolve, cache)
+        elif type == PACK_OBJ_REF_DELTA:
+            base_offset = self.find(base)
+            if base_offset is not None:
+                fmt, base_data = self.readBase(base_offset, resolve, cache)
+            else:
+                found = resolve(base) if resolve else None
+                if found is None:
+                    raise Exception("Missing delta base {0} in {1}".format(base, self.path))
+                fmt, base_data = found
+        else:
+            raise Exception("Unknown pack object type {0} in {1}".format(type, self.path))
+
+        return fmt, deltaApply(base_data, self.inflate(pos, size))
+
+
+def packsLoad(repo, reload=False):
+    """Return the list of packs of repo.  They are opened once and kept
+    on the repository object for the rest of the command."""
+    if repo.packs is not None and not reload:
+        return repo.packs
+
+    if repo.packs:
+        for p in repo.packs:
+            p.close()
+
+    packs = list()
+    path = repoDir(repo, "objects", "pack")
+    if path:
+        for f in sorted(os.listdir(path)):
+            if f.endswith(".pack") and os.path.exists(os.path.join(path, f[:-5] + ".idx")):
+                packs.append(vfPack(os.path.join(path, f)))
+    repo.packs = packs
+    return packs
+
+
+def packRead(repo, sha, resolve=None):
+    """Look up sha in every pack of repo.  Returns (fmt, data) or None."""
+    for pack in packsLoad(repo):
+        offset = pack.find(sha)
+        if offset is not None:
+            return pack.readAt(offset, resolve, repoObjectCache(repo))
+    return None
+
+
+def packReadHeader(repo, sha, resolve=None):
+    """Same as packRead, but only return (fmt, size), or None."""
+    for pack in packsLoad(repo):
+        offset = pack.find(sha)
+        if offset is not None:
+            return pack.headerAt(offset, resolve)
+    return None
+
+
+def packReadStream(repo, sha, resolve=None):
+    """Same as packRead, but return (fmt, size, chunks) or None."""
+    for pack in packsLoad(repo):
+        offset = pack.find(sha)
+        if offset is not None:
+            return pack.streamAt(offset, resolve)
+    return None
+
+
+def packContains(repo, sha):
+    for pack in packsLoad(repo):
+        if pack.findPosition(bytes.fromhex(sha)) is not None:
+            return True
+    return False
+
+
+def packEntryHeader(type, size):
+    """Encode the type and inflated size of a pack entry."""
+    c = (type << 4) | (size & 0x0f)
+    size >>= 4
+    ret = bytearray()
+    while size:
+        ret.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    ret.append(c)
+    return ret
+
+
+def packOfsEncode(rel):
+    """Encode the distance to an OFS_DELTA base."""
+    ret = bytearray([rel & 0x7f])
+    rel >>= 7
+    while rel:
+        rel -= 1
+        ret.insert(0, 0x80 | (rel & 0x7f))
+        rel >>= 7
+    return ret
+
+
+def packWrite(repo, entries):
+    """Write a pack and its index in objects/pack.  entries is an
+    iterable of (sha, fmt, data, base_sha) in which base_sha is None
+    for whole objects, and otherwise data is a delta against base_sha.
+    A base must come before its deltas.  Returns the path of the new
+    pack."""
+    path = repoDir(repo, "objects", "pack", mkdir=True)
+    offsets = dict()
+    crcs = dict()
+
+    fd, tmp_pack = tempfile.mkstemp(dir=path, prefix="tmp_pack_")
+    with os.fdopen(fd, "wb") as f:
+        # Count is unknown until the end: leave it empty and patch it
+        f.write(b'PACK' + (2).to_bytes(4, "big") + bytes(4))
+        pos = 12
+        for sha, fmt, data, base in entries:
+            if base is None:
+                header = packEntryHeader(FMT_TO_PACK_TYPE[fmt], len(data))
+            else:
+                header = packEntryHeader(PACK_OBJ_OFS_DELTA, len(data)) + packOfsEncode(pos - offsets[base])
+            raw = bytes(header) + zlib.compress(data)
+            f.write(raw)
+            offsets[sha] = pos
+            crcs[sha] = zlib.crc32(raw)
+            pos += len(raw)
+
+    # Fix the object count and append the checksum of the whole file
+    with open(tmp_pack, "r+b") as f:
+        f.seek(8)
+        f.write(len(offsets).to_bytes(4, "big"))
+        f.seek(0)
+        h = hashlib.sha1()
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+        pack_sha = h.digest()
+        f.write(pack_sha)
+        f.flush()
+        os.fsync(f.fileno())
+
+    shas = sorted(offsets.keys())
+    idx = bytearray(IDX_MAGIC + (2).to_bytes(4, "big"))
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[0:2], 16)] += 1
+    total = 0
+    for i in range(256):
+        total += fanout[i]
+        idx += total.to_bytes(4, "big")
+    for sha in shas:
+        idx += bytes.fromhex(sha)
+    for sha in shas:
+        idx += crcs[sha].to_bytes(4, "big")
+    large = list()
+    for sha in shas:
+        offset = offsets[sha]
+        if offset < 0x80000000:
+            idx += offset.to_bytes(4, "big")
+        else:
+            idx += (0x80000000 | len(large)).to_bytes(4, "big")
+            large.append(offset)
+    for offset in large:
+        idx += offset.to_bytes(8, "big")
+    idx += pack_sha
+    idx += hashlib.sha1(idx).digest()
+
+    name = os.path.join(path, "pack-" + pack_sha.hex())
+    with open(name + ".idx.tmp", "wb") as f:
+        f.write(idx)
+        f.flush()
+        os.fsync(f.fileno())
+    # The pack goes in place first: an .idx without its pack is ignored
+    os.replace(tmp_pack, name + ".pack")
+    os.replace(name + ".idx.tmp", name + ".idx")
+    return name + ".pack"
@@ -0,0 +1,239 @@
+# vf_renames.py
+# Rename and copy detection over the changes of a tree diff.
+#
+# A file deleted (the source) and one added (the destination) with the
+# same content, or a similar one, are shown as a rename.  With copies,
+# a destination may also come from a file that was modified, or from a
+# deleted one already renamed.
+#
+# Comparing every source with every destination would be quadratic in
+# their number, and in their size.  Instead:
+#
+#  - files with the same SHA are paired first, without reading them;
+#  - the others get a sketch, computed once per blob and kept by SHA: a
+#    histogram of the hashes of their chunks (lines, cut at
+#    RENAME_CHUNK bytes) weighed by their size in bytes.  How similar
+#    two files are is the number of bytes of chunks they share, over
+#    the size of the bigger one, as git estimates it;
+#  - sources are indexed by chunk hash, so each destination only looks
+#    at the sources sharing chunks with it, through chunks that aren't
+#    common to many sources (blank lines, braces...): those would make
+#    everything a candidate.  Only the `candidates` sources sharing the
+#    most bytes are scored.
+import os
+
+from object import objectReadRaw
+from vf_treeDiff import vfTreeChange, MODE_TYPE
+
+# Chunks end at newlines, or after that many bytes
+RENAME_CHUNK = 64
+# Chunks in more sources than that don't suggest candidates
+RENAME_COMMON = 32
+# Defaults: minimum similarity in percent, and sources scored per
+# destination (diff.renameCandidates in the config)
+RENAME_THRESHOLD = 50
+RENAME_CANDIDATES = 10
+
+# Modes that can be renamed: regular files and symlinks
+RENAME_TYPES = (0o100000, 0o120000)
+
+
+def renameSketch(data):
+    """(size, histogram) of data: chunk hash -> bytes in those chunks."""
+    hist = dict()
+    lines = data.split(b"\n")
+    last = len(lines) - 1
+    for i, line in enumerate(lines):
+        # All but the last one had a newline
+        size = len(line) + (i != last)
+        if not size:
+            continue
+        if size <= RENAME_CHUNK:
+            key = hash(line)
+            hist[key] = hist.get(key, 0) + size
+            continue
+        for start in range(0, len(line), RENAME_CHUNK):
+            piece = line[start:start + RENAME_CHUNK]
+            key = hash(piece)
+            hist[key] = hist.get(key, 0) + len(piece)
+        if i != last:
+            hist[0] = hist.get(0, 0) + 1
+    return len(data), hist
+
+
+def renameSketchOf(repo, sha):
+    """The sketch of blob sha, computed once and kept on repo."""
+    if repo.sketch_cache is None:
+        repo.sketch_cache = dict()
+    sketch = repo.sketch_cache.get(sha)
+    if sketch is None:
+        raw = objectReadRaw(repo, sha)
+        if raw is None:
+            raise Exception("Missing object {0}".format(sha))
+        sketch = renameSketch(raw[1])
+        repo.sketch_cache[sha] = sketch
+    return sketch
+
+
+def renameScore(one, two):
+    """Similarity of two sketches, in percent."""
+    (size_one, hist_one), (size_two, hist_two) = one, two
+    if len(hist_one) > len(hist_two):
+        hist_one, hist_two = hist_two, hist_one
+    shared = 0
+    for key, count in hist_one.items():
+        other = hist_two.get(key)
+        if other:
+            shared += count if count < other else other
+    return shared * 100 // max(size_one, size_two)
+
+
+def renameThresholdParse(value):
+    """Parse a similarity threshold the way git does: "60%" is 60%, and
+    digits without "%" are a fraction, "6" and "60" both being 60%."""
+    if value.endswith("%"):
+        score = int(value[:-1])
+    elif value.isdigit():
+        score = int(value) * 100 // 10 ** len(value)
+    else:
+        raise Exception("Invalid similarity threshold: {0}".format(value))
+    return min(score, 100)
+
+
+def renameConfig(repo):
+    """The number of candidates to score per destination, from the
+    config, or the default."""
+    if repo.conf is not None and repo.conf.has_option("diff", "renameCandidates"):
+        return repo.conf.getint("diff", "renameCandidates")
+    return RENAME_CANDIDATES
+
+
+def diffRenames(repo, changes, copies = False, threshold = RENAME_THRESHOLD, candidates = None):
+    """Detect renames, and with copies copies, among changes (a list of
+    vfTreeChange).  Returns the changes with each destination found
+    turned into an "R" or "C" change, in its place, and the deleted
+    files it came from dropped.  A deleted file that became several
+    ones is copied to all of them but the last, renamed to that one."""
+    if candidates is None:
+        candidates = renameConfig(repo)
+
+    def renamable(mode):
+        return mode & MODE_TYPE in RENAME_TYPES
+
+    sources = [ c for c in changes
+                if (c.status == "D" or (copies and c.status == "M")) and renamable(c.old_mode) ]
+    dests = [ i for i, c in enumerate(changes) if c.status == "A" and renamable(c.new_mode) ]
+    if not sources or not dests:
+        return changes
+
+    # Destination position -> (score, source)
+    found = dict()
+    used = set()
+
+    def basename(path):
+        return os.path.basename(path)
+
+    # Same content: no need to read anything
+    by_sha = dict()
+    for source in sources:
+        by_sha.setdefault(source.old_sha, []).append(source)
+    for i in dests:
+        dest = changes[i]
+        same = [ s for s in by_sha.get(dest.new_sha, ())
+                 if s.old_mode & MODE_TYPE == dest.new_mode & MODE_TYPE ]
+        if not copies:
+            same = [ s for s in same if not id(s) in used ]
+        if not same:
+            continue
+        # Unused deleted files first, then those with the same name
+        same.sort(key = lambda s: (id(s) in used or s.status != "D",
+                                   basename(s.path) != basename(dest.path)))
+        found[i] = (100, same[0])
+        used.add(id(same[0]))
+
+    # Similar content, for what's left
+    if copies:
+        remaining = sources
+    else:
+        remaining = [ s for s in sources if not id(s) in used ]
+    todo = [ i for i in dests if not i in found ]
+    if remaining and todo:
+        for i, score, source in renameSimilar(repo, changes, remaining, todo, threshold, candidates):
+            if i in found:
+                continue
+            if id(source) in used and not copies:
+                continue
+            found[i] = (score, source)
+            used.add(id(source))
+
+    # How many destinations each deleted file went to: the last one is
+    # the rename, the others copies
+    uses = dict()
+    for score, source in found.values():
+        if source.status == "D":
+            uses[id(source)] = uses.get(id(source), 0) + 1
+
+    ret = list()
+    for i, change in enumerate(changes):
+        if change.status == "D" and id(change) in uses:
+            continue
+        if not i in found:
+            ret.append(change)
+            continue
+        score, source = found[i]
+        status = "C"
+        if source.status == "D":
+            uses[id(source)] -= 1
+            if not uses[id(source)]:
+                status = "R"
+        ret.append(vfTreeChange(status, change.path, source.old_mode, change.new_mode,
+                                source.old_sha, change.new_sha, source.path, score))
+    return ret
+
+
+def renameSimilar(repo, changes, sources, dests, threshold, candidates):
+    """(destination position, score, source) for the pairs of sources
+    and changes[dests] at least threshold similar, best first.  Each
+    destination is only scored against its candidates."""
+    source_sketches = [ renameSketchOf(repo, s.old_sha) for s in sources ]
+
+    # Chunk hash -> [ (source position, bytes) ]
+    chunks = dict()
+    for n, (size, hist) in enumerate(source_sketches):
+        for key, count in hist.items():
+            chunks.setdefault(key, []).append((n, count))
+
+    pairs = list()
+    for i in dests:
+        dest = changes[i]
+        sketch = renameSketchOf(repo, dest.new_sha)
+        size, hist = sketch
+        if not size:
+            continue
+
+        # Bytes shared with each source, through uncommon chunks
+        votes = dict()
+        for key, count in hist.items():
+            holders = chunks.get(key)
+            if holders is None or len(holders) > RENAME_COMMON:
+                continue
+            for n, other in holders:
+                votes[n] = votes.get(n, 0) + (count if count < other else other)
+        best = sorted(votes, key = votes.get, reverse = True)[:candidates]
+
+        for n in best:
+            source = sources[n]
+            if source.old_mode & MODE_TYPE != dest.new_mode & MODE_TYPE:
+                continue
+            source_size = source_sketches[n][0]
+            # Sizes too far apart can't make it, whatever they share
+            if min(size, source_size) * 100 < max(size, source_size) * threshold:
+                continue
+            score = renameScore(source_sketches[n], sketch)
+            if score >= threshold:
+                # Not the same content, not a 100% match
+                same_name = os.path.basename(source.path) == os.path.basename(dest.path)
+                pairs.append((min(score, 99), same_name, i, source))
+
+    pairs.sort(key = lambda pair: (-pair[0], not pair[1], pair[2]))
+    return [ (i, score, source) for score, _, i, source in pairs ]
@@ -0,0 +1,186 @@
+# vf_repack.py
+# Repacking moves loose objects into a single delta compressed pack.
+#
+# Choosing bases follows what git does: objects are sorted by type,
+# then by a hash of the path they were seen under (so that versions of
+# the same file end up next to each other), then by decreasing size.
+# Each object is then tried against the few objects before it in that
+# order (the "window"), and the smallest delta wins, as long as the
+# delta chain doesn't get deeper than the allowed depth.
+import os
+import time
+
+from verFlowRepository import repoDir
+from object import objectReadRaw, objectReadHeader
+from verFlowTree import treeParser
+from vf_pack import packWrite, packsLoad, deltaCreate
+
+REPACK_WINDOW = 10
+REPACK_DEPTH = 50
+# Objects bigger than this are stored whole, without trying deltas.
+REPACK_BIG_FILE = 16 * 1024 * 1024
+
+TYPE_ORDER = {b'commit': 0, b'tree': 1, b'blob': 2, b'tag': 3}
+
+
+def nameHash(name):
+    """git's pack name hash: mostly driven by the last characters of
+    the path, so that files with the same extension sort together."""
+    h = 0
+    for c in name.encode("utf8"):
+        if c in b" \t\n\r":
+            continue
+        h = ((h >> 2) + (c << 24)) & 0xffffffff
+    return h
+
+
+class vfRepackEntry(object):
+    __slots__ = ("sha", "fmt", "size", "name_hash", "base", "delta", "depth")
+
+    def __init__(self, sha, fmt, size):
+        self.sha = sha
+        self.fmt = fmt
+        self.size = size
+        self.name_hash = 0
+        # Base chosen for this object, and the delta against it
+        self.base = None
+        self.delta = None
+        self.depth = 0
+
+
+class vfRepackReport(object):
+    def __init__(self):
+        self.objects = 0
+        self.deltas = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.seconds = 0.0
+        self.pack = None
+
+
+def looseList(repo):
+    """All loose objects of repo as a list of (sha, path)."""
+    ret = list()
+    path = repoDir(repo, "objects")
+    for d in sorted(os.listdir(path)):
+        if len(d) != 2:
+            continue
+        dpath = os.path.join(path, d)
+        for f in sorted(os.listdir(dpath)):
+            if len(f) == 38:
+                ret.append((d + f, os.path.join(dpath, f)))
+    return ret
+
+
+def repackFindBases(repo, entries, window = REPACK_WINDOW, depth = REPACK_DEPTH):
+    """Sort entries and pick a delta base for each, with a sliding window.
+    Only the objects in the window are kept in memory."""
+    entries.sort(key = lambda e: (TYPE_ORDER[e.fmt], e.name_hash, -e.size))
+
+    win = list() # pairs (entry, data)
+    for e in entries:
+        if e.size > REPACK_BIG_FILE:
+            continue
+        data = objectReadRaw(repo, e.sha)[1]
+        best = None
+        for cand, cand_data in win:
+            if cand.fmt != e.fmt or cand.depth >= depth:
+                continue
+            # Hopeless if sizes are too different
+            if cand.size < e.size // 32 or e.size < cand.size // 32:
+                continue
+            # Only worth it if the delta is at most half the object,
+            # and better than what we already have.
+            max_size = len(best) - 1 if best else e.size // 2 - 20
+            if max_size <= 0:
+                continue
+            delta = deltaCreate(cand_data, data, max_size)
+            if delta is not None:
+                best = delta
+                e.base = cand
+        if best is not None:
+            e.delta = best
+            e.depth = e.base.depth + 1
+
+        win.append((e, data))
+        if len(win) > window:
+            win.pop(0)
+
+
+def repack(repo, prune = False, all = False, window = REPACK_WINDOW, depth = REPACK_DEPTH):
+    """Pack the loose objects of repo (and those of the existing packs
+    if all is set) into a new pack.  With prune, the files now in the
+    new pack are removed.  Returns a vfRepackReport."""
+    report = vfRepackReport()
+    start = time.time()
+
+    loose = looseList(repo)
+    old_packs = list(packsLoad(repo)) if all else list()
+
+    shas = dict()
+    for sha, path in loose:
+        shas[sha] = path
+        report.input_bytes += os.path.getsize(path)
+    for pack in old_packs:
+        for i in range(pack.count):
+            shas.setdefault(pack.shaAt(i).hex(), None)
+        report.input_bytes += os.path.getsize(pack.path) + os.path.getsize(pack.idx_path)
+
+    if not shas:
+        report.seconds = time.time() - start
+        return report
+
+    # Type and size come from the object headers, without inflating the
+    # objects; only trees are read, for the path names of the name hash.
+    # Other objects are read when they enter the delta window, and when
+    # they're written.
+    entries = dict()
+    names = dict()
+    for sha in shas:
+        fmt, size = objectReadHeader(repo, sha)
+        entries[sha] = vfRepackEntry(sha, fmt, size)
+        if fmt == b'tree':
+            for leaf in treeParser(objectReadRaw(repo, sha)[1]):
+                names.setdefault(leaf.sha, leaf.path)
+    for sha, e in entries.items():
+        if sha in names:
+            e.name_hash = nameHash(names[sha])
+
+    ordered = list(entries.values())
+    repackFindBases(repo, ordered, window, depth)
+
+    def packEntries():
+        for e in ordered:
+            if e.delta is not None:
+                yield e.sha, e.fmt, e.delta, e.base.sha
+            else:
+                yield e.sha, e.fmt, objectReadRaw(repo, e.sha)[1], None
+
+    report.pack = packWrite(repo, packEntries())
+    report.objects = len(ordered)
+    report.deltas = sum(1 for e in ordered if e.delta is not None)
+    report.output_bytes = os.path.getsize(report.pack) + os.path.getsize(report.pack[:-5] + ".idx")
+
+    if prune:
+        for sha, path in loose:
+            os.unlink(path)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass # Not empty yet
+        for pack in old_packs:
+            if pack.path == report.pack:
+                continue
+            pack.close()
+            os.unlink(pack.idx_path)
+            os.unlink(pack.path)
+            # Its bitmaps are of no use without it
+            if os.path.exists(pack.path[:-5] + ".bitmap"):
+                os.unlink(pack.path[:-5] + ".bitmap")
+        if repo.bitmap:
+            repo.bitmap.close()
+        repo.bitmap = None
+
+    packsLoad(repo, reload=True)
+    report.seconds = time.time() - start
+    return report
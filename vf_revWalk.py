@@ -0,0 +1,170 @@
+# vf_revWalk.py
+# Streaming history walks, for log and friends.
+#
+# revWalk is a generator: it yields commits as it finds them, newest
+# first, and only looks up a commit when it is about to be shown or
+# when one of its children was.  A caller that stops after n commits
+# has only touched those and their parents.  Commits come from the
+# commit-graph when there is one (see vf_commitGraph.commitLookup), so
+# walking doesn't read objects at all: only showing a commit does.
+import re
+import time
+import heapq
+from datetime import datetime, timezone, timedelta
+
+from object import objectReadRaw
+from verFlowTree import treeParser
+from vf_commitGraph import commitLookup
+
+# For relative dates: "2 weeks ago"
+DATE_UNITS = {
+    "second": 1,
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400,
+    "week": 7 * 86400,
+    "month": 30 * 86400,
+    "year": 365 * 86400,
+}
+
+
+def revDateParse(value, now = None):
+    """Parse a date as given to --since or --until: "@<timestamp>", an
+    ISO date ("2024-01-31", "2024-01-31 12:00:00"), or a relative one
+    ("3 days ago", "2.weeks.ago").  Returns seconds since the epoch."""
+    value = value.strip()
+    if now is None:
+        now = time.time()
+
+    if value.startswith("@"):
+        return int(value[1:])
+
+    m = re.match(r"^(\d+)[ .]+(second|minute|hour|day|week|month|year)s?(?:[ .]+ago)?$", value)
+    if m:
+        return int(now - int(m.group(1)) * DATE_UNITS[m.group(2)])
+
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M",
+                "%Y-%m-%d"):
+        try:
+            return int(datetime.strptime(value, fmt).timestamp())
+        except ValueError:
+            continue
+    raise Exception("Invalid date: {0}".format(value))
+
+
+def revWalk(repo, tips, first_parent = False, since = None, until = None, topo = False,
+            exclude = None):
+    """Yield the vfCommitInfo of the commits reachable from tips.
+
+    By default commits come by committer date, newest first, the way
+    git log shows them.  With topo, no commit comes before all its
+    children, and lines of history aren't intermixed; that needs the
+    whole history (from the commit-graph) before the first commit.
+
+    first_parent only follows the first parent of merges.  Commits
+    older than since aren't shown nor walked through, commits newer
+    than until are walked through but not shown.  Neither are those in
+    exclude, a set of SHAs."""
+    if topo:
+        yield from revWalkTopo(repo, tips, first_parent, since, until, exclude)
+        return
+
+    queue = list()
+    seen = set(exclude) if exclude else set()
+    counter = 0
+    for sha in tips:
+        if not sha in seen:
+            seen.add(sha)
+            info = commitLookup(repo, sha)
+            # The counter keeps insertion order among equal dates
+            heapq.heappush(queue, (-info.date, counter, info))
+            counter += 1
+
+    while queue:
+        _, _, info = heapq.heappop(queue)
+        if since is not None and info.date < since:
+            # Everything left is older
+            break
+        if until is None or info.date <= until:
+            yield info
+
+        parents = info.parents[:1] if first_parent else info.parents
+        for sha in parents:
+            if not sha in seen:
+                seen.add(sha)
+                parent = commitLookup(repo, sha)
+                heapq.heappush(queue, (-parent.date, counter, parent))
+                counter += 1
+
+
+def revWalkTopo(repo, tips, first_parent, since, until, exclude):
+    # Find every commit to show, and how many children each has among
+    # them.  Only the commit-graph is read.
+    commits = dict()
+    children = dict()
+    stack = list(tips)
+    while stack:
+        sha = stack.pop()
+        if sha in commits or (exclude and sha in exclude):
+            continue
+        info = commitLookup(repo, sha)
+        if since is not None and info.date < since:
+            continue
+        commits[sha] = info
+        children.setdefault(sha, 0)
+        for p in info.parents[:1] if first_parent else info.parents:
+            children[p] = children.get(p, 0) + 1
+            stack.append(p)
+
+    # Like git, a stack of the commits whose children were all shown:
+    # parents are pushed in order, and the next commit shown is the last
+    # one that became ready, which keeps lines of history together.
+    ready = [ info for info in commits.values() if children[info.sha] == 0 ]
+    ready.sort(key = lambda info: info.date)
+    while ready:
+        info = ready.pop()
+        if until is None or info.date <= until:
+            yield info
+        for p in info.parents[:1] if first_parent else info.parents:
+            if p in commits:
+                children[p] -= 1
+                if children[p] == 0:
+                    ready.append(commits[p])
+
+
+def revWalkObjects(repo, trees, seen):
+    """Yield (sha, path) for the trees in trees, given as (sha, path),
+    and the trees and blobs in them, recursively, in the order git
+    rev-list --objects shows them.  Objects in seen are skipped, and
+    those yielded added to it."""
+    # (sha, path, is_tree), popped in the order a recursion would see them
+    stack = [ (sha, path, True) for sha, path in reversed(trees) ]
+    while stack:
+        sha, path, is_tree = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+        yield sha, path
+        if not is_tree:
+            continue
+        entries = list()
+        for leaf in treeParser(objectReadRaw(repo, sha)[1]):
+            mode = int(leaf.mode, 8) & 0o170000
+            # Submodules (160000) are commits of another repository
+            if mode != 0o160000:
+                name = path + "/" + leaf.path if path else leaf.path
+                entries.append((leaf.sha, name, mode == 0o040000))
+        stack.extend(reversed(entries))
+
+
+def revDateFormat(timestamp, tz):
+    """Format a date the way git log does: "Thu Oct 5 12:00:00 2023
+    +0200".  tz is the "+HHMM" offset as found in commits."""
+    sign = -1 if tz.startswith("-") else 1
+    minutes = sign * (int(tz[1:3]) * 60 + int(tz[3:5]))
+    date = datetime.fromtimestamp(timestamp, timezone(timedelta(minutes = minutes)))
+    # Printed back from the value, as git does: "-0000" is "+0000"
+    return "{0} {1} {2} {3} {4}{5:02}{6:02}".format(date.strftime("%a %b"), date.day,
+                                                  date.strftime("%H:%M:%S"), date.year,
+                                                  "-" if minutes < 0 else "+",
+                                                  abs(minutes) // 60, abs(minutes) % 60)
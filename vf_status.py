@@ -0,0 +1,252 @@
+# vf_status.py
+# The status engine: compares HEAD, the index and the worktree, and
+# returns the differences as a vfStatus.  Printing is the job of the
+# status command.
+#
+# HEAD is compared with the index directory by directory, skipping those
+# whose cache tree is valid and matches HEAD; when the whole cache tree
+# is valid, that's a tree to tree diff (see vf_treeDiff).  The index and
+# the worktree are compared with merges over dicts and sets, linear in
+# the number of files.  Worktree files whose metadata differ from
+# their index entry are the only ones read, and they're hashed on a
+# pool of threads.
+import os
+from stat import S_ISREG, S_ISLNK
+from concurrent.futures import ThreadPoolExecutor
+
+from object import objectFind, objectRead, objectWrite, objectHashStream, GitBlob
+from vfRefs import refResolver, getActiveBranch
+from vf_indexFile import indexRead, indexWrite
+from vf_cacheTree import cacheTreeRead, indexLevel
+from vf_treeDiff import treeDiff
+from vf_ignore import vfignoreRead
+from vf_walk import vfWalkStats, worktreeWalk, pathIgnored
+from vf_fsmonitor import fsmonitorChanged, fsmonitorSave
+from vf_untrackedCache import untrackedCacheEnabled, untrackedCacheRead, untrackedCacheStore, untrackedFiles
+
+# Type bits (mode >> 12) of a symlink in the index
+INDEX_MODE_SYMLINK = 0b1010
+
+
+class vfStatus(object):
+    """Result of statusCompute.  Changes are lists of (change, path)
+    where change is "added", "modified" or "deleted"."""
+
+    def __init__(self):
+        # Active branch name, or None when HEAD is detached
+        self.branch = None
+        # Commit HEAD points to, None in a new repository
+        self.head = None
+        # HEAD -> index
+        self.staged = list()
+        # index -> worktree
+        self.unstaged = list()
+        self.untracked = list()
+        # Whether the fsmonitor told us which paths to look at, and how
+        # many tracked files it let us skip
+        self.fsmonitor = False
+        self.paths_examined = 0
+        self.paths_skipped = 0
+        # Directories listed from the untracked cache, and from the disk
+        self.dirs_cached = 0
+        self.dirs_read = 0
+        # What the worktree walker enumerated and pruned
+        self.walk = vfWalkStats()
+
+
+def treeToDict(repo, ref, prefix = ""):
+    ret = dict()
+    tree_sha = objectFind(repo,ref,fmt = b'tree')
+    tree = objectRead(repo,tree_sha)
+
+    for leaf in tree.items:
+        full_path = os.path.join(prefix, leaf.path)
+        # The mode tells us the type, no need to read the object
+        is_subtree = (int(leaf.mode, 8) & 0o170000) == 0o040000
+        # Depending on the type, we either store the path (if it's a
+        # blob, so a regular file), or recurse (if it's another tree,
+        # so a subdir)
+        if is_subtree:
+            ret.update(treeToDict(repo,leaf.sha,full_path))
+        else:
+            ret[full_path] = leaf.sha
+
+    return ret
+
+
+def statusHeadIndex(repo, index, head, status):
+    """Fill status.staged with the changes between HEAD and the index.
+    Directories whose cache tree entry is valid and has the SHA of the
+    same directory in HEAD are skipped without being read."""
+    names = index.names()
+    deleted = list()
+    if any(names[i] > names[i+1] for i in range(len(names) - 1)):
+        # Not sorted, so not split in directories: compare file by file
+        head_files = treeToDict(repo, head) if head else dict()
+        for i, name in enumerate(names):
+            sha = head_files.pop(name, None)
+            if sha is None:
+                status.staged.append(("added", name))
+            elif sha != index.sha(i):
+                status.staged.append(("modified", name))
+        deleted.extend(head_files)
+    else:
+        tree_sha = objectFind(repo, head, fmt = b'tree') if head else None
+        root = cacheTreeRead(index)
+        if root.valid() and root.entry_count == len(names):
+            # The index is the tree root.sha, already written: compare
+            # the trees, only reading the directories that differ
+            for change in treeDiff(repo, tree_sha, root.sha):
+                if change.status == "D":
+                    deleted.append(change.path)
+                else:
+                    status.staged.append(("added" if change.status == "A" else "modified", change.path))
+        else:
+            statusHeadIndexLevel(repo, index, names, root, tree_sha,
+                                 "", 0, len(names), status.staged, deleted)
+
+    # Files still in HEAD are files that we haven't met in the index,
+    # and thus have been deleted.
+    for name in sorted(deleted):
+        status.staged.append(("deleted", name))
+
+
+def statusHeadIndexLevel(repo, index, names, node, tree_sha, prefix, lo, hi, staged, deleted):
+    """Compare directory prefix of HEAD, the tree tree_sha (None if
+    absent from HEAD), with the index entries names[lo:hi]."""
+    if (tree_sha is not None and node is not None and node.valid()
+        and node.entry_count == hi - lo and node.sha == tree_sha):
+        return
+
+    head_items = dict()
+    if tree_sha is not None:
+        for leaf in objectRead(repo, tree_sha).items:
+            is_subtree = (int(leaf.mode, 8) & 0o170000) == 0o040000
+            head_items[leaf.path] = (is_subtree, leaf.sha)
+
+    for name, start, end in indexLevel(names, prefix, lo, hi):
+        is_subtree, sha = head_items.pop(name, (None, None))
+        if end is None:
+            if is_subtree:
+                deleted.extend(c.path for c in treeDiff(repo, sha, None, prefix + name + "/"))
+                sha = None
+            if sha is None:
+                staged.append(("added", names[start]))
+            elif sha != index.sha(start):
+                staged.append(("modified", names[start]))
+        else:
+            if is_subtree is False:
+                deleted.append(prefix + name)
+            child = node.subtrees.get(name) if node is not None else None
+            statusHeadIndexLevel(repo, index, names, child, sha if is_subtree else None,
+                                 prefix + name + "/", start, end, staged, deleted)
+
+    for name, (is_subtree, sha) in head_items.items():
+        if is_subtree:
+            deleted.extend(c.path for c in treeDiff(repo, sha, None, prefix + name + "/"))
+        else:
+            deleted.append(prefix + name)
+
+
+def statusIndexWorktree(repo, index, status, workers = None, paths = None, untracked_cache = None):
+    """Fill status.unstaged and status.untracked.  If paths is a set of
+    paths, only those are examined: the others are known to be clean.
+    Otherwise the whole worktree is listed, through untracked_cache if
+    given."""
+    names = index.names()
+    positions = dict()
+    for i, name in enumerate(names):
+        positions[name] = i
+
+    # Ignored files are left out of the listings
+    if paths is None and untracked_cache is not None:
+        untracked = [ f for f in untrackedFiles(repo, index, untracked_cache, workers) if not f in positions ]
+        status.dirs_cached = untracked_cache.dirs_cached
+        status.dirs_read = untracked_cache.dirs_read
+        status.walk = untracked_cache.walk
+        examine = range(len(names))
+    elif paths is None:
+        files = worktreeWalk(repo, ignore = vfignoreRead(repo, index), workers = workers, stats = status.walk)
+        untracked = [ f for f in files if not f in positions ]
+        examine = range(len(names))
+    else:
+        untracked = [ p for p in paths if not p in positions
+                      and os.path.isfile(os.path.join(repo.worktree, p)) ]
+        if untracked:
+            ignore = vfignoreRead(repo, index)
+            untracked = [ p for p in untracked if not pathIgnored(ignore, p) ]
+        examine = sorted(positions[p] for p in paths if p in positions)
+    status.paths_examined = len(examine)
+    status.paths_skipped = len(names) - len(examine)
+
+    # Files with the same metadata as their entry are taken as clean,
+    # the others need to be hashed.  A file that became a directory (or
+    # anything but a file or a symlink) is gone.
+    suspicious = list()
+    for i in examine:
+        name = names[i]
+        try:
+            stat = os.lstat(os.path.join(repo.worktree, name))
+        except FileNotFoundError:
+            status.unstaged.append(("deleted", name))
+            continue
+        if not (S_ISREG(stat.st_mode) or S_ISLNK(stat.st_mode)):
+            status.unstaged.append(("deleted", name))
+        elif not index.statMatches(i, stat):
+            suspicious.append(i)
+
+    def rehash(i):
+        """The SHA of the file of names[i], None if it isn't one."""
+        path = os.path.join(repo.worktree, names[i])
+        if os.path.islink(path):
+            if index.mode(i) >> 12 == INDEX_MODE_SYMLINK:
+                # Recorded as a symlink, as git does: its content is
+                # its target
+                return objectWrite(GitBlob(os.fsencode(os.readlink(path))))
+            # Recorded by add, which follows symlinks: what it points to
+            if not os.path.isfile(path):
+                return None
+        try:
+            with open(path, "rb") as fd:
+                return objectHashStream(fd)
+        except (FileNotFoundError, IsADirectoryError):
+            # Changed since we looked at it
+            return None
+
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        for i, sha in zip(suspicious, pool.map(rehash, suspicious)):
+            if sha is None:
+                status.unstaged.append(("deleted", names[i]))
+            elif sha != index.sha(i):
+                status.unstaged.append(("modified", names[i]))
+    status.unstaged.sort(key = lambda change: change[1])
+
+    status.untracked = sorted(untracked)
+
+
+def statusCompute(repo, index = None, workers = None):
+    """Compute the status of repo, returns a vfStatus."""
+    if index is None:
+        index = indexRead(repo)
+
+    status = vfStatus()
+    status.branch = getActiveBranch(repo) or None
+    status.head = refResolver(repo, "HEAD")
+
+    statusHeadIndex(repo, index, status.head, status)
+
+    token, paths = fsmonitorChanged(repo, index)
+    status.fsmonitor = paths is not None
+    untracked_cache = None
+    if paths is None and untrackedCacheEnabled(repo):
+        untracked_cache = untrackedCacheRead(repo, index)
+    statusIndexWorktree(repo, index, status, workers, paths, untracked_cache)
+    if untracked_cache is not None and untracked_cache.changed:
+        # Save what we listed for the next status, unless another
+        # command is writing the index or did since we read it
+        untrackedCacheStore(index, untracked_cache)
+        indexWrite(repo, index, if_able = True)
+    if token:
+        dirty = [ name for _, name in status.unstaged ] + status.untracked
+        fsmonitorSave(repo, token, index, dirty)
+    return status
@@ -0,0 +1,124 @@
+# vf_treeDiff.py
+# Comparing two trees, like git diff-tree.
+#
+# Entries of a tree are sorted (by name, with a "/" after the names of
+# subtrees), so two trees are compared by walking their entries in
+# lockstep, as in a merge.  A subtree with the same SHA on both sides is
+# identical, so it is skipped without being read: comparing two commits
+# only reads the trees of the directories that changed, not every tree
+# of both sides as flattening them would.
+#
+# Changes are yielded as they are found, in path order.
+from object import objectReadRaw
+
+# Mode of trees, and the bits of a mode that tell the type of an entry
+MODE_TREE = 0o040000
+MODE_TYPE = 0o170000
+
+# In place of the SHA of a side that has no such entry
+TREE_DIFF_ZERO = "0" * 40
+
+
+class vfTreeChange(object):
+    """A difference between two trees.  status is "A" (added), "D"
+    (deleted), "M" (modified) or "T" (type changed, say a file became a
+    symlink).  The side without the entry has mode 0 and SHA None.
+
+    Rename detection (see vf_renames) adds "R" (renamed) and "C"
+    (copied), from old_path, with a similarity score in percent."""
+    __slots__ = ("status", "path", "old_mode", "new_mode", "old_sha", "new_sha",
+                 "old_path", "score")
+
+    def __init__(self, status, path, old_mode, new_mode, old_sha, new_sha,
+                 old_path = None, score = None):
+        self.status = status
+        self.path = path
+        self.old_mode = old_mode
+        self.new_mode = new_mode
+        self.old_sha = old_sha
+        self.new_sha = new_sha
+        self.old_path = old_path
+        self.score = score
+
+    def name(self):
+        """status and path(s), as git's --name-status shows them."""
+        if self.old_path is not None:
+            return "{0}{1:03}\t{2}\t{3}".format(self.status, self.score, self.old_path, self.path)
+        return "{0}\t{1}".format(self.status, self.path)
+
+    def raw(self):
+        """The change as a line of git diff-tree's raw output."""
+        return ":{0:06o} {1:06o} {2} {3} {4}".format(
+            self.old_mode, self.new_mode, self.old_sha or TREE_DIFF_ZERO,
+            self.new_sha or TREE_DIFF_ZERO, self.name())
+
+
+def treeEntries(repo, sha):
+    """The entries of tree sha (None for an empty tree), as (key, name,
+    mode, sha), in the tree's order.  key is what they're sorted by."""
+    if sha is None:
+        return []
+    raw = objectReadRaw(repo, sha)
+    if raw is None:
+        raise Exception("Missing object {0}".format(sha))
+    if raw[0] != b'tree':
+        raise Exception("Not a tree: {0}".format(sha))
+
+    data = raw[1]
+    ret = list()
+    pos = 0
+    end = len(data)
+    while pos < end:
+        space = data.index(b' ', pos)
+        nul = data.index(b'\x00', space)
+        mode = int(data[pos:space], 8)
+        name = data[space + 1:nul]
+        key = name + b'/' if mode & MODE_TYPE == MODE_TREE else name
+        ret.append((key, name.decode("utf8"), mode, data[nul + 1:nul + 21].hex()))
+        pos = nul + 21
+    return ret
+
+
+def treeDiff(repo, old, new, prefix = "", recursive = True):
+    """Yield the vfTreeChange from tree old to tree new (SHAs, None for
+    an empty tree), with paths under prefix ("" or ending with "/").
+
+    With recursive, subtrees that differ are compared in turn, and only
+    files (and submodules) are yielded; otherwise they're yielded as
+    changes to a tree, without reading them."""
+    if old == new:
+        return
+
+    old_entries = treeEntries(repo, old)
+    new_entries = treeEntries(repo, new)
+    i = j = 0
+    while i < len(old_entries) or j < len(new_entries):
+        a = old_entries[i] if i < len(old_entries) else None
+        b = new_entries[j] if j < len(new_entries) else None
+        if b is None or (a is not None and a[0] < b[0]):
+            i += 1
+            path = prefix + a[1]
+            if recursive and a[2] == MODE_TREE:
+                yield from treeDiff(repo, a[3], None, path + "/", recursive)
+            else:
+                yield vfTreeChange("D", path, a[2], 0, a[3], None)
+        elif a is None or b[0] < a[0]:
+            j += 1
+            path = prefix + b[1]
+            if recursive and b[2] == MODE_TREE:
+                yield from treeDiff(repo, None, b[3], path + "/", recursive)
+            else:
+                yield vfTreeChange("A", path, 0, b[2], None, b[3])
+        else:
+            i += 1
+            j += 1
+            if a[3] == b[3] and a[2] == b[2]:
+                # The same, subtree or not: nothing to look at
+                continue
+            path = prefix + a[1]
+            if recursive and a[2] == MODE_TREE:
+                # Same key, so b is a tree too
+                yield from treeDiff(repo, a[3], b[3], path + "/", recursive)
+            else:
+                status = "M" if a[2] & MODE_TYPE == b[2] & MODE_TYPE else "T"
+                yield vfTreeChange(status, path, a[2], b[2], a[3], b[3])
@@ -0,0 +1,225 @@
+# vf_untrackedCache.py
+# The untracked cache is an index extension (signature VFUC) that
+# remembers, for each directory of the worktree, what it contained the
+# last time status listed it: its files that are not ignored, and its
+# subdirectories.  A directory's mtime changes when an entry is added,
+# removed or renamed in it, so while it keeps the mtime (and inode) we
+# recorded, its listing is taken from the cache instead of the disk.
+#
+# Whether a file is ignored also depends on the ignore rules, so each
+# directory also records the fingerprint of the rules that applied to it
+# (see vfignoreDirFingerprint): editing a .vfignore only invalidates the
+# directory it is in and those below, editing info/exclude or the global
+# ignore file invalidates everything.
+#
+# Which of the listed files are untracked is decided by the caller
+# against the index, so adding or removing files from the index doesn't
+# invalidate anything.
+#
+# The worktree is walked a level at a time, as the walker of vf_walk
+# does: the directories of a level that the cache can't answer for are
+# listed together, on its pool of threads.
+#
+# Format: the base fingerprint (20 bytes), then directories in pre-order,
+# each as
+#
+#   <name> \0 <mtime s> <mtime ns> <ino> <fingerprint> <file count> <subdir count>
+#   <file name> \0 ...
+#
+# where numbers are 32 bits, big endian, and name is relative to the
+# parent (empty for the root).  The extension's signature starts with an
+# upper case letter, so git keeps ignoring it.
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from vf_ignore import vfignoreRead, vfignoreBaseFingerprint, vfignoreDirFingerprint
+from vf_walk import vfWalkStats, walkListDirs
+
+UNTRACKED_EXT = b"VFUC"
+UNTRACKED_DIR = struct.Struct(">III20sII")
+
+# A directory modified less than that before we list it may be modified
+# again within the same mtime tick: its listing isn't trusted next time.
+UNTRACKED_RACY_NS = 1000000000
+
+
+class vfUntrackedDir(object):
+    __slots__ = ("stat", "fingerprint", "files", "dirs")
+
+    def __init__(self, stat = None, fingerprint = None):
+        # (mtime_s, mtime_ns, ino) of the directory when it was listed,
+        # None if the listing can't be trusted
+        self.stat = stat
+        self.fingerprint = fingerprint
+        # Files of the directory that are not ignored, by name
+        self.files = list()
+        # Name -> vfUntrackedDir, ignored directories left out
+        self.dirs = dict()
+
+
+class vfUntrackedCache(object):
+    def __init__(self, fingerprint = None, root = None):
+        self.fingerprint = fingerprint
+        self.root = root
+        # Set when the cache differs from what the index holds
+        self.changed = False
+        # Directories taken from the cache, and read from the disk
+        self.dirs_cached = 0
+        self.dirs_read = 0
+        # Counters of the walker, for the directories read
+        self.walk = vfWalkStats()
+
+
+def untrackedStat(stat):
+    mask = 0xFFFFFFFF
+    return (int(stat.st_mtime) & mask, stat.st_mtime_ns % 10**9, stat.st_ino & mask)
+
+
+def untrackedCacheParse(data):
+    """Parse the content of a VFUC extension, returns a vfUntrackedCache."""
+
+    def parseDir(pos):
+        nul = data.index(b'\x00', pos)
+        name = data[pos:nul].decode("utf8")
+        mtime_s, mtime_ns, ino, fingerprint, nfiles, ndirs = UNTRACKED_DIR.unpack_from(data, nul + 1)
+        pos = nul + 1 + UNTRACKED_DIR.size
+        node = vfUntrackedDir((mtime_s, mtime_ns, ino), fingerprint)
+        if node.stat == (0, 0, 0):
+            node.stat = None
+        for _ in range(nfiles):
+            nul = data.index(b'\x00', pos)
+            node.files.append(data[pos:nul].decode("utf8"))
+            pos = nul + 1
+        for _ in range(ndirs):
+            child_name, child, pos = parseDir(pos)
+            node.dirs[child_name] = child
+        return name, node, pos
+
+    return vfUntrackedCache(data[:20], parseDir(20)[1])
+
+
+def untrackedCacheSerialize(cache):
+    out = bytearray(cache.fingerprint)
+
+    def writeDir(name, node):
+        out.extend(name.encode("utf8") + b'\x00')
+        out.extend(UNTRACKED_DIR.pack(*(node.stat or (0, 0, 0)), node.fingerprint,
+                                      len(node.files), len(node.dirs)))
+        for f in node.files:
+            out.extend(f.encode("utf8") + b'\x00')
+        for child_name in sorted(node.dirs):
+            writeDir(child_name, node.dirs[child_name])
+
+    writeDir("", cache.root)
+    return bytes(out)
+
+
+def untrackedCacheEnabled(repo):
+    """core.untrackedCache, true unless set otherwise."""
+    if repo.conf is not None and repo.conf.has_option("core", "untrackedCache"):
+        return repo.conf.getboolean("core", "untrackedCache")
+    return True
+
+
+def untrackedCacheRead(repo, index):
+    """The untracked cache of index.  It is empty if there is none, or
+    if the ignore rules of the whole worktree changed."""
+    fingerprint = vfignoreBaseFingerprint(repo)
+    data = index.extensions.get(UNTRACKED_EXT)
+    if data:
+        cache = untrackedCacheParse(data)
+        if cache.fingerprint == fingerprint:
+            return cache
+    cache = vfUntrackedCache(fingerprint)
+    cache.changed = True
+    return cache
+
+
+def untrackedCacheStore(index, cache):
+    index.extensions[UNTRACKED_EXT] = untrackedCacheSerialize(cache)
+
+
+def untrackedFiles(repo, index, cache, workers = None):
+    """All the files of the worktree that are not ignored, relative to
+    its root, whether they're tracked or not.  Directories whose listing
+    is still valid in cache aren't read, the others are, on a pool of
+    workers threads, and cache is updated with what was found."""
+    # SHA of the .vfignore of each directory, to fingerprint its rules
+    ignore_shas = dict()
+    for i, name in enumerate(index.names()):
+        if name == ".vfignore" or name.endswith("/.vfignore"):
+            ignore_shas[os.path.dirname(name)] = index.sha(i)
+
+    # Only read when a directory needs to be listed
+    rules = None
+    ret = list()
+
+    def gone(parent):
+        # A directory gone while we trusted the listing of its parent:
+        # don't anymore
+        if parent is not None:
+            parent.stat = None
+        cache.changed = True
+
+    # Directories of the level: (path, their cached node or None, the
+    # fingerprint of their parent, the new node of their parent)
+    level = [ ("", cache.root, cache.fingerprint, None) ]
+    root = None
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        while level:
+            # (path, parent, node) of the directories found, and those
+            # to read as (path, parent, old node, stat, fingerprint)
+            found = list()
+            todo = list()
+            for rel, node, parent_fingerprint, parent in level:
+                try:
+                    stat = os.lstat(os.path.join(repo.worktree, rel) if rel else repo.worktree)
+                except FileNotFoundError:
+                    gone(parent)
+                    continue
+                fingerprint = vfignoreDirFingerprint(parent_fingerprint, ignore_shas.get(rel))
+                if (node is not None and node.stat is not None
+                    and node.stat == untrackedStat(stat) and node.fingerprint == fingerprint):
+                    cache.dirs_cached += 1
+                    found.append((rel, parent, node))
+                else:
+                    todo.append((rel, parent, node, stat, fingerprint))
+
+            if todo:
+                cache.dirs_read += len(todo)
+                cache.changed = True
+                if rules is None:
+                    rules = vfignoreRead(repo, index)
+                listed = time.time_ns()
+                listings = walkListDirs(repo, pool, [ t[0] for t in todo ], rules, cache.walk)
+                for (rel, parent, old, stat, fingerprint), listing in zip(todo, listings):
+                    if listing is None:
+                        gone(parent)
+                        continue
+                    node = vfUntrackedDir(untrackedStat(stat), fingerprint)
+                    if listed - stat.st_mtime_ns < UNTRACKED_RACY_NS:
+                        node.stat = None
+                    node.files, subdirs = listing
+                    # Subdirectories may still be valid: keep theirs
+                    node.dirs = dict((name, old.dirs.get(name) if old is not None else None)
+                                     for name in subdirs)
+                    found.append((rel, parent, node))
+
+            next_level = list()
+            for rel, parent, node in found:
+                ret.extend(os.path.join(rel, f) for f in node.files)
+                if parent is None:
+                    root = node
+                else:
+                    parent.dirs[os.path.basename(rel)] = node
+                # Filled again as subdirectories are found
+                children = node.dirs
+                node.dirs = dict()
+                for name, child in children.items():
+                    next_level.append((os.path.join(rel, name), child, node.fingerprint, node))
+            level = next_level
+
+    cache.root = root
+    return ret
@@ -0,0 +1,124 @@
+# vf_walk.py
+# The worktree walker shared by status, add and check-ignore.
+#
+# Directories are listed with os.scandir, whose entries already know
+# their type, so nothing is stat'ed twice.  Ignore rules are applied to
+# directories before descending into them: an ignored directory, and
+# everything below it, is pruned, like git does.  Directories of the
+# same depth are independent, so they're listed on a pool of threads
+# (see walkListDirs).  The untracked cache (vf_untrackedCache) walks the
+# same way, only listing the directories it doesn't have.
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from vf_ignore import checkIgnore
+
+# Directories listed by a task of the pool: listing one is quick, a task
+# per directory would cost more than the listing
+WALK_BATCH = 32
+
+
+class vfWalkStats(object):
+    def __init__(self):
+        # Directory entries we got from scandir
+        self.enumerated = 0
+        # Ignored directories we didn't descend into, and ignored files
+        self.pruned = 0
+        self.ignored = 0
+
+    def add(self, other):
+        self.enumerated += other.enumerated
+        self.pruned += other.pruned
+        self.ignored += other.ignored
+
+
+def pathIgnored(ignore, path, is_dir = False):
+    """Whether path is ignored, either itself or because one of the
+    directories containing it is.  That's the walker's rule, for paths
+    that don't come from a walk."""
+    parts = path.split("/")
+    for i in range(1, len(parts)):
+        if checkIgnore(ignore, "/".join(parts[:i]), True):
+            return True
+    return checkIgnore(ignore, path, is_dir)
+
+
+def walkListDir(repo, rel, ignore = None, stats = None):
+    """List directory rel of the worktree.  Returns (files, dirs), the
+    names of its files and subdirectories, sorted, without the ignored
+    ones when ignore is given, and without .ver_flow."""
+    if stats is None:
+        stats = vfWalkStats()
+    files = list()
+    dirs = list()
+    path = os.path.join(repo.worktree, rel) if rel else repo.worktree
+    prefix = rel + "/" if rel else ""
+    with os.scandir(path) as it:
+        for entry in it:
+            stats.enumerated += 1
+            if not rel and entry.name == ".ver_flow":
+                continue
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if ignore is not None and checkIgnore(ignore, prefix + entry.name, is_dir):
+                if is_dir:
+                    stats.pruned += 1
+                else:
+                    stats.ignored += 1
+                continue
+            if is_dir:
+                dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    files.sort()
+    dirs.sort()
+    return files, dirs
+
+
+def walkListDirs(repo, pool, rels, ignore = None, stats = None):
+    """walkListDir for each of the directories rels, those of a level of
+    the walk, on the ThreadPoolExecutor pool.  Returns a list of (files,
+    dirs) in the order of rels, None for a directory that is gone.
+    Counters are added to stats, if given."""
+
+    def listDirs(batch):
+        local = vfWalkStats()
+        ret = list()
+        for rel in batch:
+            try:
+                ret.append(walkListDir(repo, rel, ignore, local))
+            except (FileNotFoundError, NotADirectoryError):
+                ret.append(None)
+        return ret, local
+
+    batches = [ rels[i:i + WALK_BATCH] for i in range(0, len(rels), WALK_BATCH) ]
+    # A single batch isn't worth a trip through the pool
+    listed = map(listDirs, batches) if len(batches) == 1 else pool.map(listDirs, batches)
+    ret = list()
+    for listings, local in listed:
+        if stats is not None:
+            stats.add(local)
+        ret.extend(listings)
+    return ret
+
+
+def worktreeWalk(repo, top = "", ignore = None, workers = None, stats = None):
+    """All the files under directory top of the worktree (relative to
+    its root), skipping ignored files and directories when ignore is
+    given.  top itself is walked even if ignored.  Counters are added
+    to stats, if given."""
+    top = os.path.normpath(top) if top else ""
+    ret = list()
+
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        level = [ top ]
+        while level:
+            next_level = list()
+            for rel, listing in zip(level, walkListDirs(repo, pool, level, ignore, stats)):
+                if listing is None:
+                    continue
+                files, dirs = listing
+                prefix = rel + "/" if rel else ""
+                ret.extend(prefix + f for f in files)
+                next_level.extend(prefix + d for d in dirs)
+            level = next_level
+    return ret